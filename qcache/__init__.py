@@ -5,6 +5,13 @@
 Usage:
   qcache [-hd] [--port=PORT] [--size=MAX_SIZE] [--age=MAX_AGE] [--statistics-buffer-size=BUFFER_SIZE]
          [--cert-file=PATH_TO_CERT] [--ca-file=PATH_TO_CA] [--basic-auth=<USER>:<PASSWORD>]
+         [--workers=WORKERS] [--query-threads=THREADS] [--response-batch-rows=ROWS]
+         [--result-cache-size=RESULT_CACHE_SIZE] [--gc-mode=GC_MODE] [--eviction-policy=POLICY]
+         [--admission=ADMISSION] [--sliding-age] [--reconcile-interval=SECONDS]
+         [--rss-soft-limit=BYTES] [--rss-hard-limit=BYTES] [--spill-dir=DIR] [--spill-size=BYTES]
+         [--snapshot-dir=DIR] [--snapshot-interval=SECONDS] [--optimize-types]
+         [--category-threshold=FRACTION] [--compact-strings] [--auto-index-scans=SCANS]
+         [--auto-index-size=BYTES] [--auto-index-age=SECONDS]
 
 Options:
   -h --help                     Show this screen
@@ -17,10 +24,57 @@ Options:
   -ca PATH_TO_CA --ca-file=PATH_TO_CA   Path to CA file, if provided client certificates will be checked against this ca
   -d --debug   Run in debug mode
   -ba <USER>:<PASSWORD> --basic-auth=<USER>:<PASSWORD>   Enable basic auth, requires that SSL is enabled.
+  -w WORKERS --workers=WORKERS  Number of worker processes. With more than one worker datasets are
+                                sharded between the workers by key and the cache size is split
+                                evenly between them. [default: 1]
+  -t THREADS --query-threads=THREADS  Number of threads used to execute queries. 0 = execute queries
+                                      in the thread serving requests. [default: 0]
+  -r ROWS --response-batch-rows=ROWS  Query results with more rows than this are serialized and
+                                      written to the client in batches of this size. [default: 50000]
+  --result-cache-size=RESULT_CACHE_SIZE  Max size of the query result cache, bytes. Split evenly
+                                         between workers. 0 = disabled. [default: 0]
+  --gc-mode=GC_MODE  Garbage collection performed when idle or after many queries, full = all generations,
+                     young = only the young generations, off = automatic collection only. [default: full]
+  --eviction-policy=POLICY  Policy selecting datasets to evict when the cache is full. lru = least recently
+                            used, lfu = least frequently used, gdsf = greedy dual size frequency,
+                            arc = adaptive replacement cache. [default: lru]
+  --admission=ADMISSION  Policy deciding if a new dataset may evict other datasets. none = always,
+                         tinylfu = only if it's estimated to be accessed more often than the evicted
+                         datasets. [default: none]
+  --sliding-age  Count the age of datasets from when they were last queried rather than from when
+                 they were stored.
+  --reconcile-interval=SECONDS  Seconds between reconciliations of the cache size with the memory
+                                used by the process. 0 = disabled. [default: 0]
+  --rss-soft-limit=BYTES  Datasets are evicted when the resident memory of the process exceeds this.
+                          Split evenly between workers. 0 = the hard limit. [default: 0]
+  --rss-hard-limit=BYTES  Stores and queries are rejected with 503 while the resident memory of the
+                          process exceeds this. Split evenly between workers. 0 = no limit. [default: 0]
+  --spill-dir=DIR  Directory that datasets evicted from memory are written to. Queries for them load
+                   them back into memory. Each worker uses a sub directory. Requires --spill-size.
+  --spill-size=BYTES  Max size of the datasets written to the spill directory. Split evenly between
+                      workers. 0 = disabled. [default: 0]
+  --snapshot-dir=DIR  Directory that a snapshot of the cache is saved to on SIGTERM. Datasets in an
+                      existing snapshot are loaded when first queried after a restart. Each worker
+                      uses a sub directory.
+  --snapshot-interval=SECONDS  Seconds between snapshots in addition to the one on SIGTERM. Only
+                               modified datasets are written. 0 = disabled. [default: 0]
+  --optimize-types  Store uploaded datasets in compact types. Integer columns are downcast and string
+                    columns with few distinct values are stored as categoricals.
+  --category-threshold=FRACTION  Max number of distinct values, as a fraction of the number of rows,
+                                 for a string column to be stored as a categorical when optimizing
+                                 types. [default: 0.5]
+  --compact-strings  Store the string columns of uploaded datasets in one buffer per column rather
+                     than as one Python object per value.
+  --auto-index-scans=SCANS  Number of times that filters or ordering scan a column of a dataset before
+                            an index is built for it while the server is idle. 0 = disabled. [default: 0]
+  --auto-index-size=BYTES  Max size of all automatically built indexes. Split evenly between workers.
+                           [default: 100000000]
+  --auto-index-age=SECONDS  Automatically built indexes that have not been used for this long are
+                            dropped. [default: 600]
 """
 
 from docopt import docopt
-from qcache.app import run
+from qcache import app, router
 
 __version__ = "0.9.3"
 __author__ = "Tobias Gustafsson"
@@ -37,14 +91,40 @@ def main():
     if '--version' in args:
         print __version__
     else:
-        run(port=int(args['--port']),
-            max_cache_size=int(args['--size']),
-            max_age=int(args['--age']),
-            statistics_buffer_size=int(args['--statistics-buffer-size']),
-            debug=args['--debug'],
-            certfile=args['--cert-file'],
-            cafile=args['--ca-file'],
-            basic_auth=args['--basic-auth'])
+        run_args = dict(port=int(args['--port']),
+                        max_cache_size=int(args['--size']),
+                        max_age=int(args['--age']),
+                        statistics_buffer_size=int(args['--statistics-buffer-size']),
+                        debug=args['--debug'],
+                        certfile=args['--cert-file'],
+                        cafile=args['--ca-file'],
+                        basic_auth=args['--basic-auth'],
+                        query_threads=int(args['--query-threads']),
+                        response_batch_rows=int(args['--response-batch-rows']),
+                        result_cache_size=int(args['--result-cache-size']),
+                        gc_mode=args['--gc-mode'],
+                        eviction_policy=args['--eviction-policy'],
+                        admission=args['--admission'],
+                        sliding_age=args['--sliding-age'],
+                        reconcile_interval=float(args['--reconcile-interval']),
+                        rss_soft_limit=int(args['--rss-soft-limit']),
+                        rss_hard_limit=int(args['--rss-hard-limit']),
+                        spill_dir=args['--spill-dir'],
+                        spill_size=int(args['--spill-size']),
+                        snapshot_dir=args['--snapshot-dir'],
+                        snapshot_interval=float(args['--snapshot-interval']),
+                        optimize_types=args['--optimize-types'],
+                        category_threshold=float(args['--category-threshold']),
+                        compact_strings=args['--compact-strings'],
+                        auto_index_scans=int(args['--auto-index-scans']),
+                        auto_index_size=int(args['--auto-index-size']),
+                        auto_index_age=float(args['--auto-index-age']))
+
+        workers = int(args['--workers'])
+        if workers > 1:
+            router.run(workers=workers, **run_args)
+        else:
+            app.run(**run_args)
 
 if __name__ == '__main__':
     main()
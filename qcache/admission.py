@@ -0,0 +1,77 @@
+"""
+Admission policies deciding whether a new dataset is worth evicting other datasets for.
+
+With the TinyLFU policy the access frequency of all dataset keys, cached or not, is estimated
+with a compact frequency sketch. A new dataset that requires evictions is only stored if it's
+estimated to be accessed more often than each of the datasets that would be evicted. Datasets
+that are uploaded once and rarely queried can then not flush frequently queried datasets
+from the cache.
+"""
+
+ADMISSION_NONE = 'none'
+ADMISSION_TINYLFU = 'tinylfu'
+ADMISSION_POLICIES = (ADMISSION_NONE, ADMISSION_TINYLFU)
+
+
+class FrequencySketch(object):
+    """
+    Count-min sketch with small saturating counters. All counters are halved when sample_size
+    accesses have been recorded so that the estimates reflect recent popularity.
+    """
+    MAX_COUNT = 15
+
+    def __init__(self, width=16384, depth=4, sample_size=None):
+        self.width = width
+        self.sample_size = sample_size or 10 * width
+        self.additions = 0
+        self._rows = [bytearray(width) for _ in range(depth)]
+
+    def _counters(self, key):
+        key_hash = hash(key)
+        for seed, row in enumerate(self._rows):
+            yield row, hash((seed, key_hash)) % self.width
+
+    def increment(self, key):
+        added = False
+        for row, i in self._counters(key):
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+                added = True
+
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self._age()
+
+    def estimate(self, key):
+        return min(row[i] for row, i in self._counters(key))
+
+    def _age(self):
+        self._rows = [bytearray(count >> 1 for count in row) for row in self._rows]
+        self.additions //= 2
+
+
+class TinyLFUAdmission(object):
+    def __init__(self, sketch=None):
+        self.sketch = sketch or FrequencySketch()
+
+    def record(self, key):
+        self.sketch.increment(key)
+
+    def admit(self, key, victim_keys):
+        """
+        :return: True if key is estimated to be accessed more often than every key in victim_keys.
+        """
+        frequency = self.sketch.estimate(key)
+        return all(frequency > self.sketch.estimate(victim_key) for victim_key in victim_keys)
+
+
+def make_admission(name):
+    """
+    :return: The admission policy with the given name, None if all datasets should be admitted.
+    """
+    if name not in ADMISSION_POLICIES:
+        raise ValueError('Unknown admission policy "{name}", must be one of {names}'.format(
+            name=name, names=', '.join(ADMISSION_POLICIES)))
+
+    return TinyLFUAdmission() if name == ADMISSION_TINYLFU else None
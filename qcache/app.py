@@ -1,17 +1,28 @@
 import base64
 import json
-import re
+import signal
 import ssl
 import time
-import gc
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.concurrent import dummy_executor
 from tornado.ioloop import IOLoop
-from tornado.web import RequestHandler, Application, url, HTTPError
+from tornado.web import RequestHandler, Application, url, HTTPError, stream_request_body
 
 from qcache.dataset_cache import DatasetCache
-from qcache.compression import CompressedContentEncoding, decoded_body
-from qcache.qframe import MalformedQueryException, QFrame
-from qcache.statistics import Statistics
+from qcache.expiry import ExpirySweeper
+from qcache.auto_index import AutoIndexer
+from qcache.gc_scheduler import GCScheduler
+from qcache.memory import MemoryGovernor, MemoryReconciler
+from qcache.compression import CompressedContentEncoding, StreamDecoder, accepted_encodings, preferred_encoding
+from qcache.qframe import (ColumnarFormatException, ColumnTypeException, MalformedQueryException, QFrame,
+                           CSVStreamParser, INDEX_KINDS, IndexException, parse_type_name)
+from qcache.result_cache import ResultCache, result_key
+from qcache.snapshot import SnapshotWriter
+from qcache.statistics import Statistics, add_hit_ratio
 
 
 class ResponseCode(object):
@@ -24,11 +35,24 @@ class ResponseCode(object):
     NOT_ACCEPTABLE = 406
     UNSUPPORTED_MEDIA_TYPE = 415
 
+    BAD_GATEWAY = 502
+    SERVICE_UNAVAILABLE = 503
+
+
+class ServiceUnavailable(HTTPError):
+    def __init__(self, retry_after, log_message=None):
+        super(ServiceUnavailable, self).__init__(ResponseCode.SERVICE_UNAVAILABLE, log_message)
+        self.retry_after = retry_after
+
 
 CONTENT_TYPE_JSON = 'application/json'
 CONTENT_TYPE_CSV = 'text/csv'
-ACCEPTED_TYPES = {CONTENT_TYPE_JSON, CONTENT_TYPE_CSV}  # text/*, */*?
-CHARSET_REGEX = re.compile('charset=([A-Za-z0-9_-]+)')
+CONTENT_TYPE_COLUMNAR = 'application/x-qcache-columnar'
+ACCEPTED_TYPES = {CONTENT_TYPE_JSON, CONTENT_TYPE_CSV, CONTENT_TYPE_COLUMNAR}  # text/*, */*?
+
+# Shapes of JSON datasets given by the orient parameter of the JSON media type, records is the default
+JSON_ORIENTS = ('records', 'columns', 'split')
+JSON_UPLOAD_ORIENTS = ('records', 'columns')
 
 auth_user = None
 auth_password = None
@@ -42,6 +66,12 @@ def credentials_correct(provided_user, provided_password):
     return provided_user == auth_user and provided_password == auth_password
 
 
+def configure_auth(basic_auth):
+    if basic_auth:
+        global auth_user, auth_password
+        auth_user, auth_password = basic_auth.split(':', 2)
+
+
 def http_auth(handler_class):
     """
     Basic auth decorator. Based on the decorator found here:
@@ -54,6 +84,10 @@ def http_auth(handler_class):
         handler._transforms = []
         handler.finish()
 
+        # Handlers streaming the request body wait for this future before reading the body
+        if handler._prepared_future is not None and not handler._prepared_future.done():
+            handler._prepared_future.set_result(None)
+
     def wrap_execute(handler_execute):
         def is_authenticated(handler):
             if not auth_enabled():
@@ -85,54 +119,281 @@ def http_auth(handler_class):
     return handler_class
 
 
+def parse_media_type(value):
+    """
+    Split a media type such as 'application/json; orient=columns' into the type and a dict of parameters.
+    """
+    parts = value.split(';')
+    params = {}
+    for part in parts[1:]:
+        name, _, param_value = part.partition('=')
+        params[name.strip().lower()] = param_value.strip().strip('"')
+
+    return parts[0].strip().lower(), params
+
+
+def json_content_type(orient):
+    if orient == 'records':
+        return CONTENT_TYPE_JSON
+
+    return '{content_type}; orient={orient}'.format(content_type=CONTENT_TYPE_JSON, orient=orient)
+
+
+def json_orient(content_type):
+    return parse_media_type(content_type)[1].get('orient', 'records')
+
+
+def utf8_records(records):
+    for r in records:
+        yield {k: v.encode(encoding='utf-8') if isinstance(v, unicode) else v for k, v in r.items()}
+
+
+def is_columns(data):
+    return isinstance(data, dict) and all(isinstance(values, list) for values in data.values())
+
+
+def utf8_columns(columns):
+    return [(name, [v.encode(encoding='utf-8') if isinstance(v, unicode) else v for v in values])
+            for name, values in columns.items()]
+
+
 class UTF8JSONDecoder(json.JSONDecoder):
     def decode(self, json_string):
         obj = super(UTF8JSONDecoder, self).decode(json_string)
         assert isinstance(obj, list), "Must pass a list of objects"
-
-        for r in obj:
-            yield {k: v.encode(encoding='utf-8') if isinstance(v, unicode) else v for k, v in r.items()}
+        return utf8_records(obj)
 
 
 class AppState(object):
     def __init__(self):
-        self.query_count = 0
+        # Number of queries per dataset key currently executing in the query executor
+        self.running_queries = Counter()
+
+    @contextmanager
+    def executing_queries(self, *dataset_keys):
+        """
+        Register work reading the frames of dataset_keys in the query executor. Frames with
+        registered work are replaced rather than modified in place.
+        """
+        self.running_queries.update(dataset_keys)
+        try:
+            yield
+        finally:
+            self.running_queries.subtract(dataset_keys)
+            for dataset_key in dataset_keys:
+                if not self.running_queries[dataset_key]:
+                    del self.running_queries[dataset_key]
+
+
+def execute_query(qframe, q, accept_type, batch_rows):
+    """
+    Query execution and serialization of the result. May run in a thread separate from the IOLoop.
+    Results larger than batch_rows are not serialized here but in batches while being written.
+    """
+    result_frame = qframe.query(q)
+    if len(result_frame) > batch_rows:
+        return result_frame, None
+
+    if accept_type == CONTENT_TYPE_CSV:
+        return result_frame, result_frame.to_csv()
+
+    if accept_type == CONTENT_TYPE_COLUMNAR:
+        return result_frame, b''.join(result_frame.to_columnar())
+
+    return result_frame, result_frame.to_json(orient=json_orient(accept_type))
+
+
+def execute_queries(qframe, qs):
+    """
+    Execution of a batch of queries against one frame and JSON serialization of the results.
+    May run in a thread separate from the IOLoop.
+    """
+    results = []
+    for result in qframe.query_many(qs):
+        if isinstance(result, MalformedQueryException):
+            results.append(batch_error(ResponseCode.BAD_REQUEST, str(result)))
+        else:
+            results.append('{{"status": {status}, "unsliced_length": {length}, "result": {result}}}'.format(
+                status=ResponseCode.OK, length=result.unsliced_df_len, result=result.to_json()))
+
+    return results
+
+
+@contextmanager
+def column_types_checked():
+    try:
+        yield
+    except ColumnTypeException as e:
+        raise HTTPError(ResponseCode.BAD_REQUEST, str(e))
+
+
+def batch_error(status, message):
+    return json.dumps({'status': status, 'error': message})
 
 
 @http_auth
+@stream_request_body
 class DatasetHandler(RequestHandler):
-    def initialize(self, dataset_cache, state, stats):
+    def initialize(self, dataset_cache, result_cache, state, stats, executor, response_batch_rows, gc_scheduler,
+                   memory_governor, optimize_types, category_threshold, compact_strings):
         self.dataset_cache = dataset_cache
+        self.result_cache = result_cache
         self.state = state
+        self.gc_scheduler = gc_scheduler
+        self.memory_governor = memory_governor
+        self.gc_pending = 0
+        gc_scheduler.request_started()
         self.stats = stats
+        self.executor = executor
+        self.response_batch_rows = response_batch_rows
+        self.optimize_types = optimize_types
+        self.category_threshold = category_threshold
+        self.compact_strings = compact_strings
+        self.body_decoder = None
+        self.body_chunks = []
+        self.body_size = 0
+        self.csv_parser = None
+        self.stream_error = None
+        self.durations_until_eviction = []
+
+        # Decided by the admission policy the first time datasets must be evicted to store the upload
+        self.admitted = None
 
     def prepare(self):
         self.request_start = time.time()
+        if self.request.method == 'POST':
+            self.body_decoder = StreamDecoder(self.request.headers.get('Content-Encoding'))
+            dataset_key, optional_q = self.path_args
+            if not optional_q:
+                self.prepare_store(dataset_key)
+
+    def prepare_store(self, dataset_key):
+        self.store_start = time.time()
+        self.operation = 'store'
+        self.ensure_not_overloaded()
+        self.dataset_cache.record_access(dataset_key)
+        if dataset_key in self.dataset_cache:
+            self.stats.inc('replace_count')
+        self.dataset_cache.discard(dataset_key)
+
+        self.upload_type = self.content_type()
+        if self.upload_type == CONTENT_TYPE_CSV:
+            self.csv_parser = CSVStreamParser(column_types=self.dtypes())
+
+    def data_received(self, chunk):
+        if self.body_decoder is None or self.stream_error is not None:
+            return
+
+        try:
+            self.consume_body(self.body_decoder.decompress(chunk))
+        except Exception as e:
+            # Raised when the complete body has been received
+            self.stream_error = e
+
+    def consume_body(self, data):
+        self.body_size += len(data)
+        if self.csv_parser:
+            # Make room for the dataset while it's being received
+            self.make_room(self.body_size)
+            self.csv_parser.feed(data)
+        else:
+            self.body_chunks.append(data)
+
+    def ensure_not_overloaded(self):
+        """
+        Reject the request if the process uses too much memory to take on more work.
+        """
+        if self.memory_governor.overloaded():
+            self.stats.inc('rss_reject_count')
+            raise ServiceUnavailable(self.memory_governor.retry_after, 'Memory usage above hard limit')
+
+    def write_error(self, status_code, **kwargs):
+        _, error, _ = kwargs.get('exc_info', (None, None, None))
+        if isinstance(error, ServiceUnavailable):
+            self.set_header('Retry-After', error.retry_after)
+
+        super(DatasetHandler, self).write_error(status_code, **kwargs)
+
+    def make_room(self, byte_count):
+        """
+        Evict datasets to make room for byte_count bytes of the uploaded dataset unless the
+        admission policy rejects it. The decision holds for the rest of the upload.
+        """
+        # Expired datasets are evicted before any datasets that are still valid
+        expired_count = self.dataset_cache.evict_expired()
+        if expired_count:
+            self.stats.inc('age_evict_count', count=expired_count)
+
+        if self.admitted is None and not self.dataset_cache.has_room(byte_count):
+            self.admitted = self.dataset_cache.admit(self.path_args[0], byte_count)
+
+        if self.admitted is not False:
+            self.durations_until_eviction.extend(self.dataset_cache.ensure_free(byte_count))
+
+    def complete_body(self, writable=False):
+        """
+        :param writable: Return the body as a bytearray rather than a string.
+        """
+        if self.stream_error is None:
+            self.consume_body(self.body_decoder.flush())
+
+        if self.stream_error is not None:
+            raise self.stream_error
+
+        body, self.body_chunks = (bytearray() if writable else b'').join(self.body_chunks), []
+        return body
 
     def on_finish(self):
         if hasattr(self, 'operation'):
             self.stats.append('{}_request_durations'.format(self.operation), time.time() - self.request_start)
 
+        # Any garbage collection is done after the response has been sent
+        self.gc_scheduler.request_finished(self.gc_pending)
+
     def accept_type(self):
-        accept_types = [t.strip() for t in self.request.headers.get('Accept', CONTENT_TYPE_JSON).split(',')]
-        for t in accept_types:
-            if t in ACCEPTED_TYPES:
-                return t
+        """
+        The type of the response, the supported type preferred by the client. Types of equal
+        quality are preferred in the order listed.
+        """
+        accepted = []
+        for ix, value in enumerate(self.request.headers.get('Accept', CONTENT_TYPE_JSON).split(',')):
+            media_type, params = parse_media_type(value)
+            try:
+                quality = float(params.get('q', 1))
+            except ValueError:
+                quality = 0.0
+
+            if quality > 0:
+                accepted.append((-quality, ix, media_type, params))
+
+        for _, _, media_type, params in sorted(accepted):
+            if media_type == CONTENT_TYPE_JSON:
+                orient = params.get('orient', 'records')
+                if orient in JSON_ORIENTS:
+                    return json_content_type(orient)
+            elif media_type in ACCEPTED_TYPES:
+                return media_type
 
         raise HTTPError(ResponseCode.NOT_ACCEPTABLE)
 
     def content_type(self):
-        header = self.request.headers.get("Content-Type", CONTENT_TYPE_CSV).split(';')
-        content_type = header[0]
+        content_type, params = parse_media_type(self.request.headers.get("Content-Type", CONTENT_TYPE_CSV))
         if content_type not in ACCEPTED_TYPES:
             raise HTTPError(ResponseCode.UNSUPPORTED_MEDIA_TYPE,
                             "Content-Type '{content_type}' not supported".format(content_type=content_type))
 
-        if len(header) > 1:
-            m = CHARSET_REGEX.match(header[1].strip())
-            if m and m.group(1) != 'utf-8':
+        charset = params.get('charset', 'utf-8').lower()
+        if charset != 'utf-8':
+            raise HTTPError(ResponseCode.UNSUPPORTED_MEDIA_TYPE,
+                            "charset={charset} not supported, only utf-8".format(charset=charset))
+
+        if content_type == CONTENT_TYPE_JSON:
+            orient = params.get('orient', 'records')
+            if orient not in JSON_UPLOAD_ORIENTS:
                 raise HTTPError(ResponseCode.UNSUPPORTED_MEDIA_TYPE,
-                                "charset={charset} not supported, only utf-8".format(charset=m.group(1)))
+                                "orient={orient} not supported for uploads".format(orient=orient))
+
+            return json_content_type(orient)
 
         return content_type
 
@@ -154,53 +415,185 @@ class DatasetHandler(RequestHandler):
 
         dtypes = {}
         for column_name, type_name in types:
-            if type_name == 'string':
-                dtypes[column_name] = 'object'
-            elif type_name == 'enum':
-                dtypes[column_name] = 'category'
-            elif type_name == 'float':
-                dtypes[column_name] = 'float64'
-            else:
+            try:
+                dtypes[column_name] = parse_type_name(type_name)
+            except ColumnTypeException:
                 raise HTTPError(ResponseCode.BAD_REQUEST,
                                 'Unrecognized type name "{type_name}" for column "{column_name}"'.format(
                                     type_name=type_name, column_name=column_name))
 
         return dtypes
 
+    def indexes(self):
+        indexes = self.header_to_key_values('X-QCache-indexes')
+        if not indexes:
+            return None
+
+        index_kinds = {}
+        for key_value in indexes:
+            if len(key_value) != 2 or key_value[1] not in INDEX_KINDS:
+                raise HTTPError(ResponseCode.BAD_REQUEST,
+                                'Invalid index "{index}", the kind of index must be one of {kinds}'.format(
+                                    index='='.join(key_value), kinds=', '.join(INDEX_KINDS)))
+
+            index_kinds[key_value[0]] = key_value[1]
+
+        return index_kinds
+
+    def ttl(self):
+        ttl = self.request.headers.get('X-QCache-ttl', None)
+        if ttl is None:
+            return None
+
+        try:
+            ttl = float(ttl)
+        except ValueError:
+            ttl = -1
+
+        if ttl < 0:
+            raise HTTPError(ResponseCode.BAD_REQUEST, 'X-QCache-ttl must be a non negative number of seconds')
+
+        return ttl
+
     def stand_in_columns(self):
         return self.header_to_key_values('X-QCache-stand-in-columns')
 
-    def query(self, dataset_key, q):
-        t0 = time.time()
-        self.operation = 'query'
-        accept_type = self.accept_type()
+    def cached_qframe(self, dataset_key):
+        """
+        The cached frame for dataset_key or None if it's not in the cache. Every lookup is counted
+        as a hit or a miss.
+        """
+        self.dataset_cache.record_access(dataset_key)
         if dataset_key not in self.dataset_cache:
-            self.stats.inc('miss_count')
-            raise HTTPError(ResponseCode.NOT_FOUND)
+            restored = self.dataset_cache.restore(dataset_key)
+            if restored is None:
+                self.stats.inc('miss_count')
+                return None
+
+            source, durations_until_eviction = restored
+            self.stats.inc(source + '_restore_count')
+            self.stats.inc('size_evict_count', count=len(durations_until_eviction))
+            self.stats.extend('durations_until_eviction', durations_until_eviction)
 
         if self.dataset_cache.evict_if_too_old(dataset_key):
             self.stats.inc('miss_count')
             self.stats.inc('age_evict_count')
+            return None
+
+        self.stats.inc('hit_count')
+        return self.dataset_cache[dataset_key]
+
+    @gen.coroutine
+    def query(self, dataset_key, q, qframe=None, stored=False):
+        """
+        Query the cached dataset or, if given, qframe which is not looked up in the cache.
+
+        :param stored: qframe has been stored in the cache under dataset_key.
+        """
+        t0 = time.time()
+        self.operation = 'query'
+        accept_type = self.accept_type()
+        qf = qframe if qframe is not None else self.cached_qframe(dataset_key)
+        if qf is None:
             raise HTTPError(ResponseCode.NOT_FOUND)
 
-        qf = self.dataset_cache[dataset_key]
+        # Operations modifying the frame are always performed in the IOLoop thread. If queries are
+        # currently executing against the frame it is replaced rather than modified in place.
+        copy_on_write = self.state.running_queries[dataset_key] > 0
+        from_cache = qframe is None
+        cached = from_cache or stored
         try:
-            result_frame = qf.query(q, stand_in_columns=self.stand_in_columns())
+            if isinstance(q, dict) and 'update' in q:
+                qf.query(q, stand_in_columns=self.stand_in_columns(), copy_on_write=copy_on_write)
+                if cached:
+                    self.dataset_cache.modified(dataset_key)
+                self.write("")
+                return
+
+            if qf.add_stand_in_columns(self.stand_in_columns(), copy_on_write=copy_on_write) and cached:
+                self.dataset_cache.modified(dataset_key)
+
+            self.set_response_content_type(accept_type)
+            key = self.result_key(dataset_key, q, accept_type) if from_cache else None
+            cached_result = self.result_cache.get(key) if key else None
+            if cached_result is not None:
+                self.stats.inc('result_cache_hit_count')
+                self.set_header("X-QCache-unsliced-length", cached_result.unsliced_length)
+                self.write_cached_result(key, cached_result)
+            else:
+                if key:
+                    self.stats.inc('result_cache_miss_count')
+
+                self.ensure_not_overloaded()
+                with self.state.executing_queries(dataset_key):
+                    result_frame, body = yield self.executor.submit(
+                        execute_query, qf, q, accept_type, self.response_batch_rows)
+                    self.set_header("X-QCache-unsliced-length", result_frame.unsliced_df_len)
+                    if body is None:
+                        yield self.write_batches(result_frame, accept_type)
+                    elif key and self.is_current_version(dataset_key, key):
+                        self.write_cached_result(key, self.result_cache.put(key, result_frame.unsliced_df_len, body))
+                    else:
+                        self.write(body)
         except MalformedQueryException as e:
             self.write(json.dumps({'error': str(e)}))
             self.set_status(ResponseCode.BAD_REQUEST)
             return
+        except ColumnarFormatException as e:
+            raise HTTPError(ResponseCode.NOT_ACCEPTABLE, 'Result not representable in columnar format: {error}'.format(
+                error=e))
+
+        self.post_query_processing()
+        self.stats.append('query_durations', time.time() - t0)
 
-        self.set_header("Content-Type", "{content_type}; charset=utf-8".format(content_type=accept_type))
-        self.set_header("X-QCache-unsliced-length", result_frame.unsliced_df_len)
+    def set_response_content_type(self, accept_type):
+        if accept_type == CONTENT_TYPE_COLUMNAR:
+            # Binary, strings in the data are UTF-8 encoded
+            self.set_header("Content-Type", accept_type)
+        else:
+            self.set_header("Content-Type", "{content_type}; charset=utf-8".format(content_type=accept_type))
+
+    def result_key(self, dataset_key, q, accept_type):
+        if not self.result_cache.enabled:
+            return None
+
+        # Stand in columns are not part of the key, adding them to the frame changes the dataset version
+        return result_key(dataset_key, self.dataset_cache.version(dataset_key), q, accept_type)
+
+    def is_current_version(self, dataset_key, key):
+        # The dataset may have been modified, replaced or evicted while the query was executing
+        return dataset_key in self.dataset_cache and self.dataset_cache.version(dataset_key) == key[1]
+
+    def write_cached_result(self, key, cached_result):
+        # The encoded body is cached, bypassing compression of the response
+        encoding = preferred_encoding(accepted_encodings(self.request))
+        if encoding:
+            self.set_header("Content-Encoding", encoding)
+
+        self.write(self.result_cache.body(key, cached_result, encoding))
+
+    @gen.coroutine
+    def write_batches(self, result_frame, accept_type):
+        """
+        Serialize and write the result in batches, each batch is flushed before the next is serialized.
+        """
         if accept_type == CONTENT_TYPE_CSV:
-            self.write(result_frame.to_csv())
+            batches = result_frame.to_csv_batches(self.response_batch_rows)
+        elif accept_type == CONTENT_TYPE_COLUMNAR:
+            # The header refers to all column buffers so the result cannot be split by rows. The
+            # buffers are written one by one instead of being joined into one large string.
+            buffers = yield self.executor.submit(result_frame.to_columnar)
+            batches = iter(buffers)
         else:
-            self.write(result_frame.to_json())
+            batches = result_frame.to_json_batches(self.response_batch_rows, orient=json_orient(accept_type))
 
-        self.post_query_processing()
-        self.stats.inc('hit_count')
-        self.stats.append('query_durations', time.time() - t0)
+        while True:
+            batch = yield self.executor.submit(next, batches, None)
+            if batch is None:
+                break
+
+            self.write(batch)
+            yield self.flush()
 
     def q_json_to_dict(self, q_json):
         try:
@@ -219,50 +612,149 @@ class DatasetHandler(RequestHandler):
 
         q_dict = self.q_json_to_dict(self.get_argument('q', default=''))
         if q_dict is not None:
-            self.query(dataset_key, q_dict)
+            return self.query(dataset_key, q_dict)
+
+    def post_query_processing(self, query_count=1):
+        self.gc_pending += query_count
+
+    def uploaded_qframe(self, dataset):
+        if isinstance(dataset, basestring):
+            with column_types_checked():
+                return QFrame.from_csv(dataset.encode('utf-8'), column_types=self.dtypes(),
+                                       stand_in_columns=self.stand_in_columns())
+
+        if isinstance(dataset, list) and all(isinstance(r, dict) for r in dataset):
+            with column_types_checked():
+                return QFrame.from_dicts(utf8_records(dataset), column_types=self.dtypes(),
+                                         stand_in_columns=self.stand_in_columns())
 
-    def post_query_processing(self):
-        if self.state.query_count % 10 == 0:
-            # Run a collect every now and then. It reduces the process memory consumption
-            # considerably but always doing it will impact query performance negatively.
-            gc.collect()
+        if is_columns(dataset):
+            return self.columns_qframe(dataset)
 
-        self.state.query_count += 1
+        raise HTTPError(ResponseCode.BAD_REQUEST,
+                        'dataset must be a list of objects, an object of lists or a CSV string')
+
+    def columns_qframe(self, columns):
+        try:
+            return QFrame.from_columns(utf8_columns(columns), column_types=self.dtypes(),
+                                       stand_in_columns=self.stand_in_columns())
+        except (ColumnTypeException, ValueError) as e:
+            raise HTTPError(ResponseCode.BAD_REQUEST, 'Invalid columns: {error}'.format(error=e))
+
+    def upload_and_query(self, dataset_key, upload, upload_size):
+        """
+        Query a dataset uploaded in the same request. The query is executed against the uploaded
+        frame, not against the cache, so the result is returned even if the dataset is evicted
+        from the cache, or doesn't fit in it, before the query has been executed.
+        """
+        self.store_start = time.time()
+        self.ensure_not_overloaded()
+        store = upload.get('store', True)
+        if store:
+            self.dataset_cache.record_access(dataset_key)
+            if dataset_key in self.dataset_cache:
+                self.stats.inc('replace_count')
+            self.dataset_cache.discard(dataset_key)
+
+            # Datasets that can never fit in the cache are queried without being stored
+            store = upload_size / 2 <= self.dataset_cache.max_size
+            if store:
+                self.make_room(upload_size / 2)
+
+        qf = self.uploaded_qframe(upload['dataset'])
+        if store:
+            store = self.store_qframe(dataset_key, qf)
+
+        self.set_header("X-QCache-stored", 'true' if store else 'false')
+        return self.query(dataset_key, upload.get('query', {}), qframe=qf, stored=store)
+
+    def store_qframe(self, dataset_key, qf):
+        """
+        :return: True if qf was stored, False if it was rejected by the admission policy.
+        """
+        ttl = self.ttl()
+        index_kinds = self.indexes()
+        self.gc_pending += 1
+        if self.admitted is False:
+            self.stats.inc('admission_reject_count')
+            return False
+
+        if self.optimize_types:
+            # Columns with explicitly given types are stored as requested
+            optimized = qf.optimize_types(self.category_threshold, skip_columns=self.dtypes() or ())
+            if optimized:
+                self.set_header('X-QCache-optimized-types', '; '.join(
+                    '{name}={type}'.format(name=name, type=optimized[name])
+                    for name in qf.columns if name in optimized))
+
+        if self.compact_strings:
+            # String columns not already stored as categoricals
+            qf.compact_strings(skip_columns=self.dtypes() or ())
+
+        if index_kinds:
+            try:
+                qf.build_indexes(index_kinds)
+            except IndexException as e:
+                raise HTTPError(ResponseCode.BAD_REQUEST, 'Invalid index: {error}'.format(error=e))
+
+        self.dataset_cache.store(dataset_key, qf, ttl=ttl)
+        self.stats.inc('size_evict_count', count=len(self.durations_until_eviction))
+        self.stats.inc('store_count')
+        self.stats.append('store_row_counts', len(qf))
+        self.stats.append('store_durations', time.time() - self.store_start)
+        self.stats.extend('durations_until_eviction', self.durations_until_eviction)
+        return True
+
+    def received_qframe(self, input_data):
+        if self.upload_type == CONTENT_TYPE_CSV:
+            # The CSV has been parsed while it was received
+            return QFrame.from_csv_stream(self.csv_parser, stand_in_columns=self.stand_in_columns())
+
+        if self.upload_type == CONTENT_TYPE_COLUMNAR:
+            # The column buffers are used as they are, the size of the data is close to that of the frame
+            self.make_room(len(input_data))
+            try:
+                return QFrame.from_columnar(input_data, stand_in_columns=self.stand_in_columns())
+            except ColumnarFormatException as e:
+                raise HTTPError(ResponseCode.BAD_REQUEST, 'Invalid columnar data: {error}'.format(error=e))
+
+        if json_orient(self.upload_type) == 'columns':
+            # Whole columns are created at once without any intermediate dict per row
+            self.make_room(len(input_data) / 2)
+            try:
+                columns = json.loads(input_data, object_pairs_hook=OrderedDict)
+            except ValueError:
+                raise HTTPError(ResponseCode.BAD_REQUEST, 'Could not load JSON')
+
+            if not is_columns(columns):
+                raise HTTPError(ResponseCode.BAD_REQUEST, 'Must pass an object with a list of values per column')
+
+            return self.columns_qframe(columns)
+
+        # This is a waste of CPU cycles, first the JSON decoder decodes all strings
+        # from UTF-8 then we immediately encode them back into UTF-8. Couldn't
+        # find an easy solution to this though.
+        self.make_room(len(input_data) / 2)
+        data = json.loads(input_data, cls=UTF8JSONDecoder)
+        return QFrame.from_dicts(data, column_types=self.dtypes(), stand_in_columns=self.stand_in_columns())
 
     def post(self, dataset_key, optional_q):
         if optional_q:
-            q_dict = self.q_json_to_dict(decoded_body(self.request))
+            body = self.complete_body()
+            q_dict = self.q_json_to_dict(body)
+            if isinstance(q_dict, dict) and 'dataset' in q_dict:
+                return self.upload_and_query(dataset_key, q_dict, len(body))
             if q_dict is not None:
-                self.query(dataset_key, q_dict)
+                return self.query(dataset_key, q_dict)
             return
 
-        t0 = time.time()
-        self.operation = 'store'
-        if dataset_key in self.dataset_cache:
-            self.stats.inc('replace_count')
-            del self.dataset_cache[dataset_key]
-
-        content_type = self.content_type()
-        input_data = decoded_body(self.request)
-        if content_type == CONTENT_TYPE_CSV:
-            durations_until_eviction = self.dataset_cache.ensure_free(len(input_data))
-            qf = QFrame.from_csv(input_data, column_types=self.dtypes(),
-                                 stand_in_columns=self.stand_in_columns())
-        else:
-            # This is a waste of CPU cycles, first the JSON decoder decodes all strings
-            # from UTF-8 then we immediately encode them back into UTF-8. Couldn't
-            # find an easy solution to this though.
-            durations_until_eviction = self.dataset_cache.ensure_free(len(input_data) / 2)
-            data = json.loads(input_data, cls=UTF8JSONDecoder)
-            qf = QFrame.from_dicts(data, stand_in_columns=self.stand_in_columns())
-
-        self.dataset_cache[dataset_key] = qf
+        with column_types_checked():
+            # Numeric columns refer to the buffers of writable columnar data rather than copies of them
+            qf = self.received_qframe(self.complete_body(writable=self.upload_type == CONTENT_TYPE_COLUMNAR))
+
+        stored = self.store_qframe(dataset_key, qf)
+        self.set_header("X-QCache-stored", 'true' if stored else 'false')
         self.set_status(ResponseCode.CREATED)
-        self.stats.inc('size_evict_count', count=len(durations_until_eviction))
-        self.stats.inc('store_count')
-        self.stats.append('store_row_counts', len(qf))
-        self.stats.append('store_durations', time.time() - t0)
-        self.stats.extend('durations_until_eviction', durations_until_eviction)
         self.write("")
 
     def delete(self, dataset_key, optional_q):
@@ -270,12 +762,97 @@ class DatasetHandler(RequestHandler):
             # There should not be a q parameter for the delete method
             raise HTTPError(ResponseCode.NOT_FOUND)
 
-        if dataset_key in self.dataset_cache:
-            del self.dataset_cache[dataset_key]
-
+        self.dataset_cache.discard(dataset_key)
         self.write("")
 
 
+class BatchQueryHandler(DatasetHandler):
+    """
+    Executes a list of queries in one request and responds with a JSON list holding one
+    result per query in the same order as the queries.
+
+    /dataset/<key>/qs takes a list of queries against one dataset, /qs takes a list of
+    {"dataset": <key>, "query": <query>} objects. Queries against the same dataset share
+    the filtering of the dataset when their from and where clauses are equal.
+    """
+    SUPPORTED_METHODS = ('POST',)
+
+    def prepare(self):
+        self.request_start = time.time()
+        self.operation = 'batch_query'
+        self.body_decoder = StreamDecoder(self.request.headers.get('Content-Encoding'))
+
+    def batch_body(self):
+        try:
+            batch = json.loads(self.complete_body())
+        except ValueError:
+            raise HTTPError(ResponseCode.BAD_REQUEST, 'Could not load JSON')
+
+        if not isinstance(batch, list):
+            raise HTTPError(ResponseCode.BAD_REQUEST, 'A list of queries is required')
+
+        return batch
+
+    def post(self, dataset_key=None):
+        self.ensure_not_overloaded()
+        batch = self.batch_body()
+        if dataset_key is not None:
+            return self.batch_query([(dataset_key, q) for q in batch], missing_code=ResponseCode.NOT_FOUND)
+
+        if not all(isinstance(item, dict) and isinstance(item.get('dataset'), basestring) for item in batch):
+            raise HTTPError(ResponseCode.BAD_REQUEST, 'Each item must be an object with dataset and query')
+
+        return self.batch_query([(item['dataset'], item.get('query', {})) for item in batch])
+
+    @gen.coroutine
+    def batch_query(self, keyed_queries, missing_code=None):
+        """
+        Execute (dataset key, query) pairs. If missing_code is set a missing dataset fails the
+        complete request with that code, otherwise only the queries against the missing dataset fail.
+        """
+        t0 = time.time()
+        if self.accept_type() != CONTENT_TYPE_JSON:
+            raise HTTPError(ResponseCode.NOT_ACCEPTABLE)
+
+        # Group the queries per dataset, remembering their position in the response
+        query_positions = {}
+        for position, (dataset_key, q) in enumerate(keyed_queries):
+            query_positions.setdefault(dataset_key, []).append((position, q))
+
+        results = [None] * len(keyed_queries)
+        frames = {}
+        for dataset_key, positioned_qs in query_positions.items():
+            qf = self.cached_qframe(dataset_key)
+            if qf is None:
+                if missing_code is not None:
+                    raise HTTPError(missing_code)
+
+                for position, _ in positioned_qs:
+                    results[position] = batch_error(ResponseCode.NOT_FOUND, 'Dataset not found')
+                continue
+
+            if qf.add_stand_in_columns(self.stand_in_columns(),
+                                       copy_on_write=self.state.running_queries[dataset_key] > 0):
+                self.dataset_cache.modified(dataset_key)
+
+            frames[dataset_key] = qf
+
+        with self.state.executing_queries(*frames.keys()):
+            dataset_results = yield {dataset_key: self.executor.submit(
+                execute_queries, qf, [q for _, q in query_positions[dataset_key]])
+                                     for dataset_key, qf in frames.items()}
+
+        for dataset_key, serialized_results in dataset_results.items():
+            for (position, _), result in zip(query_positions[dataset_key], serialized_results):
+                results[position] = result
+
+        self.set_header("Content-Type", "{content_type}; charset=utf-8".format(content_type=CONTENT_TYPE_JSON))
+        self.write('[' + ','.join(results) + ']')
+
+        self.post_query_processing(query_count=len(keyed_queries))
+        self.stats.append('batch_query_durations', time.time() - t0)
+
+
 @http_auth
 class StatusHandler(RequestHandler):
     def get(self):
@@ -284,40 +861,111 @@ class StatusHandler(RequestHandler):
 
 @http_auth
 class StatisticsHandler(RequestHandler):
-    def initialize(self, dataset_cache, stats):
+    def initialize(self, dataset_cache, result_cache, stats, memory_governor):
         self.dataset_cache = dataset_cache
+        self.result_cache = result_cache
         self.stats = stats
+        self.memory_governor = memory_governor
 
     def get(self):
         self.set_header("Content-Type", "application/json; charset=utf-8")
         stats = self.stats.snapshot()
         stats['dataset_count'] = len(self.dataset_cache)
         stats['cache_size'] = self.dataset_cache.size
+        if self.dataset_cache.overhead:
+            stats['memory_overhead'] = self.dataset_cache.overhead
+
+        if self.memory_governor.enabled:
+            stats['rss'] = self.memory_governor.rss_fn()
+
+        if self.dataset_cache.spill is not None:
+            stats['spill_dataset_count'] = len(self.dataset_cache.spill)
+            stats['spill_size'] = self.dataset_cache.spill.size
+
+        if self.dataset_cache.snapshot is not None:
+            stats['snapshot_pending_count'] = len(self.dataset_cache.snapshot)
+
+        add_hit_ratio(stats, self.dataset_cache.eviction_policy)
+        if self.result_cache.enabled:
+            stats['result_cache_size'] = self.result_cache.size
         self.write(json.dumps(stats))
 
 
 def make_app(url_prefix='/qcache', debug=False, max_cache_size=1000000000, max_age=0,
-             statistics_buffer_size=1000, basic_auth=None):
-    if basic_auth:
-        global auth_user, auth_password
-        auth_user, auth_password = basic_auth.split(':', 2)
-
+             statistics_buffer_size=1000, basic_auth=None, query_threads=0, response_batch_rows=50000,
+             result_cache_size=0, gc_mode='full', eviction_policy='lru', admission='none', sliding_age=False,
+             reconcile_interval=0, rss_soft_limit=0, rss_hard_limit=0, spill_dir=None, spill_size=0,
+             snapshot_dir=None, snapshot_interval=0, optimize_types=False, category_threshold=0.5,
+             compact_strings=False, auto_index_scans=0, auto_index_size=100000000, auto_index_age=600):
+    configure_auth(basic_auth)
     stats = Statistics(buffer_size=statistics_buffer_size)
-    cache = DatasetCache(max_size=max_cache_size, max_age=max_age)
+
+    # Force a garbage collection if the process has grown by more than a tenth of the cache size
+    gc_scheduler = GCScheduler(stats, mode=gc_mode, max_rss_growth=max_cache_size // 10)
+    result_cache = ResultCache(max_size=result_cache_size)
+    cache = DatasetCache(max_size=max_cache_size, max_age=max_age, on_invalidate=result_cache.invalidate,
+                         eviction_policy=eviction_policy, admission=admission, sliding_age=sliding_age,
+                         spill_dir=spill_dir, spill_size=spill_size, snapshot_dir=snapshot_dir)
+    ExpirySweeper(cache, stats).start()
+    if reconcile_interval:
+        MemoryReconciler(cache, stats, interval=reconcile_interval).start()
+
+    memory_governor = MemoryGovernor(cache, stats, soft_limit=rss_soft_limit, hard_limit=rss_hard_limit)
+    memory_governor.start()
+
+    snapshot_writer = None
+    if snapshot_dir:
+        snapshot_writer = SnapshotWriter(cache, stats, interval=snapshot_interval)
+        snapshot_writer.start()
+
+    # Without query threads queries are executed directly in the IOLoop thread
+    executor = ThreadPoolExecutor(max_workers=query_threads) if query_threads else dummy_executor
+    state = AppState()
+    if auto_index_scans:
+        AutoIndexer(cache, stats, executor, state, gc_scheduler, min_scans=auto_index_scans,
+                    max_size=auto_index_size, max_age=auto_index_age).start()
+
+    handler_args = dict(dataset_cache=cache, result_cache=result_cache, state=state, stats=stats,
+                        executor=executor, response_batch_rows=response_batch_rows, gc_scheduler=gc_scheduler,
+                        memory_governor=memory_governor, optimize_types=optimize_types,
+                        category_threshold=category_threshold, compact_strings=compact_strings)
     return Application([
+                           url(r"{url_prefix}/dataset/([A-Za-z0-9\-_]+)/qs".format(url_prefix=url_prefix),
+                               BatchQueryHandler,
+                               handler_args,
+                               name="dataset_batch_query"),
                            url(r"{url_prefix}/dataset/([A-Za-z0-9\-_]+)/?(q)?".format(url_prefix=url_prefix),
                                DatasetHandler,
-                               dict(dataset_cache=cache, state=AppState(), stats=stats),
+                               handler_args,
                                name="dataset"),
+                           url(r"{url_prefix}/qs".format(url_prefix=url_prefix),
+                               BatchQueryHandler,
+                               handler_args,
+                               name="batch_query"),
                            url(r"{url_prefix}/status".format(url_prefix=url_prefix),
                                StatusHandler,
                                dict(),
                                name="status"),
                            url(r"{url_prefix}/statistics".format(url_prefix=url_prefix),
                                StatisticsHandler,
-                               dict(dataset_cache=cache, stats=stats),
+                               dict(dataset_cache=cache, result_cache=result_cache, stats=stats,
+                                    memory_governor=memory_governor),
                                name="statistics")
-                       ], debug=debug, transforms=[CompressedContentEncoding])
+                       ], debug=debug, transforms=[CompressedContentEncoding], snapshot_writer=snapshot_writer)
+
+
+def serve(app):
+    """
+    Run the IOLoop serving app until the process receives SIGTERM. A snapshot of the cache is
+    saved before returning if snapshots are enabled.
+    """
+    io_loop = IOLoop.current()
+    signal.signal(signal.SIGTERM, lambda *_: io_loop.add_callback_from_signal(io_loop.stop))
+    io_loop.start()
+
+    snapshot_writer = app.settings.get('snapshot_writer')
+    if snapshot_writer:
+        snapshot_writer.save()
 
 
 def ssl_options(certfile, cafile=None):
@@ -335,24 +983,47 @@ def ssl_options(certfile, cafile=None):
 
 
 def run(port=8888, max_cache_size=1000000000, max_age=0, statistics_buffer_size=1000,
-        debug=False, certfile=None, cafile=None, basic_auth=None):
+        debug=False, certfile=None, cafile=None, basic_auth=None, query_threads=0, response_batch_rows=50000,
+        result_cache_size=0, gc_mode='full', eviction_policy='lru', admission='none', sliding_age=False,
+        reconcile_interval=0, rss_soft_limit=0, rss_hard_limit=0, spill_dir=None, spill_size=0,
+        snapshot_dir=None, snapshot_interval=0, optimize_types=False, category_threshold=0.5,
+        compact_strings=False, auto_index_scans=0, auto_index_size=100000000, auto_index_age=600):
     if basic_auth and not certfile:
         print "TLS must be enabled to use basic auth!"
         return
 
     print("Starting on port {port}, max cache size {max_cache_size} bytes, max age {max_age} seconds,"
-          " statistics_buffer_size {statistics_buffer_size}, debug={debug},".format(
+          " statistics_buffer_size {statistics_buffer_size}, query_threads {query_threads},"
+          " result_cache_size {result_cache_size}, gc_mode {gc_mode}, eviction_policy {eviction_policy},"
+          " admission {admission}, sliding_age {sliding_age}, reconcile_interval {reconcile_interval},"
+          " rss_soft_limit {rss_soft_limit}, rss_hard_limit {rss_hard_limit}, spill_dir {spill_dir},"
+          " spill_size {spill_size}, snapshot_dir {snapshot_dir}, snapshot_interval {snapshot_interval},"
+          " optimize_types {optimize_types}, category_threshold {category_threshold},"
+          " compact_strings {compact_strings}, auto_index_scans {auto_index_scans},"
+          " auto_index_size {auto_index_size}, auto_index_age {auto_index_age}, debug={debug},".format(
         port=port, max_cache_size=max_cache_size, max_age=max_age,
-        statistics_buffer_size=statistics_buffer_size, debug=debug))
+        statistics_buffer_size=statistics_buffer_size, query_threads=query_threads,
+        result_cache_size=result_cache_size, gc_mode=gc_mode, eviction_policy=eviction_policy,
+        admission=admission, sliding_age=sliding_age, reconcile_interval=reconcile_interval,
+        rss_soft_limit=rss_soft_limit, rss_hard_limit=rss_hard_limit, spill_dir=spill_dir, spill_size=spill_size,
+        snapshot_dir=snapshot_dir, snapshot_interval=snapshot_interval, optimize_types=optimize_types,
+        category_threshold=category_threshold, compact_strings=compact_strings, auto_index_scans=auto_index_scans,
+        auto_index_size=auto_index_size, auto_index_age=auto_index_age, debug=debug))
 
     app = make_app(
         debug=debug, max_cache_size=max_cache_size, max_age=max_age,
-        statistics_buffer_size=statistics_buffer_size, basic_auth=basic_auth)
+        statistics_buffer_size=statistics_buffer_size, basic_auth=basic_auth, query_threads=query_threads,
+        response_batch_rows=response_batch_rows, result_cache_size=result_cache_size, gc_mode=gc_mode,
+        eviction_policy=eviction_policy, admission=admission, sliding_age=sliding_age,
+        reconcile_interval=reconcile_interval, rss_soft_limit=rss_soft_limit, rss_hard_limit=rss_hard_limit,
+        spill_dir=spill_dir, spill_size=spill_size, snapshot_dir=snapshot_dir, snapshot_interval=snapshot_interval,
+        optimize_types=optimize_types, category_threshold=category_threshold, compact_strings=compact_strings,
+        auto_index_scans=auto_index_scans, auto_index_size=auto_index_size, auto_index_age=auto_index_age)
 
     args = {}
     args.update(ssl_options(certfile=certfile, cafile=cafile))
     app.listen(port, max_buffer_size=max_cache_size, **args)
-    IOLoop.current().start()
+    serve(app)
 
 
 if __name__ == "__main__":
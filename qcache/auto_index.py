@@ -0,0 +1,148 @@
+"""
+Automatic indexing of columns that are repeatedly scanned by queries.
+
+Filters and ordering that an index could have served are counted per dataset and column while the
+queries execute, see qcache.qframe.indexes.IndexUsage. When the server is idle an index is built for
+the column scanned the most times, given that it has been scanned at least a number of times. Indexes
+are built one at the time in the query executor. The memory used by automatically built indexes is
+kept within a budget and indexes that have not been used for a while are dropped again.
+"""
+import time
+
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
+from tornado.log import app_log
+
+from qcache.qframe import IndexException
+
+
+def estimated_index_size(row_count):
+    # The row positions, values referenced by hash indexes come in addition to that
+    return 4 * row_count
+
+
+class AutoIndexer(object):
+    def __init__(self, dataset_cache, stats, executor, state, gc_scheduler, min_scans, max_size, max_age=600.0,
+                 min_rows=10000, interval=1.0, idle_delay=0.1):
+        """
+        :param executor: The executor that indexes are built in.
+        :param state: The qcache.app.AppState that builds are registered in as running queries.
+        :param gc_scheduler: Tracks the time of the last request, see qcache.gc_scheduler.
+        :param min_scans: Number of scans of a column before it's indexed.
+        :param max_size: Max number of bytes used by all automatically built indexes.
+        :param max_age: Seconds since an automatically built index was last used before it's dropped.
+        :param min_rows: Min number of rows of datasets that are indexed, scanning small datasets is cheap.
+        :param interval: Seconds between checks for columns to index and indexes to drop.
+        :param idle_delay: Seconds without requests before the server is considered idle.
+        """
+        self.dataset_cache = dataset_cache
+        self.stats = stats
+        self.executor = executor
+        self.state = state
+        self.gc_scheduler = gc_scheduler
+        self.min_scans = min_scans
+        self.max_size = max_size
+        self.max_age = max_age
+        self.min_rows = min_rows
+        self.idle_delay = idle_delay
+        self.building = False
+        self._callback = PeriodicCallback(self.check, interval * 1000)
+
+    def start(self):
+        self._callback.start()
+
+    def stop(self):
+        self._callback.stop()
+
+    def size(self):
+        """
+        Number of bytes used by the automatically built indexes of all datasets in memory.
+        """
+        return sum(item.qframe.indexes[name].nbytes for _, item in self.dataset_cache.items()
+                   for name in item.qframe.index_usage.automatic if name in item.qframe.indexes)
+
+    def check(self):
+        if self.building or time.time() - self.gc_scheduler.last_activity < self.idle_delay:
+            return
+
+        self.drop_cold()
+        candidate = self.candidate()
+        if candidate is not None:
+            self.build(*candidate)
+
+    def drop_cold(self):
+        drop_count = 0
+        for key, item in self.dataset_cache.items():
+            usage = item.qframe.index_usage
+            cold = [name for name in usage.automatic if usage.is_cold(name, self.max_age)]
+            for name in cold:
+                item.qframe.drop_automatic_index(name)
+
+            if cold:
+                self.dataset_cache.resized(key)
+                drop_count += len(cold)
+
+        if drop_count:
+            self.stats.inc('auto_index_drop_count', count=drop_count)
+
+    def candidate(self):
+        """
+        :return: (dataset key, CacheItem, column name, kind) of the column most in need of an index,
+                 None if no column needs one.
+        """
+        free = self.max_size - self.size()
+        best = None
+        for key, item in self.dataset_cache.items():
+            qframe = item.qframe
+            row_count = len(qframe.df)
+            if row_count < self.min_rows or estimated_index_size(row_count) > free or \
+                    not self.dataset_cache.has_room(estimated_index_size(row_count)):
+                continue
+
+            for scan_count, name, kind in qframe.index_usage.candidates(self.min_scans):
+                index = qframe.indexes.get(name)
+                if index is not None and (index.serves(kind) or name not in qframe.index_usage.automatic):
+                    # Scans that the index could not serve, or an index declared by the client
+                    continue
+
+                if best is None or scan_count > best[0]:
+                    best = scan_count, key, item, name, kind
+
+                # The most scanned column of the dataset that may be indexed
+                break
+
+        return best[1:] if best is not None else None
+
+    @gen.coroutine
+    def build(self, key, item, name, kind):
+        qframe, version = item.qframe, item.version
+        t0 = time.time()
+        self.building = True
+        try:
+            # Updates and stand in columns replace the frame rather than modify it while it's being read
+            with self.state.executing_queries(key):
+                index = yield self.executor.submit(qframe.index_column, name, kind)
+        except IndexException:
+            qframe.index_usage.exclude(name, kind)
+            return
+        except Exception:
+            # Possibly temporary, the column may be indexed once it has been scanned again
+            app_log.exception('Failed to build %s index of column %r in dataset %r', kind, name, key)
+            qframe.index_usage.forget(name)
+            return
+        finally:
+            self.building = False
+
+        if key not in self.dataset_cache or self.dataset_cache.version(key) != version:
+            # Modified, replaced or evicted while the index was built
+            return
+
+        if index.nbytes > self.max_size - self.size() or not self.dataset_cache.has_room(index.nbytes):
+            # May fit later, once other indexes or datasets are gone and the column has been scanned again
+            qframe.index_usage.forget(name)
+            return
+
+        qframe.add_automatic_index(name, index)
+        self.dataset_cache.resized(key)
+        self.stats.inc('auto_index_build_count')
+        self.stats.append('auto_index_build_durations', time.time() - t0)
@@ -1,7 +1,9 @@
 import gzip
+import zlib
 from io import BytesIO
 
 import lz4.block
+import lz4.frame
 from tornado.web import OutputTransform, HTTPError
 
 
@@ -23,48 +25,144 @@ def gzip_loads(string):
 
 ENCODINGS = {
     'lz4': (lz4.block.decompress, lz4.block.compress),
+    'lz4-frame': (lz4.frame.decompress, lz4.frame.compress),
     'gzip': (gzip_loads, gzip_dumps),
     None: (lambda c: c, lambda c: c)
 }
 
 
-def decoded_body(request):
-    encoding = request.headers.get('Content-Encoding')
+def assert_known_encoding(encoding):
     if encoding not in ENCODINGS:
         raise HTTPError(400,
                         'Unrecognized encoding "{encoding}"'.format(encoding=encoding))
 
+
+def decoded_body(request):
+    encoding = request.headers.get('Content-Encoding')
+    assert_known_encoding(encoding)
     return ENCODINGS[encoding][0](request.body)
 
 
+class StreamDecoder(object):
+    """
+    Incremental decoding of a request body that arrives in chunks. gzip and lz4 frames
+    are decoded as the data arrives. lz4 blocks cannot be decoded before the complete block
+    has been received, the compressed data is buffered and decoded at the end.
+    """
+    def __init__(self, encoding):
+        assert_known_encoding(encoding)
+        self.encoding = encoding
+        self._lz4_chunks = []
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'lz4-frame':
+            self._decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, chunk):
+        if self.encoding is None:
+            return chunk
+
+        if self.encoding == 'lz4':
+            self._lz4_chunks.append(chunk)
+            return b''
+
+        return self._decompressor.decompress(chunk)
+
+    def flush(self):
+        if self.encoding == 'lz4':
+            return lz4.block.decompress(b''.join(self._lz4_chunks))
+
+        if self.encoding == 'gzip':
+            return self._decompressor.flush()
+
+        return b''
+
+
+class GzipStreamCompressor(object):
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk):
+        return self._compressor.compress(chunk)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class LZ4FrameStreamCompressor(object):
+    def __init__(self):
+        self._compressor = lz4.frame.LZ4FrameCompressor()
+        self._started = False
+
+    def compress(self, chunk):
+        if not self._started:
+            self._started = True
+            return self._compressor.begin() + self._compressor.compress(chunk)
+
+        return self._compressor.compress(chunk)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+STREAM_COMPRESSORS = {
+    'lz4-frame': LZ4FrameStreamCompressor,
+    'gzip': GzipStreamCompressor,
+}
+
+
+def accepted_encodings(request):
+    accept_coding = request.headers.get("Accept-Encoding", "")
+    return {e.split(';')[0].strip() for e in accept_coding.split(',')}
+
+
+def preferred_encoding(accepted):
+    return next((e for e in ('lz4', 'lz4-frame', 'gzip') if e in accepted), None)
+
+
 class CompressedContentEncoding(OutputTransform):
     """Applies compression to response. Prefers lz4 if accepted else uses gzip.
+
+    Responses written in multiple chunks are compressed as a stream. lz4 blocks cannot
+    be streamed, the lz4 frame format or gzip is used for such responses instead
+    depending on what the client accepts.
+
+    Responses that already have a Content-Encoding are left as they are.
     """
     def __init__(self, request):
-        accept_coding = request.headers.get("Accept-Encoding", "")
-        if 'lz4' in accept_coding:
-            self.encoding = 'lz4'
-        elif 'gzip' in accept_coding:
-            self.encoding = 'gzip'
-        else:
-            self.encoding = None
-
+        self.accepted = accepted_encodings(request)
+        self.encoding = preferred_encoding(self.accepted)
+        self.stream_compressor = None
         super(CompressedContentEncoding, self).__init__(request)
 
     def transform_first_chunk(self, status_code, headers, chunk, finishing):
-        if status_code != 200:
+        if status_code != 200 or 'Content-Encoding' in headers:
             # Only compress responses containing query data
             self.encoding = None
 
         if self.encoding:
-            if not finishing:
-                raise Exception("Multi chunk not accepted by QCache when applying compression")
+            if finishing:
+                chunk = ENCODINGS[self.encoding][1](chunk)
+                headers['Content-Length'] = str(len(chunk))
+            else:
+                if self.encoding not in STREAM_COMPRESSORS:
+                    self.encoding = next((e for e in ('lz4-frame', 'gzip') if e in self.accepted), None)
+                    if not self.encoding:
+                        return status_code, headers, chunk
+
+                self.stream_compressor = STREAM_COMPRESSORS[self.encoding]()
+                chunk = self.stream_compressor.compress(chunk)
+                if 'Content-Length' in headers:
+                    del headers['Content-Length']
 
-            chunk = ENCODINGS[self.encoding][1](chunk)
             headers['Content-Encoding'] = self.encoding
-            headers['Content-Length'] = str(len(chunk))
 
         return status_code, headers, chunk
 
     def transform_chunk(self, chunk, finishing):
+        if self.stream_compressor:
+            chunk = self.stream_compressor.compress(chunk)
+            if finishing:
+                chunk += self.stream_compressor.flush()
+
         return chunk
@@ -1,15 +1,42 @@
+import heapq
+from itertools import count
 from time import time
 
+from qcache.admission import make_admission
+from qcache.eviction import make_policy
+from qcache.snapshot import Snapshot
+from qcache.spill import SpillCache
+
+_versions = count()
+_expiry_order = count()
+
 
 class CacheItem(object):
-    def __init__(self, qframe):
+    def __init__(self, qframe, ttl=0):
         self.creation_time = time()
         self.last_access_time = self.creation_time
         self._qframe = qframe
         self.access_count = 0
 
+        # Seconds until the item expires, 0 = never
+        self.ttl = ttl
+
+        # Unique among all items, changed when the dataset is modified
+        self.version = next(_versions)
+        self.size = 0
+        self.update_size()
+
+    def update_size(self):
+        """
+        Estimate the size of the item, called again when the dataset has been modified.
+
+        :return: The change of the size in bytes
+        """
+        previous_size = self.size
+
         # 100 bytes is just a very rough estimate of the object overhead of this instance
-        self.size = 100 + qframe.byte_size()
+        self.size = 100 + self._qframe.byte_size()
+        return self.size - previous_size
 
     @property
     def dataset(self):
@@ -17,16 +44,56 @@ class CacheItem(object):
         self.access_count += 1
         return self._qframe
 
+    @property
+    def qframe(self):
+        # Without counting as an access
+        return self._qframe
+
 
 class DatasetCache(object):
-    def __init__(self, max_size, max_age):
+    def __init__(self, max_size, max_age, on_invalidate=None, eviction_policy='lru', admission='none',
+                 sliding_age=False, spill_dir=None, spill_size=0, snapshot_dir=None):
+        """
+        :param max_age: Default time to live of datasets in seconds, 0 = never expire.
+        :param on_invalidate: Called with the key of datasets that are replaced, deleted, evicted or modified.
+        :param eviction_policy: Name of the policy selecting datasets to evict, see qcache.eviction.
+        :param admission: Name of the policy deciding if new datasets may evict others, see qcache.admission.
+        :param sliding_age: Count the age of datasets from the last access rather than from when they were stored.
+        :param spill_dir: Directory of the disk tier that datasets evicted to make room for others are
+                          written to, see qcache.spill. Requires spill_size.
+        :param spill_size: Max size of the disk tier in bytes, 0 = no disk tier.
+        :param snapshot_dir: Directory of snapshots of the cache, see qcache.snapshot. Datasets in an
+                             existing snapshot are loaded when first accessed.
+        """
         self.max_size = max_size
         self.max_age = max_age
+        self.sliding_age = sliding_age
+        self.on_invalidate = on_invalidate
+        self.eviction_policy = eviction_policy
+        self._policy = make_policy(eviction_policy, max_size)
+        self._admission = make_admission(admission)
+        self.spill = SpillCache(spill_dir, spill_size) if spill_dir and spill_size else None
+        self.snapshot = Snapshot(snapshot_dir) if snapshot_dir else None
         self._cache_dict = {}
         self.size = 0.0
 
+        # Memory used by the process in addition to the estimated size of the datasets, bytes.
+        # Maintained by qcache.memory.MemoryReconciler.
+        self.overhead = 0
+
+        # Heap of (expiry time, insertion order, key, item). Entries for items that are no longer
+        # cached are stale, entries for items accessed since with sliding age are postponed when popped.
+        self._expiry_heap = []
+
+    def expiry_time(self, item):
+        if not item.ttl:
+            return None
+
+        return (item.last_access_time if self.sliding_age else item.creation_time) + item.ttl
+
     def has_expired(self, item):
-        return self.max_age and time() > item.creation_time + self.max_age
+        expiry_time = self.expiry_time(item)
+        return expiry_time is not None and time() > expiry_time
 
     def evict_if_too_old(self, key):
         if self.has_expired(self._cache_dict[key]):
@@ -39,24 +106,183 @@ class DatasetCache(object):
         return key in self._cache_dict
 
     def __getitem__(self, item):
-        return self._cache_dict[item].dataset
+        cache_item = self._cache_dict[item]
+        dataset = cache_item.dataset
+        self._policy.accessed(item, cache_item)
+        return dataset
 
     def __setitem__(self, key, qframe):
+        self.store(key, qframe)
+
+    def store(self, key, qframe, ttl=None):
+        """
+        :param ttl: Time to live of the dataset in seconds, 0 = never expire. Defaults to max_age.
+        """
         current_size = 0.0
         if key in self._cache_dict:
-            current_size = self._cache_dict[key].size
+            current_size = self._cache_dict.pop(key).size
+            self._policy.removed(key)
+            self._invalidated(key)
 
-        new_item = CacheItem(qframe)
+        self._discard_stored(key)
+        new_item = CacheItem(qframe, ttl=self.max_age if ttl is None else ttl)
         self.size += new_item.size - current_size
         self._cache_dict[key] = new_item
+        self._policy.inserted(key, new_item)
+        if new_item.ttl:
+            self._push_expiry(key, new_item)
+
+    def _push_expiry(self, key, item):
+        heapq.heappush(self._expiry_heap, (self.expiry_time(item), next(_expiry_order), key, item))
+        if len(self._expiry_heap) > 2 * len(self._cache_dict) + 100:
+            self._expiry_heap = [entry for entry in self._expiry_heap if self._cache_dict.get(entry[2]) is entry[3]]
+            heapq.heapify(self._expiry_heap)
+
+    def evict_expired(self, time_budget=None):
+        """
+        Evict expired datasets, oldest first.
+
+        :param time_budget: Max number of seconds to spend, None = until all expired datasets are evicted.
+        :return: The number of evicted datasets.
+        """
+        now = time()
+        deadline = now + time_budget if time_budget is not None else None
+        evicted_count = 0
+        while self._expiry_heap and self._expiry_heap[0][0] < now:
+            if deadline is not None and time() > deadline:
+                break
+
+            _, _, key, item = heapq.heappop(self._expiry_heap)
+            if self._cache_dict.get(key) is not item:
+                continue
+
+            if self.has_expired(item):
+                del self[key]
+                evicted_count += 1
+            else:
+                # Accessed since the entry was pushed
+                self._push_expiry(key, item)
+
+        return evicted_count
 
     def __delitem__(self, key):
         self.size -= self._cache_dict[key].size
         del self._cache_dict[key]
+        self._policy.removed(key)
+        self._invalidated(key)
+
+    def discard(self, key):
+        """
+        Remove key from the cache, including the disk tier, if present.
+        """
+        if key in self._cache_dict:
+            del self[key]
+
+        self._discard_stored(key)
+
+    def _discard_stored(self, key):
+        # Copies of the dataset on disk that would otherwise be restored
+        for tier in (self.snapshot, self.spill):
+            if tier is not None:
+                tier.discard(key)
+
+    def restore(self, key):
+        """
+        Move the dataset stored under key from the snapshot or the disk tier back into memory.
+
+        :return: None if there was no dataset to restore, otherwise a tuple (source, durations) where
+                 source is 'snapshot' or 'spill' and durations is a list of durations that the datasets
+                 evicted to make room for it spent in the cache.
+        """
+        for source, tier in (('snapshot', self.snapshot), ('spill', self.spill)):
+            restored = tier.pop(key) if tier is not None else None
+            if restored is not None:
+                break
+        else:
+            return None
+
+        qframe, expiry_time = restored
+        byte_count = 100 + qframe.byte_size()
+        if byte_count > self.max_size:
+            return None
+
+        durations_until_eviction = self.ensure_free(byte_count)
+        # The remaining time to live, a ttl of 0 would mean that the dataset never expires
+        ttl = max(expiry_time - time(), 0.001) if expiry_time is not None else 0
+        self.store(key, qframe, ttl=ttl)
+        if source == 'snapshot':
+            self.snapshot.restored(key, self.version(key))
+
+        return source, durations_until_eviction
+
+    def _invalidated(self, key):
+        if self.on_invalidate:
+            self.on_invalidate(key)
+
+    def version(self, key):
+        return self._cache_dict[key].version
+
+    def modified(self, key):
+        """
+        Signal that the dataset has been modified in place.
+        """
+        item = self._cache_dict[key]
+        item.version = next(_versions)
+        self.resized(key)
+        self._invalidated(key)
+
+    def resized(self, key):
+        """
+        Signal that the size of the dataset has changed without changing the data, for example
+        when an index has been added.
+        """
+        item = self._cache_dict[key]
+        size_change = item.update_size()
+        if size_change:
+            self.size += size_change
+            self._policy.resized(key, item)
+
+    def record_access(self, key):
+        """
+        Record a lookup or store of key, whether it's cached or not, for the admission policy.
+        """
+        if self._admission:
+            self._admission.record(key)
+
+    def free_bytes(self):
+        return self.max_size - self.size - self.overhead
+
+    def has_room(self, byte_count):
+        return self.free_bytes() >= byte_count
+
+    def admit(self, key, byte_count):
+        """
+        :return: True if a dataset of byte_count bytes stored under key may evict the datasets
+                 required to make room for it.
+        """
+        if not self._admission:
+            return True
+
+        victims = []
+        free = self.free_bytes()
+        for victim in self._policy.eviction_order():
+            if free >= byte_count:
+                break
+
+            victims.append(victim)
+            free += self._cache_dict[victim].size
+
+        return self._admission.admit(key, victims)
 
     def __len__(self):
         return len(self._cache_dict)
 
+    def items(self):
+        """
+        :return: A list of (key, CacheItem) for all datasets in memory.
+        """
+        return self._cache_dict.items()
+
     def ensure_free(self, byte_count):
         """
         :return: A list of durations in seconds that the dataset spent in the cache before
@@ -65,17 +291,14 @@ class DatasetCache(object):
         if byte_count > self.max_size:
             raise Exception('Impossible to allocate')
 
-        if self.max_size - self.size >= byte_count:
-            return []
-
-        # This is not very efficient but good enough for now
-        lru_datasets = sorted(self._cache_dict.items(), key=lambda item: item[1].last_access_time)
         now = time()
         durations_until_eviction = []
-        for key, _ in lru_datasets:
-            durations_until_eviction.append(now - self._cache_dict[key].creation_time)
+        while self._cache_dict and not self.has_room(byte_count):
+            key = self._policy.victim()
+            item = self._cache_dict[key]
+            durations_until_eviction.append(now - item.creation_time)
             del self[key]
-            if self.max_size - self.size >= byte_count:
-                break
+            if self.spill is not None:
+                self.spill.put(key, item.qframe, expiry_time=self.expiry_time(item))
 
         return durations_until_eviction
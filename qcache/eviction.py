@@ -0,0 +1,256 @@
+"""
+Eviction policies deciding which dataset to evict from the DatasetCache when space is needed.
+
+All policies implement the same interface:
+
+inserted(key, item)  A new cache item has been stored under key
+accessed(key, item)  The cache item stored under key has been read
+resized(key, item)   The size of the cache item stored under key has changed
+removed(key)         The cache item stored under key has been deleted, replaced or evicted
+victim()             The key of the item to evict next, only called when the cache is not empty.
+                     The item is evicted right after the call.
+eviction_order()     Iterator over the keys in the order they would be evicted, does not change
+                     the state of the policy.
+"""
+import heapq
+from collections import OrderedDict
+from itertools import count
+
+
+class LRUPolicy(object):
+    """
+    Least recently used.
+    """
+    def __init__(self, max_size):
+        # Ordered from least to most recently used
+        self._keys = OrderedDict()
+
+    def inserted(self, key, item):
+        self._keys[key] = None
+
+    def accessed(self, key, item):
+        del self._keys[key]
+        self._keys[key] = None
+
+    def resized(self, key, item):
+        pass
+
+    def removed(self, key):
+        self._keys.pop(key, None)
+
+    def victim(self):
+        return next(iter(self._keys))
+
+    def eviction_order(self):
+        return iter(self._keys)
+
+
+class LFUPolicy(object):
+    """
+    Least frequently used, ties are broken by least recently used.
+    """
+    def __init__(self, max_size):
+        self._frequencies = {}
+
+        # Frequency -> keys with that access frequency ordered from least to most recently used
+        self._buckets = {}
+
+    def _add(self, key, frequency):
+        self._frequencies[key] = frequency
+        self._buckets.setdefault(frequency, OrderedDict())[key] = None
+
+    def inserted(self, key, item):
+        self._add(key, item.access_count)
+
+    def accessed(self, key, item):
+        self.removed(key)
+        self._add(key, item.access_count)
+
+    def resized(self, key, item):
+        pass
+
+    def removed(self, key):
+        frequency = self._frequencies.pop(key, None)
+        if frequency is not None:
+            bucket = self._buckets[frequency]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[frequency]
+
+    def victim(self):
+        # The number of distinct frequencies is small compared to the number of keys
+        return next(iter(self._buckets[min(self._buckets)]))
+
+    def eviction_order(self):
+        for frequency in sorted(self._buckets):
+            for key in self._buckets[frequency]:
+                yield key
+
+
+class GDSFPolicy(object):
+    """
+    Greedy Dual Size Frequency. The priority of an item is its access frequency divided by its
+    size plus an inflation value that is raised to the priority of each evicted item. Large
+    items that are rarely accessed are evicted before small, frequently accessed items while
+    the inflation ages items that are no longer accessed.
+    """
+    def __init__(self, max_size):
+        self._inflation = 0.0
+        self._priorities = {}
+
+        # Heap of (priority, insertion order, key), entries not matching the current priority are stale
+        self._heap = []
+        self._order = count()
+
+    def inserted(self, key, item):
+        priority = self._inflation + (item.access_count + 1) / float(item.size)
+        self._priorities[key] = priority
+        heapq.heappush(self._heap, (priority, next(self._order), key))
+        if len(self._heap) > 2 * len(self._priorities) + 100:
+            self._heap = [(p, o, k) for p, o, k in self._heap if self._priorities.get(k) == p]
+            heapq.heapify(self._heap)
+
+    accessed = inserted
+    resized = inserted
+
+    def removed(self, key):
+        self._priorities.pop(key, None)
+
+    def victim(self):
+        while True:
+            priority, _, key = self._heap[0]
+            if self._priorities.get(key) == priority:
+                self._inflation = priority
+                return key
+
+            heapq.heappop(self._heap)
+
+    def eviction_order(self):
+        heap = list(self._heap)
+        while heap:
+            priority, _, key = heapq.heappop(heap)
+            if self._priorities.get(key) == priority:
+                yield key
+
+
+class _SizedLRUList(object):
+    def __init__(self):
+        self.keys = OrderedDict()
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, size):
+        self.keys[key] = size
+        self.size += size
+
+    def resize(self, key, size):
+        self.size += size - self.keys[key]
+        self.keys[key] = size
+
+    def pop(self, key):
+        size = self.keys.pop(key)
+        self.size -= size
+        return size
+
+    def pop_lru(self):
+        key, size = self.keys.popitem(last=False)
+        self.size -= size
+        return key, size
+
+
+class ARCPolicy(object):
+    """
+    Adaptive Replacement Cache with sizes in bytes rather than number of items.
+
+    Items accessed once are kept in a recency list, t1, items accessed more than once in a
+    frequency list, t2. Evicted keys are remembered in the ghost lists b1 and b2. Storing a
+    key found in a ghost list adapts the target size of t1 towards recency or frequency.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+
+        # Target size of t1 in bytes
+        self.target = 0.0
+        self._t1 = _SizedLRUList()
+        self._t2 = _SizedLRUList()
+        self._b1 = _SizedLRUList()
+        self._b2 = _SizedLRUList()
+
+    def inserted(self, key, item):
+        if key in self._b1:
+            self.target = min(self.max_size, self.target + max(self._b2.size / float(self._b1.size), 1) * item.size)
+            self._b1.pop(key)
+            self._t2.add(key, item.size)
+        elif key in self._b2:
+            self.target = max(0.0, self.target - max(self._b1.size / float(self._b2.size), 1) * item.size)
+            self._b2.pop(key)
+            self._t2.add(key, item.size)
+        else:
+            self._t1.add(key, item.size)
+
+    def accessed(self, key, item):
+        resident = self._t1 if key in self._t1 else self._t2
+        resident.pop(key)
+        self._t2.add(key, item.size)
+
+    def resized(self, key, item):
+        resident = self._t1 if key in self._t1 else self._t2
+        resident.resize(key, item.size)
+
+    def removed(self, key):
+        # Evicted keys have already been moved to a ghost list
+        for resident in (self._t1, self._t2):
+            if key in resident:
+                resident.pop(key)
+
+    def victim(self):
+        if self._t1 and (self._t1.size > self.target or not self._t2):
+            key, size = self._t1.pop_lru()
+            self._b1.add(key, size)
+        else:
+            key, size = self._t2.pop_lru()
+            self._b2.add(key, size)
+
+        while self._b1 and self._t1.size + self._b1.size > self.max_size:
+            self._b1.pop_lru()
+
+        while self._b2 and self._t1.size + self._t2.size + self._b1.size + self._b2.size > 2 * self.max_size:
+            self._b2.pop_lru()
+
+        return key
+
+    def eviction_order(self):
+        # Same selection as victim() without moving keys to the ghost lists
+        t1, t2 = self._t1.keys.iteritems(), self._t2.keys.iteritems()
+        t1_size, t1_count, t2_count = self._t1.size, len(self._t1), len(self._t2)
+        while t1_count or t2_count:
+            if t1_count and (t1_size > self.target or not t2_count):
+                key, size = next(t1)
+                t1_size -= size
+                t1_count -= 1
+            else:
+                key, _ = next(t2)
+                t2_count -= 1
+
+            yield key
+
+
+EVICTION_POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'gdsf': GDSFPolicy,
+    'arc': ARCPolicy,
+}
+
+
+def make_policy(name, max_size):
+    if name not in EVICTION_POLICIES:
+        raise ValueError('Unknown eviction policy "{name}", must be one of {names}'.format(
+            name=name, names=', '.join(sorted(EVICTION_POLICIES))))
+
+    return EVICTION_POLICIES[name](max_size)
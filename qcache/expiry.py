@@ -0,0 +1,32 @@
+"""
+Background eviction of expired datasets.
+
+Datasets that have expired are otherwise only evicted when they are queried. Datasets that nobody
+queries would keep their memory until pushed out by new datasets, possibly after datasets that
+are still in use.
+"""
+from tornado.ioloop import PeriodicCallback
+
+
+class ExpirySweeper(object):
+    def __init__(self, dataset_cache, stats, interval=1.0, time_budget=0.005):
+        """
+        :param interval: Seconds between sweeps.
+        :param time_budget: Max number of seconds spent evicting datasets per sweep, remaining expired
+                            datasets are evicted by later sweeps.
+        """
+        self.dataset_cache = dataset_cache
+        self.stats = stats
+        self.time_budget = time_budget
+        self._callback = PeriodicCallback(self.sweep, interval * 1000)
+
+    def start(self):
+        self._callback.start()
+
+    def stop(self):
+        self._callback.stop()
+
+    def sweep(self):
+        evicted_count = self.dataset_cache.evict_expired(time_budget=self.time_budget)
+        if evicted_count:
+            self.stats.inc('age_evict_count', count=evicted_count)
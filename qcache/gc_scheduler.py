@@ -0,0 +1,106 @@
+"""
+Scheduling of garbage collection outside of request handling.
+
+Queries and uploads leave a lot of garbage behind, collecting it regularly reduces the process
+memory consumption considerably. A collection may take tens of milliseconds though. To keep the
+collections off the request path they are preferably performed when the server is idle. If the
+server does not become idle collections are forced after a number of requests or when the RSS
+of the process has grown too much since the last collection.
+"""
+import gc
+import os
+import time
+
+from tornado.ioloop import IOLoop
+
+GC_MODE_FULL = 'full'
+GC_MODE_YOUNG = 'young'
+GC_MODE_OFF = 'off'
+GC_MODES = {GC_MODE_FULL: 2, GC_MODE_YOUNG: 1, GC_MODE_OFF: None}
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes or None if not available on this platform.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+class GCScheduler(object):
+    def __init__(self, stats, mode=GC_MODE_FULL, idle_delay=0.1, max_pending=100, max_rss_growth=100000000,
+                 rss_fn=current_rss):
+        """
+        :param mode: full collects all generations, young only the two youngest, off disables the scheduler
+                     leaving all collection to the automatic garbage collection.
+        :param idle_delay: Seconds without requests before the server is considered idle.
+        :param max_pending: Number of queries and uploads after which a collection is forced.
+        :param max_rss_growth: Growth in bytes of the RSS after which a collection is forced.
+        """
+        if mode not in GC_MODES:
+            raise ValueError('Unknown GC mode "{mode}"'.format(mode=mode))
+
+        self.stats = stats
+        self.generation = GC_MODES[mode]
+        self.idle_delay = idle_delay
+        self.max_pending = max_pending
+        self.max_rss_growth = max_rss_growth
+        self.rss_fn = rss_fn
+
+        # Number of queries and uploads since the last collection
+        self.pending = 0
+        self.last_activity = time.time()
+        self.last_rss = rss_fn()
+        self._idle_timeout = None
+
+    @property
+    def enabled(self):
+        return self.generation is not None
+
+    def request_started(self):
+        self.last_activity = time.time()
+
+    def request_finished(self, pending):
+        """
+        Called when a request has been finished. pending is the number of queries and uploads
+        performed by the request.
+        """
+        if not self.enabled:
+            return
+
+        self.last_activity = time.time()
+        self.pending += pending
+        if not self.pending:
+            return
+
+        if self.pending >= self.max_pending or self.rss_grown():
+            self.collect()
+        elif self._idle_timeout is None:
+            self._idle_timeout = IOLoop.current().call_later(self.idle_delay, self.on_idle_timeout)
+
+    def rss_grown(self):
+        rss = self.rss_fn()
+        return rss is not None and self.last_rss is not None and rss - self.last_rss > self.max_rss_growth
+
+    def on_idle_timeout(self):
+        self._idle_timeout = None
+        if not self.pending:
+            return
+
+        idle_time = time.time() - self.last_activity
+        if idle_time >= self.idle_delay:
+            self.collect()
+        else:
+            self._idle_timeout = IOLoop.current().call_later(self.idle_delay - idle_time, self.on_idle_timeout)
+
+    def collect(self):
+        t0 = time.time()
+        gc.collect(self.generation)
+        self.stats.append('gc_durations', time.time() - t0)
+        self.pending = 0
+        self.last_rss = self.rss_fn()
@@ -0,0 +1,120 @@
+"""
+Reconciliation of the estimated size of the cached datasets with the memory actually used and
+limits on the memory used by the process.
+
+The size of a dataset is estimated when it's stored and modified. Query results, temporary
+copies, garbage and fragmentation make the process use more memory than that. The memory used
+by the process beyond the estimated size of the datasets is measured periodically and reserved
+in the cache, datasets are evicted if the reservation makes the cache exceed its max size.
+
+Limits on the RSS of the process can also be set directly. Datasets are evicted above the soft
+limit and requests that would allocate a lot of memory are rejected above the hard limit.
+"""
+import gc
+
+from tornado.ioloop import PeriodicCallback
+
+from qcache.gc_scheduler import current_rss
+
+
+class MemoryReconciler(object):
+    def __init__(self, dataset_cache, stats, interval=10.0, max_overhead_fraction=0.5, rss_fn=current_rss):
+        """
+        :param interval: Seconds between reconciliations.
+        :param max_overhead_fraction: Max part of the cache size that may be reserved for the overhead.
+                                      Memory that has been freed is not necessarily returned to the OS,
+                                      it is reused for new datasets but still counts as overhead.
+        """
+        self.dataset_cache = dataset_cache
+        self.stats = stats
+        self.max_overhead_fraction = max_overhead_fraction
+        self.rss_fn = rss_fn
+
+        # Memory used before any datasets have been stored
+        self.baseline_rss = rss_fn()
+        self._callback = PeriodicCallback(self.reconcile, interval * 1000)
+
+    def start(self):
+        self._callback.start()
+
+    def stop(self):
+        self._callback.stop()
+
+    def reconcile(self):
+        rss = self.rss_fn()
+        if rss is None or self.baseline_rss is None:
+            return
+
+        overhead = rss - self.baseline_rss - self.dataset_cache.size
+        max_overhead = self.max_overhead_fraction * self.dataset_cache.max_size
+        self.dataset_cache.overhead = min(max(overhead, 0), max_overhead)
+
+        evicted_count = len(self.dataset_cache.ensure_free(0))
+        if evicted_count:
+            self.stats.inc('memory_evict_count', count=evicted_count)
+
+
+class MemoryGovernor(object):
+    """
+    Keeps the resident set size of the process within limits. Above the soft limit datasets are
+    evicted, above the hard limit requests that would allocate a lot of memory should be rejected.
+    """
+    def __init__(self, dataset_cache, stats, soft_limit=0, hard_limit=0, interval=1.0, retry_after=1,
+                 rss_fn=current_rss):
+        """
+        :param soft_limit: RSS in bytes above which datasets are evicted, 0 = the hard limit.
+        :param hard_limit: RSS in bytes above which the process is considered overloaded, 0 = no limit.
+        :param interval: Seconds between checks of the soft limit.
+        :param retry_after: Seconds that clients are asked to wait before retrying rejected requests.
+        """
+        self.dataset_cache = dataset_cache
+        self.stats = stats
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.retry_after = retry_after
+        self.rss_fn = rss_fn
+        self.rss = None
+
+        # RSS measured after the last eviction, evicting more will not help as long as the RSS stays below it
+        self._rss_after_eviction = None
+        self._callback = PeriodicCallback(self.check, interval * 1000)
+
+    @property
+    def enabled(self):
+        return bool(self.soft_limit or self.hard_limit)
+
+    def start(self):
+        if self.enabled:
+            self._callback.start()
+
+    def stop(self):
+        self._callback.stop()
+
+    def overloaded(self):
+        """
+        :return: True if the RSS is above the hard limit.
+        """
+        if not self.hard_limit:
+            return False
+
+        self.rss = self.rss_fn()
+        return self.rss is not None and self.rss > self.hard_limit
+
+    def check(self):
+        self.rss = self.rss_fn()
+        soft_limit = self.soft_limit or self.hard_limit
+        if self.rss is None or self.rss <= soft_limit:
+            self._rss_after_eviction = None
+            return
+
+        if self._rss_after_eviction is not None and self.rss <= self._rss_after_eviction:
+            return
+
+        byte_count = min(self.dataset_cache.free_bytes() + self.rss - soft_limit, self.dataset_cache.max_size)
+        evicted_count = len(self.dataset_cache.ensure_free(byte_count))
+        if evicted_count:
+            self.stats.inc('rss_evict_count', count=evicted_count)
+
+        # Make sure that the memory of the evicted datasets is released
+        gc.collect()
+        self._rss_after_eviction = self.rss = self.rss_fn()
@@ -1,13 +1,21 @@
 from __future__ import unicode_literals
 
-from StringIO import StringIO
+import json
 
 import numpy
 from pandas import DataFrame, pandas
 
+from qcache.qframe import columnar
+from qcache.qframe.column_types import ColumnTypeException, apply_column_types, parse_type_name, type_name
+from qcache.qframe.columnar import ColumnarFormatException
 from qcache.qframe.common import unquote, MalformedQueryException
 from qcache.qframe.context import set_current_qframe
-from qcache.qframe.query import query
+from qcache.qframe.csv_stream import CSVStreamParser, read_csv
+from qcache.qframe.indexes import INDEX_KINDS, SORTED_INDEX, IndexException, IndexUsage, build_index
+from qcache.qframe.memory_usage import estimate_byte_size
+from qcache.qframe.optimize import optimize_types, restore_types
+from qcache.qframe.query import query, query_many
+from qcache.qframe.strings import compact_strings, materialize
 from qcache.qframe.update import update_frame
 
 
@@ -38,55 +46,323 @@ def _add_stand_in_columns(df, stand_in_columns):
                 df.loc[:, column_name] = pandas.Series(arr, index=df.index)
 
 
+def _referenced_names(q):
+    if isinstance(q, (list, tuple)):
+        return set().union(*[_referenced_names(e) for e in q])
+
+    return {q} if isinstance(q, basestring) else set()
+
+
+def _json_name(name):
+    return json.dumps(name if isinstance(name, basestring) else str(name))
+
+
 class QFrame(object):
     """
     Thin wrapper around a Pandas dataframe.
     """
-    __slots__ = ('df', 'unsliced_df_len')
+    __slots__ = ('df', 'unsliced_df_len', 'original_types', 'string_columns', 'indexes', 'index_usage')
 
-    def __init__(self, pandas_df, unsliced_df_len=None):
+    def __init__(self, pandas_df, unsliced_df_len=None, original_types=None, string_columns=None):
         self.unsliced_df_len = len(pandas_df) if unsliced_df_len is None else unsliced_df_len
         self.df = pandas_df
 
+        # Original type names of the columns optimized for storage, see optimize_types
+        self.original_types = original_types or {}
+
+        # Compact string columns, the dataframe holds the row positions in them, see compact_strings
+        self.string_columns = string_columns or {}
+
+        # Secondary indexes of columns, see build_indexes
+        self.indexes = {}
+
+        # Lookups on the columns of the frame by filters, for automatic indexing
+        self.index_usage = IndexUsage()
+
     @staticmethod
     def from_csv(csv_string, column_types=None, stand_in_columns=None):
-        df = pandas.read_csv(StringIO(csv_string), dtype=column_types, na_values=[''], keep_default_na=False)
+        df = read_csv(csv_string, column_types)
+        _add_stand_in_columns(df, stand_in_columns)
+        return QFrame(df)
+
+    @staticmethod
+    def from_csv_stream(parser, stand_in_columns=None):
+        """
+        Create a QFrame from the data fed to a CSVStreamParser.
+        """
+        df = parser.close()
+        _add_stand_in_columns(df, stand_in_columns)
+        return QFrame(df)
+
+    @staticmethod
+    def from_columnar(data, stand_in_columns=None):
+        """
+        Create a QFrame from data in the columnar format, see qcache.qframe.columnar. Column types
+        are given by the data.
+        """
+        df = columnar.from_columnar(data)
         _add_stand_in_columns(df, stand_in_columns)
         return QFrame(df)
 
+    @staticmethod
+    def map_columnar(path, original_types=None, string_columns=(), index_kinds=None):
+        """
+        Create a QFrame from a file in the columnar format written from a stored frame by memory
+        mapping it, see qcache.qframe.columnar.mmap_file. The mapping remains valid after the file
+        has been removed. Raises ColumnarFormatException, IOError or OSError if the file cannot be read.
+
+        :param string_columns: Names of the compact string columns of the stored frame.
+        :param index_kinds: Indexes of the stored frame, they are built again.
+        """
+        df, compact_columns = columnar.read_columnar(columnar.mmap_file(path), string_columns=string_columns)
+        qframe = QFrame(df, original_types=original_types, string_columns=compact_columns)
+        qframe.build_indexes(index_kinds or {})
+        return qframe
+
     @staticmethod
     def from_dicts(d, column_types=None, stand_in_columns=None):
         df = DataFrame.from_records(d)
+        apply_column_types(df, column_types)
+        _add_stand_in_columns(df, stand_in_columns=stand_in_columns)
+        return QFrame(df)
 
-        # Setting columns to categorials is slightly awkward from dicts
-        # than from CSV...
-        if column_types:
-            for name, type in column_types.items():
-                if type == 'category':
-                    df[name] = df[name].astype("category")
-
+    @staticmethod
+    def from_columns(columns, column_types=None, stand_in_columns=None):
+        """
+        Create a QFrame from a list of (column name, list of values) tuples. Raises ValueError if
+        the columns are not of equal length.
+        """
+        df = DataFrame.from_items(columns)
+        apply_column_types(df, column_types)
         _add_stand_in_columns(df, stand_in_columns=stand_in_columns)
         return QFrame(df)
 
-    def query(self, q, stand_in_columns=None):
-        _add_stand_in_columns(self.df, stand_in_columns)
+    def add_stand_in_columns(self, stand_in_columns, copy_on_write=False):
+        """
+        Add stand in columns missing from the frame. With copy_on_write the frame is replaced rather
+        than modified so that queries currently executing against the old frame are not affected.
+
+        :return: True if any columns were added
+        """
+        if not stand_in_columns or all(name in self.df for name, _ in stand_in_columns):
+            return False
+
+        df = self.df.copy(deep=False) if copy_on_write else self.df
+        _add_stand_in_columns(df, stand_in_columns)
+
+        # Stand ins copied from optimized columns are optimized as well
+        original_types = dict(self.original_types)
+        for name, stand_in_value in stand_in_columns:
+            if stand_in_value in self.original_types and name not in original_types:
+                original_types[name] = self.original_types[stand_in_value]
+        self.original_types = original_types
+
+        # As are stand ins copied from compact string columns, the positions are copied as well
+        string_columns = dict(self.string_columns)
+        for name, stand_in_value in stand_in_columns:
+            if stand_in_value in self.string_columns and name not in string_columns:
+                string_columns[name] = self.string_columns[stand_in_value]
+        self.string_columns = string_columns
+
+        # And indexed, the index applies to the copy as well. Automatically built indexes are
+        # only kept for the columns that they were built for.
+        indexes = dict(self.indexes)
+        for name, stand_in_value in stand_in_columns:
+            if stand_in_value in self.indexes and stand_in_value not in self.index_usage.automatic and \
+                    name not in indexes:
+                indexes[name] = self.indexes[stand_in_value]
+        self.indexes = indexes
+
+        # Consolidate up front, it would otherwise be done lazily as part of a later query
+        df._consolidate_inplace()
+        self.df = df
+        return True
+
+    def query(self, q, stand_in_columns=None, copy_on_write=False):
+        self.add_stand_in_columns(stand_in_columns, copy_on_write=copy_on_write)
         set_current_qframe(self)
         if 'update' in q:
             # In place operation, should it be?
-            update_frame(self.df, q)
+            df = self.df.copy() if copy_on_write else self.df
+
+            # The updated values may not fit the optimized types
+            referenced = _referenced_names(q.values())
+            df, restored = restore_types(df, self.original_types, columns=referenced, inplace=True)
+            df, materialized = materialize(df, self.string_columns, columns=referenced, inplace=True)
+            update_frame(df, q)
+            self.df = df
+            self.original_types = {name: t for name, t in self.original_types.items() if name not in restored}
+            self.string_columns = {name: c for name, c in self.string_columns.items() if name not in materialized}
+
+            # Indexes of updated columns no longer match the values
+            updated = _referenced_names(q.get('update'))
+            self.indexes = {name: i for name, i in self.indexes.items() if name not in updated}
+            for name in updated:
+                self.index_usage.modified(name)
             return None
 
         new_df, unsliced_df_len = query(self.df, q)
         return QFrame(new_df, unsliced_df_len=unsliced_df_len)
 
+    def optimize_types(self, category_threshold=0.5, skip_columns=()):
+        """
+        Store the columns of the frame in more compact types, see qcache.qframe.optimize. Query
+        results are the same as before the optimization.
+
+        :return: Dict with the new type names of the optimized columns.
+        """
+        skip_columns = set(skip_columns) | set(self.string_columns)
+        optimized = optimize_types(self.df, category_threshold=category_threshold, skip_columns=skip_columns)
+        self.original_types.update(optimized)
+        return {name: type_name(self.df[name].dtype) for name in optimized}
+
+    def compact_strings(self, skip_columns=()):
+        """
+        Store the string columns of the frame compactly, see qcache.qframe.strings. Query results
+        are the same as before.
+
+        :return: Names of the compacted columns.
+        """
+        skip_columns = set(skip_columns) | set(self.original_types) | set(self.string_columns)
+        compacted = compact_strings(self.df, skip_columns=skip_columns)
+        self.string_columns.update(compacted)
+        return [name for name in self.df.columns if name in compacted]
+
+    def build_indexes(self, index_kinds):
+        """
+        Build secondary indexes, see qcache.qframe.indexes, used by filters on the indexed columns.
+        Raises IndexException if a column is missing or cannot be indexed.
+
+        :param index_kinds: Dict with the kind of index to build per column name.
+        """
+        indexes = {name: self.index_column(name, kind) for name, kind in index_kinds.items()}
+        for name in indexes:
+            self.index_usage.automatic.pop(name, None)
+
+        self.indexes.update(indexes)
+
+    def index_column(self, name, kind):
+        """
+        :return: An index of the given kind on column name, not used by the frame until added.
+                 Raises IndexException if the column is missing or cannot be indexed.
+        """
+        if name not in self.df:
+            raise IndexException('Unknown column "{name}"'.format(name=name))
+
+        if kind == SORTED_INDEX and self.df[name].dtype.name == 'category' and name not in self.original_types:
+            # Enums cannot be compared by larger than and less than
+            raise IndexException('Enum column "{name}" cannot have a sorted index'.format(name=name))
+
+        values = materialize(self.df, self.string_columns, columns=[name])[0][name]
+        try:
+            return build_index(values, kind)
+        except IndexException as e:
+            raise IndexException('Column "{name}": {error}'.format(name=name, error=e))
+
+    def add_automatic_index(self, name, index):
+        """
+        Add an index built by index_column for a column that is scanned repeatedly.
+        """
+        self.indexes[name] = index
+        self.index_usage.built(name)
+
+    def drop_automatic_index(self, name):
+        self.index_usage.dropped(name, self.indexes.pop(name).kind)
+
+    @property
+    def index_kinds(self):
+        return {name: index.kind for name, index in self.indexes.items()}
+
+    @property
+    def declared_index_kinds(self):
+        """
+        The kinds of the indexes that were not built automatically.
+        """
+        return {name: index.kind for name, index in self.indexes.items()
+                if name not in self.index_usage.automatic}
+
+    def _values_df(self):
+        # The frame with the strings of compact string columns, for serialization
+        return materialize(self.df, self.string_columns)[0]
+
+    def query_many(self, qs):
+        """
+        Execute a list of queries against the frame. Queries with equal filters share one scan.
+        Returns a list with one QFrame or MalformedQueryException per query.
+        """
+        set_current_qframe(self)
+        return [r if isinstance(r, MalformedQueryException) else QFrame(r[0], unsliced_df_len=r[1])
+                for r in query_many(self.df, qs)]
+
     def to_csv(self):
-        return self.df.to_csv(index=False)
+        return self._values_df().to_csv(index=False)
+
+    def to_json(self, orient='records'):
+        """
+        :param orient: 'records' for a list with one object per row, 'columns' for an object with
+                       a list of values per column, 'split' for an object with a list of the
+                       column names and a list with a list of values per row.
+        """
+        if orient == 'records':
+            return self._values_df().to_json(orient='records')
+
+        return ''.join(self.to_json_batches(max(len(self.df), 1), orient=orient))
+
+    def to_columnar(self):
+        """
+        List of byte strings that together make up the frame in the columnar format,
+        see qcache.qframe.columnar.
+        """
+        return columnar.to_columnar(self.df, string_columns=self.string_columns)
+
+    def _batches(self, batch_rows):
+        df = self._values_df()
+        for start in range(0, len(df), batch_rows):
+            yield start, df[start:start + batch_rows]
+
+    def to_csv_batches(self, batch_rows):
+        """
+        Generator of CSV serialized batches of at most batch_rows rows. The concatenated
+        batches equal the output of to_csv.
+        """
+        for start, df in self._batches(batch_rows):
+            yield df.to_csv(index=False, header=start == 0)
+
+    def to_json_batches(self, batch_rows, orient='records'):
+        """
+        Generator of JSON serialized batches of at most batch_rows rows, or one column for
+        orient='columns'. The concatenated batches equal the output of to_json.
+        """
+        if orient == 'columns':
+            df = self._values_df()
+            for i, name in enumerate(df.columns):
+                values = df.iloc[:, i].to_json(orient='values')
+                yield ('{' if i == 0 else ',') + _json_name(name) + ':' + values
+
+            yield '}' if len(self.df.columns) else '{}'
+            return
+
+        if orient == 'split':
+            yield '{"columns":[' + ','.join(_json_name(name) for name in self.df.columns) + '],"data":'
+            batch_orient = 'values'
+        else:
+            batch_orient = 'records'
+
+        if not len(self.df):
+            yield '[]'
+        else:
+            for start, df in self._batches(batch_rows):
+                # Strip the enclosing brackets of each batch and join with the previous
+                rows = df.to_json(orient=batch_orient)[1:-1]
+                yield ('[' if start == 0 else ',') + rows
+
+            yield ']'
 
-    def to_json(self):
-        return self.df.to_json(orient='records')
+        if orient == 'split':
+            yield '}'
 
     def to_dicts(self):
-        return self.df.to_dict(orient='records')
+        return self._values_df().to_dict(orient='records')
 
     @property
     def columns(self):
@@ -96,5 +372,7 @@ class QFrame(object):
         return len(self.df)
 
     def byte_size(self):
-        # Estimate of the number of bytes consumed by this QFrame
-        return self.df.memory_usage(index=True, deep=True).sum()
+        # Estimate of the number of bytes consumed by this QFrame, stand ins may share string
+        # columns and indexes
+        shared = {id(c): c for c in self.string_columns.values() + self.indexes.values()}
+        return estimate_byte_size(self.df) + sum(c.nbytes for c in shared.values())
@@ -0,0 +1,179 @@
+"""
+Explicitly given types of the columns of uploaded datasets.
+
+Column types map column names to pandas dtype names. Datetime columns may also be given as a
+DatetimeType with the format of the values. Types that pandas can parse safely, strings, categories
+and floats, are passed to the CSV parser. All other types are applied after parsing where the
+values can be checked, pandas silently wraps integers that overflow the given type when parsing.
+"""
+import numpy
+import pandas
+
+# Type names accepted in the X-QCache-types header and the dtypes they map to
+TYPE_NAMES = {'string': 'object',
+              'enum': 'category',
+              'float': 'float64',
+              'float32': 'float32',
+              'float64': 'float64',
+              'bool': 'bool',
+              'int8': 'int8',
+              'int16': 'int16',
+              'int32': 'int32',
+              'int64': 'int64',
+              'uint8': 'uint8',
+              'uint16': 'uint16',
+              'uint32': 'uint32',
+              'uint64': 'uint64'}
+DATETIME_TYPE_NAME = 'datetime'
+
+# Strings, in any case, accepted as boolean values
+_BOOL_STRINGS = {'true': True, 'false': False, '1': True, '0': False}
+
+
+class ColumnTypeException(Exception):
+    pass
+
+
+class DatetimeType(object):
+    """
+    Datetime column with values in format, see strftime(), or in any format understood by
+    pandas.to_datetime if format is None.
+    """
+    __slots__ = ('format',)
+
+    def __init__(self, format=None):
+        self.format = format
+
+
+def parse_type_name(type_name):
+    """
+    :param type_name: One of TYPE_NAMES, 'datetime' or 'datetime:<format>'.
+    :return: The column type for type_name.
+    """
+    if type_name in TYPE_NAMES:
+        return TYPE_NAMES[type_name]
+
+    name, _, datetime_format = type_name.partition(':')
+    if name == DATETIME_TYPE_NAME:
+        return DatetimeType(datetime_format or None)
+
+    raise ColumnTypeException('Unrecognized type name "{type_name}"'.format(type_name=type_name))
+
+
+def type_name(dtype):
+    """
+    Name of dtype as used in the X-QCache-types header.
+    """
+    if dtype.name == 'category':
+        return 'enum'
+
+    if dtype.kind == 'M':
+        return DATETIME_TYPE_NAME
+
+    return dtype.name
+
+
+def _dtype(column_type):
+    if isinstance(column_type, DatetimeType) or column_type == 'category':
+        return None
+
+    return numpy.dtype(column_type)
+
+
+def parser_types(column_types):
+    """
+    The column types that can be given to the CSV parser.
+    """
+    if not column_types:
+        return column_types
+
+    return {name: column_type for name, column_type in column_types.items()
+            if column_type == 'category' or (_dtype(column_type) is not None and _dtype(column_type).kind in 'Of')}
+
+
+def _to_datetime(series, column_type):
+    if series.dtype.kind == 'M':
+        return series
+
+    datetime_format = column_type.format if isinstance(column_type, DatetimeType) else None
+    return pandas.to_datetime(series, format=datetime_format)
+
+
+def _to_integer(series, dtype):
+    if series.dtype.kind not in 'biuf':
+        raise ValueError('not a number')
+
+    if series.isnull().any():
+        raise ValueError('null values cannot be stored as integers')
+
+    values = series.values
+    if series.dtype.kind == 'f' and (values != numpy.floor(values)).any():
+        raise ValueError('not an integer')
+
+    info = numpy.iinfo(dtype)
+    if len(values) and (values.min() < info.min or values.max() > info.max):
+        raise ValueError('value out of range for {dtype}'.format(dtype=dtype))
+
+    return series.astype(dtype)
+
+
+def _to_bool(series):
+    if series.dtype.kind in 'iuf' and series.isin([0, 1]).all():
+        return series.astype(bool)
+
+    if series.dtype.kind == 'O':
+        lowered = series.str.lower()
+        if lowered.isin(_BOOL_STRINGS).all():
+            return lowered.map(_BOOL_STRINGS).astype(bool)
+
+    raise ValueError('not a boolean')
+
+
+def _to_string(series):
+    # Null values remain null
+    return series.where(series.isnull(), series.astype(str))
+
+
+def _convert(series, column_type):
+    if column_type == 'category':
+        return series.astype('category')
+
+    dtype = _dtype(column_type)
+    if dtype is None or dtype.kind == 'M':
+        return _to_datetime(series, column_type)
+
+    if series.dtype == dtype:
+        return series
+
+    if not len(series):
+        # Empty columns, such as those of a CSV with only a header, are parsed as objects
+        return series.astype(dtype)
+
+    if dtype.kind in 'iu':
+        return _to_integer(series, dtype)
+
+    if dtype.kind == 'b':
+        return _to_bool(series)
+
+    if dtype.kind == 'O':
+        return _to_string(series)
+
+    return series.astype(dtype)
+
+
+def apply_column_types(df, column_types):
+    """
+    Convert the columns of df to the given types in place. Columns not in df are ignored.
+    Raises ColumnTypeException if the values of a column cannot be represented in its type.
+    """
+    if not column_types:
+        return
+
+    for name, column_type in column_types.items():
+        if name not in df:
+            continue
+
+        try:
+            df[name] = _convert(df[name], column_type)
+        except (ValueError, TypeError, OverflowError) as e:
+            raise ColumnTypeException('Invalid values in column "{name}": {error}'.format(name=name, error=e))
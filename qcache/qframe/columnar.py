@@ -0,0 +1,393 @@
+"""
+Binary columnar format for dataframes.
+
+The format consists of:
+
+- The magic bytes QCOLUMN1.
+- The length of the header as an unsigned 64 bit little endian integer.
+- The header, a JSON object padded with spaces to a multiple of 8 bytes.
+- The column buffers, each starting at a multiple of 8 bytes from the end of the header.
+
+The header holds the number of rows and a list of column descriptions:
+
+{"rows": 2,
+ "columns": [{"name": "foo", "type": "numeric", "dtype": "<i8", "data": [0, 16]},
+             {"name": "bar", "type": "string", "encoding": "plain",
+              "offsets": [16, 24], "data": [40, 6], "nulls": null},
+             {"name": "baz", "type": "category", "ordered": false, "category_count": 2,
+              "codes": {"type": "numeric", "dtype": "|i1", "data": [48, 2]},
+              "categories": {"type": "string", "encoding": "plain",
+                             "offsets": [56, 16], "data": [72, 2], "nulls": null}}]}
+
+Buffers are given as [offset, length] in bytes. Numeric buffers contain the values in the given
+NumPy dtype. Plain string columns have a buffer with the UTF-8 encoded values back to back, a
+buffer of rows + 1 int64 offsets of the values in that buffer and, if any value is null, a buffer
+with one byte per row that is 1 for null values. Dictionary encoded string columns have numeric
+codes, -1 = null, referring to a plain string column with the distinct values:
+
+{"type": "string", "encoding": "dictionary", "dictionary_count": 2,
+ "codes": {"type": "numeric", ...}, "dictionary": {"type": "string", "encoding": "plain", ...}}
+
+Category columns have numeric codes, -1 = null, and either numeric or string categories.
+
+Numeric buffers of writable data, such as private memory mapped files, are used as they are when
+reading, the columns of the dataframe refer to the mapped file rather than copies of the values.
+Plain string columns may also be read as compact string columns, see qcache.qframe.strings, that use
+the buffers as they are.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import numpy
+from pandas import Categorical, DataFrame, Index, RangeIndex, factorize
+from pandas.api.types import is_categorical_dtype, is_object_dtype
+from pandas.core.internals import BlockManager, make_block
+
+from qcache.qframe.strings import StringColumn, encode_strings, is_compact
+
+MAGIC = b'QCOLUMN1'
+_LENGTH = struct.Struct('<Q')
+_ALIGNMENT = 8
+
+# NumPy dtype kinds stored as raw values: bool, signed and unsigned integer, float and naive datetime/timedelta
+_NUMERIC_KINDS = 'biufMm'
+
+
+class ColumnarFormatException(Exception):
+    pass
+
+
+class _BufferWriter(object):
+    def __init__(self):
+        self.buffers = []
+        self.size = 0
+
+    def add(self, data):
+        """
+        :return: [offset, length] of data
+        """
+        location = [self.size, len(data)]
+        self.buffers.append(data)
+        self.size += len(data)
+
+        padding = -self.size % _ALIGNMENT
+        if padding:
+            self.buffers.append(b'\0' * padding)
+            self.size += padding
+
+        return location
+
+
+def _numeric_column(values, writer):
+    values = numpy.ascontiguousarray(values)
+    return {'type': 'numeric', 'dtype': values.dtype.str, 'data': writer.add(values.tobytes())}
+
+
+def _string_buffers(offsets, data, nulls, writer):
+    return {'type': 'string',
+            'encoding': 'plain',
+            'offsets': writer.add(offsets.astype('<i8').tobytes()),
+            'data': writer.add(data),
+            'nulls': writer.add(nulls.astype(numpy.uint8).tobytes()) if nulls is not None else None}
+
+
+def _plain_string_column(values, writer, name):
+    try:
+        offsets, data, nulls = encode_strings(values)
+    except TypeError as e:
+        raise ColumnarFormatException(
+            'Unsupported value type {type} in column "{name}"'.format(type=e, name=name))
+
+    return _string_buffers(offsets, data, nulls, writer)
+
+
+def _compact_string_column(string_column, positions, writer, name):
+    if len(positions) == len(string_column) and (positions == numpy.arange(len(positions))).all():
+        # The buffers are written as they are
+        data = string_column.data if isinstance(string_column.data, str) else bytes(string_column.data)
+        return _string_buffers(string_column.offsets, data, string_column.nulls, writer)
+
+    return _plain_string_column(string_column.take(positions), writer, name)
+
+
+def _string_column(values, writer, name):
+    codes, uniques = factorize(values)
+    if len(uniques) > len(values) // 2:
+        return _plain_string_column(values, writer, name)
+
+    # Only the distinct values have to be encoded and decoded one by one
+    code_dtype = next(dtype for dtype in (numpy.int8, numpy.int16, numpy.int32, numpy.int64)
+                      if len(uniques) <= numpy.iinfo(dtype).max)
+    return {'type': 'string',
+            'encoding': 'dictionary',
+            'dictionary_count': len(uniques),
+            'codes': _numeric_column(codes.astype(code_dtype), writer),
+            'dictionary': _plain_string_column(uniques, writer, name)}
+
+
+def _column(values, writer, name):
+    if is_categorical_dtype(values):
+        return {'type': 'category',
+                'ordered': bool(values.ordered),
+                'category_count': len(values.categories),
+                'codes': _numeric_column(values.codes, writer),
+                'categories': _column(values.categories.values, writer, name)}
+
+    if is_object_dtype(values):
+        return _string_column(values, writer, name)
+
+    if values.dtype.kind in _NUMERIC_KINDS:
+        return _numeric_column(values, writer)
+
+    raise ColumnarFormatException(
+        'Unsupported type {dtype} of column "{name}"'.format(dtype=values.dtype, name=name))
+
+
+def to_columnar(df, string_columns=None):
+    """
+    Serialize df into a list of byte strings that together make up the columnar representation.
+    Only the values of df are serialized, the index is not.
+
+    :param string_columns: Compact string columns that columns of df hold the positions in.
+    """
+    if not df.columns.is_unique:
+        raise ColumnarFormatException('Column names must be unique')
+
+    string_columns = string_columns or {}
+    writer = _BufferWriter()
+    columns = []
+    for name, series in df.iteritems():
+        if is_compact(df, name, string_columns):
+            column = _compact_string_column(string_columns[name], series.values, writer, name)
+        else:
+            column = _column(series.values, writer, name)
+        column['name'] = name
+        columns.append(column)
+
+    header = json.dumps({'rows': len(df), 'columns': columns})
+    header += ' ' * (-len(header) % _ALIGNMENT)
+    return [MAGIC, _LENGTH.pack(len(header)), header] + writer.buffers
+
+
+def write_columnar(df, f, string_columns=None):
+    for data in to_columnar(df, string_columns=string_columns):
+        f.write(data)
+
+
+class _BufferReader(object):
+    def __init__(self, data, start):
+        self.data = data
+        self.start = start
+
+    def _location(self, location):
+        offset, length = location
+        offset += self.start
+        if offset < self.start or length < 0 or offset + length > len(self.data):
+            raise ColumnarFormatException('Column buffer outside of data')
+
+        return offset, length
+
+    def array(self, location, dtype, count):
+        offset, length = self._location(location)
+        if length != dtype.itemsize * count:
+            raise ColumnarFormatException('Unexpected length of column buffer')
+
+        return numpy.frombuffer(self.data, dtype=dtype, count=count, offset=offset)
+
+    def bytes(self, location):
+        offset, length = self._location(location)
+        return bytes(self.data[offset:offset + length])
+
+    def buffer(self, location):
+        # Refers to the data rather than copying it
+        offset, length = self._location(location)
+        return buffer(self.data, offset, length)
+
+
+def _read_string_column(column, reader, rows):
+    """
+    A plain string column as a StringColumn, None for all other columns.
+    """
+    try:
+        if column['type'] != 'string' or column['encoding'] != 'plain':
+            return None
+
+        offsets = reader.array(column['offsets'], numpy.dtype('<i8'), rows + 1)
+        data = reader.buffer(column['data'])
+        nulls = None
+        if column['nulls'] is not None:
+            nulls = reader.array(column['nulls'], numpy.dtype(numpy.uint8), rows).astype(bool)
+    except (KeyError, TypeError, ValueError) as e:
+        raise ColumnarFormatException('Invalid column description: {error}'.format(error=e))
+
+    if len(offsets) and (offsets[0] != 0 or offsets[-1] != len(data) or (numpy.diff(offsets) < 0).any()):
+        raise ColumnarFormatException('String offsets out of range')
+
+    return StringColumn(data, offsets, nulls)
+
+
+def _read_column(column, reader, rows):
+    try:
+        column_type = column['type']
+        if column_type == 'numeric':
+            dtype = numpy.dtype(str(column['dtype']))
+            if dtype.kind not in _NUMERIC_KINDS:
+                raise ColumnarFormatException('Unsupported dtype {dtype}'.format(dtype=dtype))
+
+            return reader.array(column['data'], dtype, rows)
+
+        if column_type == 'string' and column['encoding'] == 'dictionary':
+            codes = _read_column(column['codes'], reader, rows)
+            dictionary = _read_column(column['dictionary'], reader, column['dictionary_count'])
+            if len(codes) and (codes.min() < -1 or codes.max() >= len(dictionary)):
+                raise ColumnarFormatException('Dictionary code out of range')
+
+            # Code -1 refers to the last element, null
+            return numpy.append(dictionary, numpy.nan).take(codes)
+
+        if column_type == 'string' and column['encoding'] == 'plain':
+            offsets = reader.array(column['offsets'], numpy.dtype('<i8'), rows + 1).tolist()
+            data = reader.bytes(column['data'])
+            values = numpy.empty(rows, dtype=object)
+            values[:] = [data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+            if column['nulls'] is not None:
+                nulls = reader.array(column['nulls'], numpy.dtype(numpy.uint8), rows)
+                values[nulls.astype(bool)] = numpy.nan
+
+            return values
+
+        if column_type == 'category':
+            codes = _read_column(column['codes'], reader, rows)
+            categories = _read_column(column['categories'], reader, column['category_count'])
+            return Categorical.from_codes(codes, categories, ordered=column['ordered'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ColumnarFormatException('Invalid column description: {error}'.format(error=e))
+
+    raise ColumnarFormatException('Unknown column type "{type}"'.format(type=column_type))
+
+
+def _block(values, position, rows):
+    """
+    A dataframe block holding only the column at position, referring to values rather than a copy
+    where possible.
+    """
+    if is_categorical_dtype(values):
+        return make_block(values, placement=[position])
+
+    if not values.dtype.isnative:
+        values = values.astype(values.dtype.newbyteorder('='))
+
+    if values.dtype.kind in 'Mm' and values.dtype != numpy.dtype(values.dtype.kind + '8[ns]'):
+        # Pandas only stores datetimes and timedeltas in nanoseconds
+        values = values.astype(values.dtype.kind + '8[ns]')
+
+    if not values.flags.writeable:
+        # Columns are modified in place by updates
+        values = values.copy()
+
+    return make_block(values.reshape(1, rows), placement=[position])
+
+
+def read_columnar(data, string_columns=()):
+    """
+    Create a dataframe from data in the columnar format. data may be any object supporting
+    the buffer protocol, such as a string, a bytearray or an mmap. Numeric columns refer to
+    data if it's writable, like a bytearray or a private mmap, they are copied otherwise.
+
+    :param string_columns: Names of plain string columns to read as compact string columns.
+    :return: The dataframe and a dict with the compact string columns that it holds the positions in.
+    """
+    prefix_length = len(MAGIC) + _LENGTH.size
+    if len(data) < prefix_length or data[:len(MAGIC)] != MAGIC:
+        raise ColumnarFormatException('Not in columnar format')
+
+    header_length, = _LENGTH.unpack(data[len(MAGIC):prefix_length])
+    try:
+        header = json.loads(bytes(data[prefix_length:prefix_length + header_length]))
+        rows = header['rows']
+        columns = header['columns']
+        names = [column['name'] for column in columns]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ColumnarFormatException('Invalid header: {error}'.format(error=e))
+
+    reader = _BufferReader(data, prefix_length + header_length)
+    blocks = []
+    compact_columns = {}
+    for position, column in enumerate(columns):
+        name = column['name']
+        string_column = _read_string_column(column, reader, rows) if name in string_columns else None
+        if string_column is not None:
+            compact_columns[name] = string_column
+            values = string_column.positions()
+        else:
+            values = _read_column(column, reader, rows)
+
+        blocks.append(_block(values, position, rows))
+
+    # The DataFrame constructor would consolidate columns of the same type into one block, copying them
+    return DataFrame(BlockManager(blocks, [Index(names), RangeIndex(rows)])), compact_columns
+
+
+def from_columnar(data):
+    """
+    Create a dataframe from data in the columnar format, see read_columnar.
+    """
+    return read_columnar(data)[0]
+
+
+def mmap_file(path):
+    """
+    Memory map the file at path. The mapping is private, modifications are not written to the file.
+    """
+    with open(path, 'rb') as f:
+        # The mapping is closed when no longer referenced
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+
+def map_columnar(path):
+    """
+    Create a dataframe from a file in the columnar format by memory mapping it, see mmap_file.
+    """
+    return from_columnar(mmap_file(path))
+
+
+def key_file_name(key, suffix):
+    """
+    Name of the file for the dataset stored under key.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    # Keys may contain any character, the digest is safe to use as a file name
+    return hashlib.sha1(key).hexdigest() + suffix
+
+
+def write_columnar_file(df, path, string_columns=None):
+    """
+    Write df to the file at path in the columnar format, see to_columnar. Anything written is
+    removed if the file cannot be written completely.
+
+    :return: The size of the file or None if df contains values that cannot be represented in the
+             columnar format or the file could not be written.
+    """
+    try:
+        with open(path, 'wb') as f:
+            write_columnar(df, f, string_columns=string_columns)
+    except (ColumnarFormatException, IOError, OSError):
+        remove_file(path)
+        return None
+
+    return os.path.getsize(path)
+
+
+def remove_file(path):
+    """
+    Remove the file at path if it exists.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
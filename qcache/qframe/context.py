@@ -1,16 +1,17 @@
 """
 Context to keep track of the qframe that is currently being operated on.
 
-NB! Not thread safe and not safe for interleaved operations on multiple frames.
+The context is thread local so that queries can be executed concurrently in different
+threads. Interleaved operations on multiple frames within one thread are not supported.
 """
+import threading
 
-_current_qframe = None
+_context = threading.local()
 
 
 def set_current_qframe(qframe):
-    global _current_qframe
-    _current_qframe = qframe
+    _context.qframe = qframe
 
 
 def get_current_qframe():
-    return _current_qframe
+    return getattr(_context, 'qframe', None)
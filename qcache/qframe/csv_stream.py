@@ -0,0 +1,153 @@
+from StringIO import StringIO
+
+import numpy
+import pandas
+from pandas.api.types import union_categoricals, is_categorical_dtype
+
+from qcache.qframe.column_types import apply_column_types, parser_types
+
+CSV_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def read_csv(csv_string, column_types=None, **kwargs):
+    """
+    Raises ColumnTypeException if the values of a column cannot be represented in its type.
+    """
+    df = pandas.read_csv(StringIO(csv_string), dtype=parser_types(column_types), na_values=[''],
+                         keep_default_na=False, **kwargs)
+    apply_column_types(df, column_types)
+    return df
+
+
+def _last_line_end(text):
+    """
+    Position of the last newline in text that is not part of a quoted field, -1 if none exists.
+    """
+    pos = text.rfind('\n')
+    if pos < 0 or '"' not in text:
+        return pos
+
+    # An odd number of quotes before the newline means that it's within a quoted field
+    quote_count = text.count('"', 0, pos)
+    while pos >= 0 and quote_count % 2:
+        previous_pos = text.rfind('\n', 0, pos)
+        quote_count -= text.count('"', previous_pos + 1, pos)
+        pos = previous_pos
+
+    return pos
+
+
+def _as_strings(series):
+    """
+    The values of an already parsed column as strings, nulls remain nulls.
+    """
+    strings = numpy.array([v if isinstance(v, basestring) else repr(v) if isinstance(v, float) else str(v)
+                           for v in series.values], dtype=object)
+    strings[series.isnull().values] = numpy.nan
+    return strings
+
+
+class CSVStreamParser(object):
+    """
+    Incremental CSV parser. Data is fed to the parser as it arrives, every time block_size bytes
+    have been received the complete lines received so far are parsed into a data frame block.
+    The blocks are concatenated into the final data frame when the parser is closed.
+
+    Type inference is done per block. When a column is inferred to a type in a block that cannot
+    be combined with the types of earlier blocks, for example strings after numbers, the column of
+    that block is parsed again as strings, the values of the earlier blocks are converted to strings
+    and the column is parsed as strings in all later blocks. This is what parsing the complete CSV
+    would result in, except for numbers written in another form than their string representation
+    in earlier blocks, "1.50" for example becomes "1.5".
+    """
+    def __init__(self, column_types=None, block_size=CSV_BLOCK_SIZE):
+        self.column_types = column_types
+        self.block_size = block_size
+        self._pending = []
+        self._pending_size = 0
+        self._blocks = []
+        self._columns = None
+        self._block_types = dict(column_types or {})
+        self._inferred_dtypes = {}
+
+    def feed(self, data):
+        if not data:
+            return
+
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.block_size:
+            self._parse_complete_lines()
+
+    def _parse_complete_lines(self):
+        text = b''.join(self._pending)
+        line_end = _last_line_end(text)
+        if line_end < 0:
+            self._pending = [text]
+            return
+
+        self._parse_block(text[:line_end + 1])
+        rest = text[line_end + 1:]
+        self._pending = [rest] if rest else []
+        self._pending_size = len(rest)
+
+    def _header_args(self):
+        # Only the first block has a header
+        return {} if self._columns is None else {'header': None, 'names': self._columns}
+
+    def _parse_block(self, text):
+        header_args = self._header_args()
+        block = read_csv(text, self._block_types, **header_args)
+        if self._columns is None:
+            self._columns = list(block.columns)
+
+        conflicting = self._conflicting_columns(block)
+        if conflicting:
+            strings = pandas.read_csv(StringIO(text), usecols=conflicting, dtype={name: str for name in conflicting},
+                                      na_values=[''], keep_default_na=False, **header_args)
+            for name in conflicting:
+                block[name] = strings[name].values
+                for earlier_block in self._blocks:
+                    earlier_block[name] = _as_strings(earlier_block[name])
+
+                self._block_types[name] = 'object'
+
+        self._blocks.append(block)
+
+    def _conflicting_columns(self, block):
+        """
+        Names of the columns with inferred types in block that cannot be combined with the types
+        inferred in earlier blocks. Numeric types can be combined into one numeric column. Blocks
+        where the column only holds nulls do not take part, they are inferred as floats whatever
+        the type of the column.
+        """
+        conflicting = []
+        for name in self._columns:
+            if name in self._block_types or block[name].isnull().all():
+                continue
+
+            dtypes = self._inferred_dtypes.setdefault(name, set())
+            dtypes.add(block[name].dtype)
+            if len(dtypes) > 1 and not all(dtype.kind in 'iuf' for dtype in dtypes):
+                conflicting.append(name)
+
+        return conflicting
+
+    def close(self):
+        text = b''.join(self._pending)
+        self._pending = []
+        if text.strip() or self._columns is None:
+            self._parse_block(text)
+
+        blocks, self._blocks = self._blocks, []
+        if len(blocks) == 1:
+            return blocks[0]
+
+        # Categories must be the same in all blocks for the result to remain categorical
+        for name in self._columns:
+            if is_categorical_dtype(blocks[0][name]):
+                categories = union_categoricals([b[name] for b in blocks], ignore_order=True).categories
+                for block in blocks:
+                    block[name] = block[name].cat.set_categories(categories)
+
+        return pandas.concat(blocks, ignore_index=True)
@@ -0,0 +1,366 @@
+"""
+Secondary indexes on dataframe columns.
+
+Indexes are declared per column when a dataset is stored and map values to the positions of the
+rows holding them. Filters on an indexed column look up the matching rows rather than comparing
+every value of the column.
+
+- Hash indexes serve equality and in filters.
+- Sorted indexes, a permutation of the rows that orders the column, serve equality, in and range
+  filters using binary search. They also serve order_by on the column.
+
+Null values are never part of an index, like in the filters they never match a comparison.
+Indexes only apply to the frame they were built for and are dropped when the column is updated.
+Sorted indexes only hold the order of the rows, the values are read from the column when searching.
+
+Filters and ordering that an index could have served are counted per column, see IndexUsage, which
+makes it possible to build indexes automatically for columns that are scanned repeatedly.
+"""
+import operator
+import time
+from collections import Counter
+
+import numpy
+from pandas import Index, factorize, isnull
+from pandas.api.types import is_categorical_dtype
+
+from qcache.qframe.memory_usage import estimate_index_size
+
+HASH_INDEX = 'hash'
+SORTED_INDEX = 'sorted'
+INDEX_KINDS = (HASH_INDEX, SORTED_INDEX)
+
+_NUMERIC = 'numeric'
+_STRING = 'string'
+
+# Max fraction of the rows of a numeric column looked up through an index. Comparing numbers is
+# cheap enough for scanning the column to be faster than marking a large number of rows one by one.
+MAX_NUMERIC_FRACTION = 0.1
+
+
+# Side of the searched value that the rows matching a range comparison start or end at
+_RANGE_SIDES = {operator.lt: 'left', operator.le: 'right', operator.gt: 'right', operator.ge: 'left'}
+
+
+class IndexException(Exception):
+    pass
+
+
+def _positions_dtype(length):
+    return numpy.int32 if length <= numpy.iinfo(numpy.int32).max else numpy.int64
+
+
+def _value_type(values):
+    """
+    Type of the non null values, numeric or string, that the index is built on.
+    """
+    if values.dtype.kind in 'iuf':
+        return _NUMERIC
+
+    if values.dtype.kind == 'O' and all(isinstance(v, basestring) for v in values if v == v and v is not None):
+        return _STRING
+
+    return None
+
+
+def _key(value_type, value):
+    """
+    value as used to look up rows, None if it's not comparable to the indexed values in a way
+    that the index can answer.
+    """
+    if value_type == _NUMERIC:
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool) and value == value:
+            return value
+    elif isinstance(value, str):
+        return value
+    elif isinstance(value, unicode):
+        # Non ASCII unicode strings do not compare equal to the UTF-8 encoded strings
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+
+    return None
+
+
+def column_values(series, string_column=None):
+    """
+    The values of series as searched by sorted indexes, an array or a function from row position
+    to value.
+
+    :param string_column: The compact string column that series holds the positions in, if any.
+    """
+    if string_column is not None:
+        return string_column.value
+
+    if is_categorical_dtype(series):
+        categories, codes = series.values.categories.values, series.values.codes
+        return lambda position: categories[codes[position]]
+
+    return series.values
+
+
+def _search(values, order, key, side):
+    """
+    Position in order where key would be inserted to keep values ordered, see numpy.searchsorted.
+    """
+    if isinstance(values, numpy.ndarray):
+        if len(order) == len(values):
+            return numpy.searchsorted(values, key, side=side, sorter=order)
+
+        # The null values are not part of order, which numpy requires them to be
+        values = values.__getitem__
+
+    low, high = 0, len(order)
+    while low < high:
+        middle = (low + high) // 2
+        value = values(order[middle])
+        if value < key or (side == 'right' and value == key):
+            low = middle + 1
+        else:
+            high = middle
+
+    return low
+
+
+class _ColumnIndex(object):
+    def __init__(self, value_type, row_count):
+        self.value_type = value_type
+        self.row_count = row_count
+
+    def _rows(self, rows):
+        # The rows if looking them up is faster than scanning, None otherwise
+        if self.value_type == _NUMERIC and len(rows) > MAX_NUMERIC_FRACTION * self.row_count:
+            return None
+
+        return rows
+
+    def serves(self, kind):
+        """
+        True if the index serves lookups that require an index of kind.
+        """
+        return kind == HASH_INDEX or self.kind == SORTED_INDEX
+
+    def keys(self, values):
+        """
+        values as used to look up rows, None if any of them cannot be looked up in the index.
+        """
+        keys = [_key(self.value_type, v) for v in values]
+        return None if any(k is None for k in keys) else keys
+
+
+class HashIndex(_ColumnIndex):
+    kind = HASH_INDEX
+
+    def __init__(self, values, value_type):
+        super(HashIndex, self).__init__(value_type, len(values))
+        codes, uniques = factorize(values)
+        self._uniques = Index(uniques, dtype=object if value_type == _STRING else None)
+
+        # The positions of the rows grouped by value, nulls (code -1) first
+        self._order = numpy.argsort(codes, kind='mergesort').astype(_positions_dtype(len(values)))
+        counts = numpy.bincount(codes + 1, minlength=len(uniques) + 1)
+        self._starts = numpy.cumsum(counts)
+
+        # Build the hash table up front to have its memory counted
+        self._uniques.get_indexer(self._uniques[:1])
+
+    @property
+    def nbytes(self):
+        return estimate_index_size(self._uniques) + self._order.nbytes + self._starts.nbytes
+
+    def equal_rows(self, column, values):
+        """
+        :param column: The indexed column, see column_values.
+        :return: Positions of the rows equal to any of values, None if the index cannot answer.
+        """
+        keys = self.keys(values)
+        if keys is None:
+            return None
+
+        try:
+            codes = numpy.unique(self._uniques.get_indexer(keys))
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+        return self._rows(numpy.concatenate(
+            [self._order[0:0]] + [self._order[self._starts[c]:self._starts[c + 1]] for c in codes if c >= 0]))
+
+    def range_rows(self, column, op_fn, value):
+        return None
+
+
+class SortedIndex(_ColumnIndex):
+    kind = SORTED_INDEX
+
+    def __init__(self, values, value_type):
+        super(SortedIndex, self).__init__(value_type, len(values))
+        nulls = isnull(values)
+        positions = numpy.flatnonzero(~nulls)
+        try:
+            order = positions[numpy.argsort(values[positions], kind='mergesort')]
+            ordered_values = values[order]
+            run_starts = numpy.ones(len(order), dtype=bool)
+            run_starts[1:] = ordered_values[1:] != ordered_values[:-1]
+        except (TypeError, UnicodeDecodeError):
+            raise IndexException('Values cannot be ordered')
+
+        self._nulls = numpy.flatnonzero(nulls).astype(_positions_dtype(len(values)))
+        self._order = order.astype(_positions_dtype(len(values)))
+
+        # Where runs of equal values start in order, one bit per row
+        self._run_starts = numpy.packbits(run_starts)
+
+    @property
+    def nbytes(self):
+        return self._order.nbytes + self._nulls.nbytes + self._run_starts.nbytes
+
+    def equal_rows(self, column, values):
+        keys = self.keys(values)
+        if keys is None:
+            return None
+
+        try:
+            ranges = [(_search(column, self._order, k, 'left'), _search(column, self._order, k, 'right'))
+                      for k in set(keys)]
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+        return self._rows(numpy.concatenate([self._order[0:0]] + [self._order[start:end] for start, end in ranges]))
+
+    def range_rows(self, column, op_fn, value):
+        """
+        :param column: The indexed column, see column_values.
+        :return: Positions of the rows where op_fn(row value, value) is true, None if the index cannot answer.
+        """
+        key = _key(self.value_type, value)
+        if key is None or op_fn not in _RANGE_SIDES:
+            return None
+
+        try:
+            end = _search(column, self._order, key, _RANGE_SIDES[op_fn])
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+        return self._rows(self._order[:end] if op_fn in (operator.lt, operator.le) else self._order[end:])
+
+    def _descending_order(self):
+        # The runs of equal values in reverse, rows within a run remain ordered by position
+        row_count = len(self._order)
+        run_starts = numpy.unpackbits(self._run_starts)[:row_count].astype(bool)
+        runs = numpy.cumsum(run_starts) - 1
+        starts = numpy.flatnonzero(run_starts)
+        ends = numpy.append(starts[1:], row_count)
+        order = numpy.empty_like(self._order)
+        order[row_count - ends[runs] + numpy.arange(row_count) - starts[runs]] = self._order
+        return order
+
+    def ordered_rows(self, ascending):
+        """
+        Positions of all rows ordered by the column, null values last. Rows with equal values are
+        ordered by position, like a stable sort.
+        """
+        return numpy.concatenate([self._order if ascending else self._descending_order(), self._nulls])
+
+
+_INDEX_CLASSES = {HASH_INDEX: HashIndex, SORTED_INDEX: SortedIndex}
+
+
+def build_index(series, kind):
+    """
+    Build an index of the given kind on the values of series. Raises IndexException if the
+    kind is unknown or the values cannot be indexed.
+    """
+    if kind not in _INDEX_CLASSES:
+        raise IndexException('Unknown index kind "{kind}"'.format(kind=kind))
+
+    if is_categorical_dtype(series):
+        values = numpy.asarray(series, dtype=object)
+    else:
+        values = series.values
+
+    value_type = _value_type(values)
+    if value_type is None:
+        raise IndexException('Columns of type {dtype} cannot be indexed'.format(dtype=series.dtype))
+
+    return _INDEX_CLASSES[kind](values, value_type)
+
+
+class IndexUsage(object):
+    """
+    Lookups on the columns of a frame, served by an index or not, used to build indexes automatically
+    for columns that are scanned repeatedly and to drop them again when they are no longer used.
+    Updated by the threads executing queries, counts may be lost when they update it concurrently.
+    """
+    def __init__(self):
+        # Number of lookups scanning the column per (column name, kind of index required)
+        self.scans = Counter()
+
+        # Time of the last lookup served by the index per column name
+        self.last_used = {}
+
+        # Time when the index was built per column name of automatically built indexes
+        self.automatic = {}
+
+        # (column name, kind) that should not be indexed automatically again
+        self.excluded = set()
+
+    def record(self, name, kind, served):
+        if served:
+            self.last_used[name] = time.time()
+        else:
+            self.scans[(name, kind)] += 1
+
+    def candidates(self, min_scans):
+        """
+        :return: List of (scan count, column name, kind) with at least min_scans scans, most scanned first.
+        """
+        return sorted(((count, name, kind) for (name, kind), count in self.scans.items()
+                       if count >= min_scans and (name, kind) not in self.excluded), reverse=True)
+
+    def built(self, name):
+        self.automatic[name] = time.time()
+        self.forget(name)
+
+    def is_cold(self, name, max_age):
+        """
+        True if the automatically built index of name has not been used for max_age seconds.
+        """
+        return time.time() - self.last_used.get(name, self.automatic[name]) > max_age
+
+    def exclude(self, name, kind):
+        self.excluded.add((name, kind))
+        self.forget(name)
+
+    def dropped(self, name, kind):
+        self.automatic.pop(name, None)
+        if name not in self.last_used:
+            # Never used, the lookups counted cannot be served by an index
+            self.exclude(name, kind)
+        else:
+            self.forget(name)
+
+    def modified(self, name):
+        """
+        The values of name have been modified and its index, if any, dropped.
+        """
+        self.automatic.pop(name, None)
+        self.forget(name)
+
+    def forget(self, name):
+        """
+        Forget the lookups on name, when the column has been indexed or its values modified.
+        """
+        for key in [k for k in self.scans.keys() if k[0] == name]:
+            del self.scans[key]
+
+        self.last_used.pop(name, None)
+
+
+def rows_mask(rows, row_count):
+    """
+    Boolean array of length row_count that is True at the positions rows.
+    """
+    mask = numpy.zeros(row_count, dtype=bool)
+    mask[rows] = True
+    return mask
@@ -0,0 +1,65 @@
+"""
+Fast estimation of the memory used by dataframes.
+
+pandas memory_usage(deep=True) calls sys.getsizeof() for every value in object columns, for
+large frames that can take as long as parsing the data did. Here the size of object columns
+is instead estimated from a random sample of the values. The size of all other
+columns is exact and computed without looking at the values.
+"""
+import sys
+
+import numpy
+from pandas.api.types import is_categorical_dtype, is_object_dtype
+
+# Object arrays with at most this many values are measured exactly
+SAMPLE_SIZE = 1000
+
+# Random rather than evenly spaced samples to not be fooled by periodic data
+_random = numpy.random.RandomState(0)
+
+
+def _objects_size(values, sample_size):
+    """
+    Size of the objects referred to from the object array values.
+    """
+    if len(values) <= sample_size:
+        return sum(map(sys.getsizeof, values))
+
+    sample = values[_random.randint(0, len(values), sample_size)]
+    return int(sum(map(sys.getsizeof, sample)) * len(values) / float(len(sample)))
+
+
+def _index_size(index, sample_size):
+    # Includes the size of the hash table of the index when it has been created
+    size = index.memory_usage()
+    if is_object_dtype(index):
+        size += _objects_size(index.values, sample_size)
+
+    return size
+
+
+def _series_size(series, sample_size):
+    if is_categorical_dtype(series):
+        categorical = series.values
+        return categorical.codes.nbytes + _index_size(categorical.categories, sample_size)
+
+    if is_object_dtype(series):
+        return series.values.nbytes + _objects_size(series.values, sample_size)
+
+    return series.values.nbytes
+
+
+def estimate_index_size(index, sample_size=SAMPLE_SIZE):
+    """
+    Estimate of the number of bytes used by the pandas Index index, including its hash table.
+    """
+    return _index_size(index, sample_size)
+
+
+def estimate_byte_size(df, sample_size=SAMPLE_SIZE):
+    """
+    Estimate of the number of bytes used by df, including its index and the objects referred
+    to from object columns. Equal to df.memory_usage(index=True, deep=True).sum() when no object
+    column holds more than sample_size values.
+    """
+    return _index_size(df.index, sample_size) + sum(_series_size(series, sample_size) for _, series in df.iteritems())
@@ -0,0 +1,87 @@
+"""
+Optimization of the types that dataframe columns are stored as.
+
+Integer columns are downcast to the smallest integer type that holds all values and string columns
+with few distinct values are turned into categoricals. Float columns are left as they are, values
+that survive a round trip to float32 may still compare differently to float64 query arguments.
+
+The types are only meant for storage. Queries restore the original types of the columns as soon as
+the rows have been filtered so that arithmetic, aggregation and ordering give the same results as
+without optimization.
+"""
+import numpy
+from pandas import Categorical, factorize, to_numeric
+from pandas.api.types import is_object_dtype
+
+
+def _downcast(series):
+    downcast = to_numeric(series, downcast='integer')
+    return downcast if downcast.dtype.itemsize < series.dtype.itemsize else None
+
+
+def _categorize(series, category_threshold):
+    codes, uniques = factorize(series.values)
+    if len(uniques) >= category_threshold * len(series):
+        return None
+
+    if not all(isinstance(value, basestring) for value in uniques):
+        return None
+
+    return Categorical.from_codes(codes, uniques)
+
+
+def optimize_types(df, category_threshold=0.5, skip_columns=()):
+    """
+    Store the columns of df in more compact types, df is modified in place.
+
+    :param category_threshold: Max number of distinct values, as a fraction of the number of rows, for
+                               a string column to be turned into a categorical.
+    :param skip_columns: Names of columns that should keep their types.
+    :return: Dict with the original type names of the optimized columns.
+    """
+    original_types = {}
+    if not len(df) or not df.columns.is_unique:
+        return original_types
+
+    for name, series in df.iteritems():
+        if name in skip_columns:
+            continue
+
+        if series.dtype.kind == 'i':
+            values = _downcast(series)
+        elif is_object_dtype(series):
+            values = _categorize(series, category_threshold)
+        else:
+            values = None
+
+        if values is not None:
+            original_types[name] = series.dtype.name
+            df[name] = values
+
+    return original_types
+
+
+def restore_types(df, original_types, columns=None, inplace=False):
+    """
+    Convert optimized columns of df back to their original types.
+
+    :param columns: Names of the columns to convert, None = all optimized columns.
+    :param inplace: Modify df rather than returning a new frame. The data of df is never modified
+                    if not inplace.
+    :return: The frame with the converted columns and the names of the converted columns.
+    """
+    if not original_types:
+        return df, []
+
+    names = [name for name in (original_types if columns is None else columns)
+             if name in original_types and name in df and df[name].dtype != original_types[name]]
+    if not names:
+        return df, names
+
+    if not inplace:
+        df = df.copy(deep=False)
+
+    for name in names:
+        df[name] = numpy.asarray(df[name], dtype=original_types[name])
+
+    return df, names
@@ -1,78 +1,204 @@
+"""
+Compilation of where clauses into functions that filter dataframes.
+
+All validation of the clause that does not depend on the filtered data, regex compilation
+and operator lookups are done once when the clause is compiled.
+"""
 from __future__ import unicode_literals
 
 import operator
+import re
 
 import numpy
+from pandas import Series
+from pandas.api.types import is_categorical_dtype
 
 from qcache.qframe.common import assert_list, raise_malformed, is_quoted, unquote, assert_len
 from qcache.qframe.constants import COMPARISON_OPERATORS
 from qcache.qframe.context import get_current_qframe
+from qcache.qframe.indexes import HASH_INDEX, SORTED_INDEX, column_values, rows_mask
+from qcache.qframe.strings import is_compact
 
 JOINING_OPERATORS = {'&': operator.and_,
                      '|': operator.or_}
 
+# Characters with a special meaning in (i)like patterns, which are regular expressions
+_PATTERN_CHARACTERS = set('.^$*+?{}[]\\|()')
+
+
+def _constant(value):
+    return lambda df: value
+
+
+def _categorical_map(series, fn, null_value):
+    """
+    Apply fn to the categories of series rather than to every value. Null values map to null_value.
+    """
+    categorical = series.values
+    mapped = numpy.append(numpy.asarray(fn(Series(categorical.categories)), dtype=bool), null_value)
+
+    # Code -1 refers to the last element, null_value
+    return Series(mapped.take(categorical.codes), index=series.index)
+
+
+def _is_optimized(df, column_name):
+    # Columns of the stored frame turned into categoricals to save memory are compared as the strings they hold
+    qframe = get_current_qframe()
+    return qframe is not None and df is qframe.df and column_name in qframe.original_types
+
+
+def _string_column(df, column_name):
+    """
+    The compact string column that column_name of df holds the positions in, None if the column holds values.
+    Only columns of the stored frame hold positions.
+    """
+    qframe = get_current_qframe()
+    if qframe is None or df is not qframe.df or not is_compact(df, column_name, qframe.string_columns):
+        return None
+
+    return qframe.string_columns[column_name]
+
+
+def _column_values(df, column_name):
+    column = df[column_name]
+    string_column = _string_column(df, column_name)
+    if string_column is None:
+        return column
+
+    return Series(string_column.take(column.values), index=column.index)
+
+
+def _indexed_rows(df, column_name, kind, lookup):
+    """
+    Positions of the rows of df found by lookup(index, column values) in the index of column_name.
+    None if df is not the indexed frame, the column has no index of the kind required or the index
+    cannot answer. Lookups that the column must be scanned for are recorded for automatic indexing.
+    """
+    qframe = get_current_qframe()
+    if qframe is None or df is not qframe.df or not isinstance(column_name, basestring) or column_name not in df:
+        return None
 
-def _leaf_node(df, q):
+    index = qframe.indexes.get(column_name)
+    rows = None
+    if index is not None and index.serves(kind):
+        rows = lookup(index, column_values(df[column_name], _string_column(df, column_name)))
+
+    qframe.index_usage.record(column_name, kind, served=rows is not None)
+    return rows
+
+
+def _rows_filter(df, rows, negate=False):
+    mask = rows_mask(rows, len(df))
+    return Series(~mask if negate else mask, index=df.index)
+
+
+def _object_values(series):
+    # Categoricals can only be compared to each other if they have the same categories
+    return series.astype(object) if is_categorical_dtype(series) else series
+
+
+def _compile_leaf_node(q):
     if isinstance(q, basestring):
         if is_quoted(q):
-            return q[1:-1].encode('utf-8')
+            return _constant(q[1:-1].encode('utf-8'))
 
-        try:
-            return df[q]
-        except KeyError:
-            raise_malformed("Unknown column", q)
+        def column(df):
+            try:
+                return _column_values(df, q)
+            except KeyError:
+                raise_malformed("Unknown column", q)
 
-    return q
+        return column
 
+    return _constant(q)
 
-def _bitwise_filter(df, q):
+
+def _compile_bitwise_filter(q):
     assert_len(q, 3)
     op, column, arg = q
     if not isinstance(arg, (int, long)):
         raise_malformed('Invalid argument type, must be an integer:'.format(t=type(arg)), q)
 
-    try:
-        series = df[column] & arg
-        if op == "any_bits":
-            return series > 0
-        return series == arg
-    except TypeError:
-        raise_malformed("Invalid column type, must be an integer", q)
+    def bitwise_filter(df):
+        try:
+            series = _column_values(df, column) & arg
+            if op == "any_bits":
+                return series > 0
+            return series == arg
+        except TypeError:
+            raise_malformed("Invalid column type, must be an integer", q)
+
+    return bitwise_filter
 
 
-def _not_filter(df, q):
+def _compile_not_filter(q):
     assert_len(q, 2, "! is a single arity operator, invalid number of arguments")
-    return ~_do_pandas_filter(df, q[1])
+    filter_fn = _compile(q[1])
+    return lambda df: ~filter_fn(df)
 
 
-def _isnull_filter(df, q):
+def _compile_isnull_filter(q):
     assert_len(q, 2, "isnull is a single arity operator, invalid number of arguments")
+    column = q[1]
+
+    def isnull_filter(df):
+        string_column = _string_column(df, column)
+        if string_column is not None:
+            return Series(string_column.isnull(df[column].values), index=df.index)
+
+        return df[column].isnull()
 
-    # Slightly hacky but the only way I've come up with so far.
-    return df[q[1]] != df[q[1]]
+    return isnull_filter
 
 
-def _comparison_filter(df, q):
+def _compile_comparison_filter(q):
     assert_len(q, 3)
     op, col_name, arg = q
-    return COMPARISON_OPERATORS[op](df[col_name], _do_pandas_filter(df, arg))
+    op_fn = COMPARISON_OPERATORS[op]
+    arg_fn = _compile(arg)
+
+    def comparison_filter(df):
+        arg_value = arg_fn(df)
+        if not isinstance(arg_value, Series):
+            if op_fn in (operator.eq, operator.ne):
+                rows = _indexed_rows(df, col_name, HASH_INDEX,
+                                     lambda index, column: index.equal_rows(column, [arg_value]))
+            else:
+                rows = _indexed_rows(df, col_name, SORTED_INDEX,
+                                     lambda index, column: index.range_rows(column, op_fn, arg_value))
+
+            if rows is not None:
+                return _rows_filter(df, rows, negate=op_fn is operator.ne)
+
+        string_column = _string_column(df, col_name)
+        if string_column is not None and not isinstance(arg_value, Series) and op_fn in (operator.eq, operator.ne):
+            equal = string_column.equals(df[col_name].values, arg_value)
+            return Series(equal if op_fn is operator.eq else ~equal, index=df.index)
+
+        column = _column_values(df, col_name)
+        if isinstance(arg_value, Series):
+            return op_fn(_object_values(column), _object_values(arg_value))
+
+        if is_categorical_dtype(column) and _is_optimized(df, col_name):
+            return _categorical_map(column, lambda values: op_fn(values, arg_value), op_fn is operator.ne)
 
+        return op_fn(column, arg_value)
 
-def _join_filter(df, q):
-    result = None
+    return comparison_filter
+
+
+def _compile_join_filter(q):
     if len(q) < 2:
         raise_malformed("Invalid number of arguments", q)
-    elif len(q) == 2:
-        # Conjunctions and disjunctions with only one clause are OK
-        result = _do_pandas_filter(df, q[1])
-    else:
-        result = reduce(lambda l, r: JOINING_OPERATORS[q[0]](l, _do_pandas_filter(df, r)),
-                        q[2:], _do_pandas_filter(df, q[1]))
 
-    return result
+    # Conjunctions and disjunctions with only one clause are OK
+    join_fn = JOINING_OPERATORS[q[0]]
+    first_fn = _compile(q[1])
+    other_fns = [_compile(clause) for clause in q[2:]]
+    return lambda df: reduce(lambda l, r: join_fn(l, r(df)), other_fns, first_fn(df))
 
 
-def prepare_in_clause(q):
+def _compile_in_filter(q):
     """
     The arguments to an in expression may be either a list of values or
     a sub query which is then executed to produce a list of values.
@@ -82,26 +208,79 @@ def prepare_in_clause(q):
 
     if isinstance(args, dict):
         # Sub query, circular dependency on query by nature so need to keep the import local
-        from qcache.qframe import query
-        current_qframe = get_current_qframe()
-        sub_df, _ = query(current_qframe.df, args)
-        try:
-            args = sub_df[col_name].values
-        except KeyError:
-            raise_malformed('Unknown column "{}"'.format(col_name), q)
+        from qcache.qframe.query import compile_query
+        sub_plan = compile_query(args)
+
+        def in_sub_query_filter(df):
+            sub_df, _ = sub_plan.execute(get_current_qframe().df)
+            try:
+                values = sub_df[col_name].values
+            except KeyError:
+                raise_malformed('Unknown column "{}"'.format(col_name), q)
+
+            rows = _indexed_rows(df, col_name, HASH_INDEX, lambda index, column: index.equal_rows(column, values))
+            if rows is not None:
+                return _rows_filter(df, rows)
+
+            return _column_values(df, col_name).isin(values)
+
+        return in_sub_query_filter
 
     if not isinstance(args, (list, numpy.ndarray)):
         raise_malformed("Second argument must be a list", q)
 
-    return col_name, args
+    def in_filter(df):
+        rows = _indexed_rows(df, col_name, HASH_INDEX, lambda index, column: index.equal_rows(column, args))
+        if rows is not None:
+            return _rows_filter(df, rows)
+
+        string_column = _string_column(df, col_name)
+        if string_column is not None:
+            # None matches null values, as for categoricals
+            positions = df[col_name].values
+            matches = string_column.isin(positions, args)
+            if any(v is None for v in args):
+                matches |= string_column.isnull(positions)
+
+            return Series(matches, index=df.index)
 
+        column = df[col_name]
+        if is_categorical_dtype(column):
+            return _categorical_map(column, lambda values: values.isin(args),
+                                    any(v is None for v in args))
 
-def _in_filter(df, q):
-    col_name, args = prepare_in_clause(q)
-    return df[col_name].isin(args)
+        return column.isin(args)
 
+    return in_filter
 
-def _like_filter(df, q):
+
+def _literal_match(op, raw_pattern):
+    """
+    Function matching the values of a compact string column against a like pattern without wildcards
+    other than a leading or trailing %, None for all other patterns.
+    """
+    prefix, suffix = raw_pattern.startswith('%'), raw_pattern.endswith('%')
+    body = raw_pattern[int(prefix):len(raw_pattern) - int(suffix)]
+    if op != 'like' or (prefix and suffix) or not body or '%' in body or _PATTERN_CHARACTERS.intersection(body):
+        return None
+
+    try:
+        body = body.encode('ascii')
+    except UnicodeEncodeError:
+        return None
+
+    if suffix:
+        return lambda string_column, positions: string_column.startswith(positions, body)
+
+    # Like the regular expressions, $ also matches before a trailing newline
+    if prefix:
+        return lambda string_column, positions: numpy.logical_or(string_column.endswith(positions, body),
+                                                                 string_column.endswith(positions, body + b'\n'))
+
+    return lambda string_column, positions: string_column.isin(positions, [body, body + b'\n'])
+
+
+def _compile_like_filter(q):
     assert_len(q, 3)
     op, column, raw_expr = q
 
@@ -121,38 +300,76 @@ def _like_filter(df, q):
         regexp = regexp[:-1]
 
     # 'like' is case sensitive, 'ilike' is case insensitive
-    case = op == 'like'
-
+    flags = 0 if op == 'like' else re.IGNORECASE
     try:
-        return df[column].str.contains(regexp, case=case, na=False)
-    except AttributeError:
-        raise_malformed("Invalid column type for (i)like", q)
+        pattern = re.compile(regexp, flags)
+    except re.error:
+        raise_malformed("Invalid pattern for (i)like", q)
 
+    def contains(series):
+        # The case flag is part of the compiled pattern
+        return series.str.contains(pattern, case=True, na=False)
 
-def _do_pandas_filter(df, q):
+    literal_match = _literal_match(op, unquote(raw_expr))
+
+    def like_filter(df):
+        try:
+            string_column = _string_column(df, column)
+            if string_column is not None:
+                positions = df[column].values
+                if literal_match is not None:
+                    return Series(literal_match(string_column, positions), index=df.index)
+
+                return Series(string_column.search(positions, pattern), index=df.index)
+
+            if is_categorical_dtype(df[column]):
+                return _categorical_map(df[column], contains, False)
+
+            return contains(_column_values(df, column))
+        except AttributeError:
+            raise_malformed("Invalid column type for (i)like", q)
+
+    return like_filter
+
+
+def _guarded(q, filter_fn):
+    """
+    Errors from applying filter_fn are reported in terms of the expression q it was compiled from.
+    """
+    def guarded_filter(df):
+        try:
+            return filter_fn(df)
+        except KeyError:
+            raise_malformed("Column is not defined", q)
+        except TypeError:
+            raise_malformed("Invalid type in argument", q)
+
+    return guarded_filter
+
+
+def _compile(q):
     if not isinstance(q, list):
-        return _leaf_node(df, q)
+        return _compile_leaf_node(q)
 
     if not q:
         raise_malformed("Empty expression not allowed", q)
 
-    result = None
     op = q[0]
     try:
         if op in ('any_bits', 'all_bits'):
-            result = _bitwise_filter(df, q)
+            filter_fn = _compile_bitwise_filter(q)
         elif op == "!":
-            result = _not_filter(df, q)
+            filter_fn = _compile_not_filter(q)
         elif op == "isnull":
-            result = _isnull_filter(df, q)
+            filter_fn = _compile_isnull_filter(q)
         elif op in COMPARISON_OPERATORS:
-            result = _comparison_filter(df, q)
+            filter_fn = _compile_comparison_filter(q)
         elif op in JOINING_OPERATORS:
-            result = _join_filter(df, q)
+            filter_fn = _compile_join_filter(q)
         elif op == 'in':
-            result = _in_filter(df, q)
+            filter_fn = _compile_in_filter(q)
         elif op in ('like', 'ilike'):
-            result = _like_filter(df, q)
+            filter_fn = _compile_like_filter(q)
         else:
             raise_malformed("Unknown operator", q)
     except KeyError:
@@ -160,12 +377,20 @@ def _do_pandas_filter(df, q):
     except TypeError:
         raise_malformed("Invalid type in argument", q)
 
-    return result
+    return _guarded(q, filter_fn)
 
 
-def pandas_filter(df, filter_q):
-    if filter_q:
-        assert_list('where', filter_q)
-        return df[_do_pandas_filter(df, filter_q)]
+def compile_filter(filter_q):
+    """
+    Compile a where clause into a function that takes a dataframe and returns the filtered dataframe.
+    """
+    if not filter_q:
+        return lambda df: df
+
+    assert_list('where', filter_q)
+    mask_fn = _compile(filter_q)
+    return lambda df: df[mask_fn(df)]
 
-    return df
+
+def pandas_filter(df, filter_q):
+    return compile_filter(filter_q)(df)
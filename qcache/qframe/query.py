@@ -1,10 +1,19 @@
 from __future__ import unicode_literals
+import copy
+import json
 import re
+import threading
+from collections import OrderedDict
 
-from pandas import DataFrame
+import numpy
+from pandas import DataFrame, RangeIndex
 from pandas.core.computation.ops import UndefinedVariableError
 from pandas.core.groupby import DataFrameGroupBy
-from qcache.qframe.pandas_filter import pandas_filter
+from qcache.qframe.context import get_current_qframe
+from qcache.qframe.indexes import SORTED_INDEX, rows_mask
+from qcache.qframe.optimize import restore_types
+from qcache.qframe.pandas_filter import compile_filter
+from qcache.qframe.strings import materialize
 from qcache.qframe.common import assert_list, assert_integer, raise_malformed, MalformedQueryException
 
 
@@ -19,17 +28,27 @@ CLAUSE_FROM = 'from'
 QUERY_CLAUSES = {CLAUSE_WHERE, CLAUSE_GROUP_BY, CLAUSE_DISTINCT, CLAUSE_SELECT,
                  CLAUSE_ORDER_BY, CLAUSE_OFFSET, CLAUSE_LIMIT, CLAUSE_FROM}
 
+# Max number of compiled query plans kept
+PLAN_CACHE_SIZE = 1000
 
-def _group_by(dataframe, group_by_q):
+# Min fraction of the rows of the queried frame to be ordered for a sorted index to be used,
+# ordering fewer rows is faster than going through all rows of the index
+MIN_INDEXED_ORDER_FRACTION = 1.0 / 16
+
+
+def _compile_group_by(group_by_q):
     if not group_by_q:
-        return dataframe
+        return None
 
     assert_list('group_by', group_by_q)
 
-    try:
-        return dataframe.groupby(group_by_q, as_index=False)
-    except KeyError:
-        raise_malformed('Group by column not in table', group_by_q)
+    def group_by(dataframe):
+        try:
+            return dataframe.groupby(group_by_q, as_index=False)
+        except KeyError:
+            raise_malformed('Group by column not in table', group_by_q)
+
+    return group_by
 
 
 def is_aggregate_function(expr):
@@ -97,8 +116,8 @@ def _build_eval_expression(expr):
     return expr
 
 
-def _alias(dataframe, expressions):
-    result_frame = dataframe
+def _compile_alias(expressions):
+    eval_expressions = []
     for expression in expressions:
         destination, source = expression[1], expression[2]
         if not isinstance(destination, basestring):
@@ -107,13 +126,20 @@ def _alias(dataframe, expressions):
         if not re.match(ALIAS_RE, destination):
             raise_malformed('Invalid alias, must match {alias}'.format(alias=ALIAS_STRING), expression)
 
-        eval_expr = _build_eval_expression(source)
-        try:
-            result_frame = result_frame.eval('{destination} = {expr}'.format(destination=destination, expr=eval_expr), inplace=False)
-        except (SyntaxError, ValueError):
-            raise_malformed('Unknown function in alias', source)
+        eval_expr = '{destination} = {expr}'.format(destination=destination, expr=_build_eval_expression(source))
+        eval_expressions.append((eval_expr, source))
+
+    def alias(dataframe):
+        result_frame = dataframe
+        for eval_expr, source in eval_expressions:
+            try:
+                result_frame = result_frame.eval(eval_expr, inplace=False)
+            except (SyntaxError, ValueError):
+                raise_malformed('Unknown function in alias', source)
+
+        return result_frame
 
-    return result_frame
+    return alias
 
 
 def classify_expressions(project_q):
@@ -130,43 +156,89 @@ def classify_expressions(project_q):
     return aggregate_functions, alias_expressions
 
 
-def _project(dataframe, project_q):
+def _count(dataframe):
+    return DataFrame.from_dict({'count': [len(dataframe)]})
+
+
+def _compile_project(project_q):
     if not project_q:
-        return dataframe
+        return None
 
     assert_list('project', project_q)
 
     if project_q == [['count']]:
         # Special case for count only, ~equal to SQL count(*)
-        return DataFrame.from_dict({'count': [len(dataframe)]})
+        return _count
 
     aggregate_fns, alias_expressions = classify_expressions(project_q)
 
     if aggregate_fns and alias_expressions:
         raise_malformed("Cannot mix aliasing and aggregation functions", project_q)
 
-    if isinstance(dataframe, DataFrameGroupBy):
-        dataframe = _aggregate(dataframe, project_q, aggregate_fns)
-    elif aggregate_fns:
-        return _aggregate_without_group_by(dataframe, project_q, aggregate_fns)
-    elif alias_expressions:
-        dataframe = _alias(dataframe, alias_expressions)
-    else:
-        # Nothing to do here
-        pass
-
+    alias = _compile_alias(alias_expressions) if alias_expressions else None
     columns = [e if type(e) is not list else e[1] for e in project_q]
 
-    try:
-        return dataframe[columns]
-    except KeyError:
-        missing_columns = set(columns) - set(dataframe.columns.values)
-        raise_malformed("Selected columns not in table", list(missing_columns))
+    def project(dataframe):
+        if isinstance(dataframe, DataFrameGroupBy):
+            dataframe = _aggregate(dataframe, project_q, aggregate_fns)
+        elif aggregate_fns:
+            return _aggregate_without_group_by(dataframe, project_q, aggregate_fns)
+        elif alias:
+            dataframe = alias(dataframe)
+
+        try:
+            return dataframe[columns]
+        except KeyError:
+            missing_columns = set(columns) - set(dataframe.columns.values)
+            raise_malformed("Selected columns not in table", list(missing_columns))
+
+    return project
 
 
-def _order_by(dataframe, order_q):
+def _indexed_order(dataframe, column, ascending):
+    """
+    dataframe ordered by column using a sorted index, None if there is no index to use. The rows of
+    dataframe must be rows of the indexed frame with unmodified values.
+    """
+    qframe = get_current_qframe()
+    if qframe is None or column not in dataframe:
+        return None
+
+    # The labels of the rows must be their positions in the indexed frame
+    index = qframe.df.index
+    if not (isinstance(index, RangeIndex) and index._start == 0 and index._step == 1):
+        return None
+
+    if len(dataframe) < MIN_INDEXED_ORDER_FRACTION * len(index):
+        return None
+
+    ordered_rows = getattr(qframe.indexes.get(column), 'ordered_rows', None)
+    if ordered_rows is None:
+        qframe.index_usage.record(column, SORTED_INDEX, served=False)
+        return None
+
+    if not dataframe.index.is_monotonic_increasing:
+        return None
+
+    qframe.index_usage.record(column, SORTED_INDEX, served=True)
+
+    rows = ordered_rows(ascending)
+    if len(dataframe) < len(index):
+        # Positions of the selected rows in dataframe, which holds them in the same order as the index
+        selected = rows_mask(dataframe.index.values, len(index))
+        rows = rows[selected[rows]]
+        return dataframe.take((numpy.cumsum(selected) - 1)[rows])
+
+    return dataframe.take(rows)
+
+
+def _compile_order_by(order_q, indexable):
+    """
+    :param indexable: The ordered rows and values are those of the queried frame, a sorted index of
+                      the column may be used when ordering by a single column.
+    """
     if not order_q:
-        return dataframe
+        return None
 
     assert_list('order_by', order_q)
     if not all(isinstance(c, basestring) for c in order_q):
@@ -174,37 +246,53 @@ def _order_by(dataframe, order_q):
 
     columns = [e[1:] if e.startswith('-') else e for e in order_q]
     ascending = [not e.startswith('-') for e in order_q]
+    indexable = indexable and len(columns) == 1
 
-    try:
-        return dataframe.sort_values(by=columns, ascending=ascending)
-    except KeyError:
-        raise_malformed("Order by column not in table", columns)
+    def order_by(dataframe):
+        ordered = _indexed_order(dataframe, columns[0], ascending[0]) if indexable else None
+        if ordered is not None:
+            return ordered
+
+        try:
+            # Stable, rows with equal values remain in the order of the frame like when ordered by an index
+            return dataframe.sort_values(by=columns, ascending=ascending, kind='mergesort')
+        except KeyError:
+            raise_malformed("Order by column not in table", columns)
 
+    return order_by
 
-def _do_slice(dataframe, offset, limit):
+
+def _compile_slice(offset, limit):
     if offset:
         assert_integer('offset', offset)
-        dataframe = dataframe[offset:]
 
     if limit:
         assert_integer('limit', limit)
-        dataframe = dataframe[:limit]
 
-    return dataframe
+    def do_slice(dataframe):
+        if offset:
+            dataframe = dataframe[offset:]
 
+        if limit:
+            dataframe = dataframe[:limit]
 
-def _distinct(dataframe, columns):
-    if columns is None:
         return dataframe
 
+    return do_slice
+
+
+def _compile_distinct(columns):
+    if columns is None:
+        return None
+
     args = {}
     if columns:
         args['subset'] = columns
 
-    return dataframe.drop_duplicates(**args)
+    return lambda dataframe: dataframe.drop_duplicates(**args)
 
 
-def query(dataframe, q):
+def _assert_query(q):
     if not isinstance(q, dict):
         raise MalformedQueryException('Query must be a dictionary, not "{q}"'.format(q=q))
 
@@ -213,16 +301,122 @@ def query(dataframe, q):
         raise MalformedQueryException('Unknown query clauses: {keys}'.format(
             keys=', '.join(key_set.difference(QUERY_CLAUSES))))
 
+
+def _is_indexable(q):
+    # Rows are neither grouped nor aggregated and no values are replaced by aliases
+    select_q = q.get(CLAUSE_SELECT)
+    if CLAUSE_FROM in q or q.get(CLAUSE_GROUP_BY):
+        return False
+
+    return not (isinstance(select_q, list) and any(type(e) is list for e in select_q))
+
+
+class QueryPlan(object):
+    """
+    Executable form of a query. The query is validated and everything that does not depend on
+    the queried data is prepared once when the plan is created. Plans are immutable and may be
+    executed concurrently in multiple threads.
+    """
+    def __init__(self, q):
+        _assert_query(q)
+
+        # Queries with equal filter keys filter a dataframe in the same way
+        self.filter_key = json.dumps([q.get(CLAUSE_FROM), q.get(CLAUSE_WHERE)], sort_keys=True)
+        self._from_plan = compile_query(q[CLAUSE_FROM]) if CLAUSE_FROM in q else None
+        self._filter = compile_filter(q.get(CLAUSE_WHERE))
+        self._stages = [stage for stage in (_compile_group_by(q.get(CLAUSE_GROUP_BY)),
+                                            _compile_distinct(q.get(CLAUSE_DISTINCT)),
+                                            _compile_project(q.get(CLAUSE_SELECT)),
+                                            _compile_order_by(q.get(CLAUSE_ORDER_BY), _is_indexable(q)))
+                        if stage is not None]
+        self._slice = _compile_slice(q.get(CLAUSE_OFFSET), q.get(CLAUSE_LIMIT))
+
+    def filter(self, dataframe):
+        if self._from_plan:
+            dataframe, _ = self._from_plan.execute(dataframe)
+
+        # Columns stored in optimized types are given back their original types, and compact
+        # string columns their strings, once the rows of the stored frame have been filtered. The
+        # remaining stages are not affected by the optimization. Frames produced by a from clause
+        # have already been converted, their columns may have other types than the stored ones.
+        qframe = get_current_qframe()
+        stored = qframe is not None and dataframe is qframe.df
+        filtered_df = self._filter(dataframe)
+        if stored:
+            filtered_df, _ = restore_types(filtered_df, qframe.original_types)
+            filtered_df, _ = materialize(filtered_df, qframe.string_columns)
+
+        return filtered_df
+
+    def post_filter(self, filtered_df):
+        """
+        :return: The result and the length of the result before slicing
+        """
+        ordered_df = filtered_df
+        for stage in self._stages:
+            ordered_df = stage(ordered_df)
+
+        return self._slice(ordered_df), len(ordered_df)
+
+    def execute(self, dataframe):
+        try:
+            return self.post_filter(self.filter(dataframe))
+        except UndefinedVariableError as e:
+            raise MalformedQueryException(str(e))
+
+
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+
+def compile_query(q):
+    """
+    Compile q into a QueryPlan. Plans are cached by the canonical JSON of the query.
+    """
     try:
-        if CLAUSE_FROM in q:
-            dataframe, _ = query(dataframe, q[CLAUSE_FROM])
-
-        filtered_df = pandas_filter(dataframe, q.get('where'))
-        grouped_df = _group_by(filtered_df, q.get('group_by'))
-        distinct_df = _distinct(grouped_df, q.get('distinct'))
-        projected_df = _project(distinct_df, q.get('select'))
-        ordered_df = _order_by(projected_df, q.get('order_by'))
-        sliced_df = _do_slice(ordered_df, q.get('offset'), q.get('limit'))
-        return sliced_df, len(ordered_df)
-    except UndefinedVariableError as e:
-        raise MalformedQueryException(str(e))
+        fingerprint = json.dumps(q, sort_keys=True)
+    except (TypeError, ValueError):
+        return QueryPlan(q)
+
+    with _plan_cache_lock:
+        plan = _plan_cache.pop(fingerprint, None)
+        if plan is not None:
+            _plan_cache[fingerprint] = plan
+            return plan
+
+    # The plan refers to parts of the query, copy it to not be affected by later changes to q
+    plan = QueryPlan(copy.deepcopy(q))
+    with _plan_cache_lock:
+        _plan_cache[fingerprint] = plan
+        if len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+
+    return plan
+
+
+def query(dataframe, q):
+    return compile_query(q).execute(dataframe)
+
+
+def query_many(dataframe, qs):
+    """
+    Execute a list of queries against the same dataframe. Queries with equal from and where
+    clauses share one filtering of the dataframe.
+
+    Returns a list with one (dataframe, unsliced length) tuple or MalformedQueryException per query.
+    """
+    filtered_dfs = {}
+    results = []
+    for q in qs:
+        try:
+            plan = compile_query(q)
+            if plan.filter_key not in filtered_dfs:
+                filtered_dfs[plan.filter_key] = plan.filter(dataframe)
+
+            results.append(plan.post_filter(filtered_dfs[plan.filter_key]))
+        except UndefinedVariableError as e:
+            results.append(MalformedQueryException(str(e)))
+        except MalformedQueryException as e:
+            results.append(e)
+
+    return results
@@ -0,0 +1,258 @@
+"""
+Compact storage of string columns.
+
+A string column is stored as one buffer with the UTF-8 encoded values back to back, an array with
+the offsets of the values in the buffer and, if any value is null, an array marking the null values.
+That is the same layout as plain string columns in the columnar format, which makes it possible to
+use the buffers of memory mapped files directly.
+
+Compact columns are kept outside of the pandas dataframe, which holds a column with the position of
+each row in the compact column in their place. Filtering the dataframe filters the positions and
+the string values are only created for the rows that remain. Equality, in and prefix/suffix like
+filters are evaluated directly on the buffer, one byte at the time for all rows that may still match.
+The bytes that match the fewest rows in a sample are compared first.
+"""
+import numpy
+
+# Number of rows used to estimate which bytes of a value rule out the most rows
+_SAMPLE_SIZE = 1000
+
+
+def _is_null(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def encode_strings(values):
+    """
+    :return: A tuple (offsets, data, nulls) for values, nulls is None if no value is null.
+             Raises TypeError for values that are neither strings nor null.
+    """
+    encoded = []
+    nulls = numpy.zeros(len(values), dtype=bool)
+    for i, value in enumerate(values):
+        if isinstance(value, str):
+            encoded.append(value)
+        elif isinstance(value, unicode):
+            encoded.append(value.encode('utf-8'))
+        elif _is_null(value):
+            encoded.append(b'')
+            nulls[i] = True
+        else:
+            raise TypeError(type(value).__name__)
+
+    offsets = numpy.zeros(len(values) + 1, dtype='<i8')
+    numpy.cumsum(numpy.fromiter((len(e) for e in encoded), dtype='<i8', count=len(encoded)), out=offsets[1:])
+    return offsets, b''.join(encoded), nulls if nulls.any() else None
+
+
+def _encoded(value):
+    """
+    value as stored in a string column, None if it can never be equal to a stored value.
+    """
+    if isinstance(value, str):
+        return value
+
+    if isinstance(value, unicode):
+        # Like for object columns only ASCII unicode strings compare equal to the stored strings
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+
+    return None
+
+
+class StringColumn(object):
+    __slots__ = ('data', 'offsets', 'nulls', '_bytes')
+
+    def __init__(self, data, offsets, nulls=None):
+        """
+        :param data: Buffer with the values, a string or any object supporting the buffer protocol.
+        :param offsets: Array of len + 1 int64 offsets of the values in data, starting at 0.
+        :param nulls: Boolean array that is True for null values, None if no value is null.
+        """
+        self.data = data
+        self.offsets = offsets
+        self.nulls = nulls
+        self._bytes = numpy.frombuffer(data, dtype=numpy.uint8) if len(data) else numpy.zeros(0, dtype=numpy.uint8)
+
+    @staticmethod
+    def from_values(values):
+        """
+        Raises TypeError if values contains anything but strings and nulls.
+        """
+        offsets, data, nulls = encode_strings(values)
+        return StringColumn(data, offsets, nulls)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return len(self._bytes) + self.offsets.nbytes + (self.nulls.nbytes if self.nulls is not None else 0)
+
+    def positions(self):
+        """
+        Positions of all rows, the column held in the dataframe in place of this column.
+        """
+        dtype = numpy.int32 if len(self) <= numpy.iinfo(numpy.int32).max else numpy.int64
+        return numpy.arange(len(self), dtype=dtype)
+
+    def take(self, positions):
+        """
+        Object array with the values, and NaN for null values, at positions.
+        """
+        starts = self.offsets[positions].tolist()
+        ends = self.offsets[positions + 1].tolist()
+        data = self.data
+        values = numpy.empty(len(starts), dtype=object)
+        values[:] = [data[start:end] for start, end in zip(starts, ends)]
+        if self.nulls is not None:
+            values[self.nulls[positions]] = numpy.nan
+
+        return values
+
+    def value(self, position):
+        """
+        The value at position, which must not be null.
+        """
+        return self.data[self.offsets[position]:self.offsets[position + 1]]
+
+    def isnull(self, positions):
+        if self.nulls is None:
+            return numpy.zeros(len(positions), dtype=bool)
+
+        return self.nulls[positions]
+
+    def _match(self, positions, candidates, starts, value):
+        """
+        :param candidates: Rows of positions, as a boolean array, that may match.
+        :param starts: Offsets in the buffer to compare value with for each row of positions.
+        :return: Boolean array, True for the rows where value is found at the start offset.
+        """
+        if self.nulls is not None:
+            candidates &= ~self.nulls[positions]
+
+        rows = numpy.flatnonzero(candidates)
+        starts = starts[rows]
+        for i, byte in self._comparison_order(starts, value):
+            if not len(rows):
+                break
+
+            matching = self._bytes[starts + i] == byte
+            rows, starts = rows[matching], starts[matching]
+
+        result = numpy.zeros(len(positions), dtype=bool)
+        result[rows] = True
+        return result
+
+    def _comparison_order(self, starts, value):
+        """
+        (index, byte) of value ordered by the fraction of a sample of the rows at starts that they match.
+        """
+        value = bytearray(value)
+        sample = starts[::max(len(starts) // _SAMPLE_SIZE, 1)]
+        if len(value) < 2 or len(sample) < 2:
+            return list(enumerate(value))
+
+        matches = [numpy.count_nonzero(self._bytes[sample + i] == byte) for i, byte in enumerate(value)]
+        return [(i, value[i]) for i in numpy.argsort(matches, kind='mergesort')]
+
+    def _lengths(self, positions):
+        return self.offsets[positions + 1] - self.offsets[positions]
+
+    def equals(self, positions, value):
+        return self.isin(positions, [value])
+
+    def isin(self, positions, values):
+        result = numpy.zeros(len(positions), dtype=bool)
+        values = set(_encoded(value) for value in values)
+        values.discard(None)
+        if values:
+            lengths, starts = self._lengths(positions), self.offsets[positions]
+            for value in values:
+                result |= self._match(positions, lengths == len(value), starts, value)
+
+        return result
+
+    def startswith(self, positions, prefix):
+        return self._match(positions, self._lengths(positions) >= len(prefix), self.offsets[positions], prefix)
+
+    def endswith(self, positions, suffix):
+        ends = self.offsets[positions + 1]
+        return self._match(positions, self._lengths(positions) >= len(suffix), ends - len(suffix), suffix)
+
+    def search(self, positions, pattern):
+        """
+        True for the rows where the compiled regular expression pattern matches anywhere in the value.
+        """
+        starts = self.offsets[positions].tolist()
+        ends = self.offsets[positions + 1].tolist()
+        data, search = self.data, pattern.search
+        result = numpy.fromiter((search(data[start:end]) is not None for start, end in zip(starts, ends)),
+                                dtype=bool, count=len(starts))
+        if self.nulls is not None:
+            result &= ~self.nulls[positions]
+
+        return result
+
+
+def compact_strings(df, skip_columns=()):
+    """
+    Store the string columns of df as StringColumns, df is modified in place to hold the positions
+    of the rows in the StringColumns in place of the strings. Columns with values that are neither
+    strings nor null are left as they are.
+
+    :param skip_columns: Names of columns that should keep their types.
+    :return: Dict with a StringColumn per compacted column.
+    """
+    string_columns = {}
+    if not len(df) or not df.columns.is_unique:
+        return string_columns
+
+    for name, series in df.iteritems():
+        if name in skip_columns or series.dtype.kind != 'O':
+            continue
+
+        try:
+            string_column = StringColumn.from_values(series.values)
+        except TypeError:
+            continue
+
+        string_columns[name] = string_column
+        df[name] = string_column.positions()
+
+    return string_columns
+
+
+def is_compact(df, name, string_columns):
+    """
+    True if the column name of df holds positions in string_columns rather than values.
+    """
+    return isinstance(name, basestring) and name in string_columns and name in df and df[name].dtype.kind in 'iu'
+
+
+def materialize(df, string_columns, columns=None, inplace=False):
+    """
+    Replace the positions of compact string columns of df with the strings.
+
+    :param columns: Names of the columns to replace, None = all compact columns.
+    :param inplace: Modify df rather than returning a new frame. The data of df is never modified
+                    if not inplace.
+    :return: The frame with the strings and the names of the replaced columns.
+    """
+    if not string_columns:
+        return df, []
+
+    names = [name for name in (string_columns if columns is None else columns)
+             if is_compact(df, name, string_columns)]
+    if not names:
+        return df, names
+
+    if not inplace:
+        df = df.copy(deep=False)
+
+    for name in names:
+        df[name] = string_columns[name].take(df[name].values)
+
+    return df, names
@@ -0,0 +1,101 @@
+"""
+Size bounded LRU cache of serialized query results.
+
+Results are keyed by dataset key, dataset version, the canonical JSON of the query and
+anything else in the request affecting the result. Compressed variants of a result are
+added to the cached entry as they are requested.
+"""
+import json
+from collections import OrderedDict
+
+from qcache.compression import ENCODINGS
+
+# Very rough estimate of the memory overhead of one entry
+ENTRY_OVERHEAD = 200
+
+
+def result_key(dataset_key, version, q, *variant):
+    """
+    Cache key of a query result. variant holds other request properties affecting the result.
+    """
+    return (dataset_key, version, json.dumps(q, sort_keys=True, separators=(',', ':'))) + variant
+
+
+class CachedResult(object):
+    __slots__ = ('unsliced_length', 'bodies')
+
+    def __init__(self, unsliced_length, body):
+        self.unsliced_length = unsliced_length
+        self.bodies = {None: body}
+
+    @property
+    def size(self):
+        return ENTRY_OVERHEAD + sum(len(b) for b in self.bodies.values())
+
+
+class ResultCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._keys_by_dataset = {}
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            # Move to most recently used
+            self._entries[key] = entry
+
+        return entry
+
+    def put(self, key, unsliced_length, body):
+        """
+        :return: The new entry. Entries larger than the cache are returned without being cached.
+        """
+        entry = CachedResult(unsliced_length, body)
+        if entry.size > self.max_size:
+            return entry
+
+        self._remove(key)
+        self._entries[key] = entry
+        self._keys_by_dataset.setdefault(key[0], set()).add(key)
+        self.size += entry.size
+        self._evict()
+        return entry
+
+    def body(self, key, entry, encoding):
+        """
+        The body of entry with encoding applied. Encoded bodies are kept in the entry.
+        """
+        if encoding not in entry.bodies:
+            size_before = entry.size
+            entry.bodies[encoding] = ENCODINGS[encoding][1](entry.bodies[None])
+            if key in self._entries:
+                self.size += entry.size - size_before
+                self._evict()
+
+        return entry.bodies[encoding]
+
+    def invalidate(self, dataset_key):
+        for key in self._keys_by_dataset.pop(dataset_key, ()):
+            self.size -= self._entries.pop(key).size
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+            self._keys_by_dataset[key[0]].discard(key)
+
+    def _evict(self):
+        while self.size > self.max_size:
+            key = next(iter(self._entries))
+            self._remove(key)
+            if not self._keys_by_dataset[key[0]]:
+                del self._keys_by_dataset[key[0]]
@@ -0,0 +1,422 @@
+"""
+Key sharded routing between a front listener and a number of worker processes.
+
+Each worker process runs an ordinary QCache application with its own DatasetCache
+listening on a loopback socket. The front listener owns the public port, terminates
+TLS and basic auth and forwards every dataset request to the worker that owns the
+hash slot of the dataset key. Request bodies are passed on to the worker as they are received.
+"""
+import json
+import multiprocessing
+import os
+import re
+import signal
+import zlib
+
+from tornado import gen, httputil
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.queues import Queue
+from tornado.web import RequestHandler, Application, url, HTTPError, stream_request_body
+
+from qcache.app import make_app, serve, http_auth, ssl_options, configure_auth, ResponseCode, batch_error
+from qcache.compression import decoded_body
+from qcache.statistics import merge_snapshots
+
+SLOT_COUNT = 16384
+WORKER_ADDRESS = '127.0.0.1'
+WORKER_REQUEST_TIMEOUT = 300.0
+WORKER_CHECK_INTERVAL = 1000
+
+# Max number of received chunks of a request body waiting to be sent to the worker
+BODY_QUEUE_SIZE = 16
+
+DATASET_KEY_PATTERN = r'[A-Za-z0-9\-_]+'
+_DATASET_KEY_RE = re.compile(DATASET_KEY_PATTERN + r'\Z')
+
+# Hop by hop headers and headers that are recalculated when forwarding
+_SKIPPED_HEADERS = {'Host', 'Content-Length', 'Transfer-Encoding', 'Connection', 'Keep-Alive', 'Date', 'Server'}
+
+
+def key_slot(dataset_key):
+    return (zlib.crc32(dataset_key) & 0xffffffff) % SLOT_COUNT
+
+
+class ShardMap(object):
+    """
+    Maps dataset keys to worker base URLs through a fixed number of hash slots.
+    """
+    def __init__(self, worker_urls):
+        self.worker_urls = list(worker_urls)
+
+    def worker_url(self, dataset_key):
+        return self.worker_urls[key_slot(dataset_key) % len(self.worker_urls)]
+
+
+def _forwarded_headers(headers):
+    # Headers may be repeated
+    forwarded = httputil.HTTPHeaders()
+    for name, value in headers.get_all():
+        if name not in _SKIPPED_HEADERS:
+            forwarded.add(name, value)
+
+    return forwarded
+
+
+# Markers of the end of a request body in a BodyStream
+_BODY_END = object()
+_BODY_ABORTED = object()
+
+
+class BodyStream(object):
+    """
+    Request body passed on to a worker while it's received from the client. Receiving more of the
+    body waits while BODY_QUEUE_SIZE chunks are waiting to be sent to the worker.
+    """
+    def __init__(self):
+        self._chunks = Queue(maxsize=BODY_QUEUE_SIZE)
+        self._ended = False
+
+    def put(self, chunk):
+        return self._chunks.put(chunk)
+
+    def end(self):
+        return self._chunks.put(_BODY_END)
+
+    def abort(self):
+        """
+        The client has gone away before sending the complete body.
+        """
+        return self._chunks.put(_BODY_ABORTED)
+
+    @gen.coroutine
+    def _get(self):
+        chunk = yield self._chunks.get()
+        self._ended = chunk is _BODY_END or chunk is _BODY_ABORTED
+        raise gen.Return(chunk)
+
+    @gen.coroutine
+    def produce(self, write):
+        """
+        body_producer of the request to the worker.
+        """
+        while True:
+            chunk = yield self._get()
+            if chunk is _BODY_END:
+                return
+
+            if chunk is _BODY_ABORTED:
+                # Makes the request to the worker fail rather than pass on a truncated body
+                raise IOError('Request body not completely received')
+
+            yield write(chunk)
+
+    @gen.coroutine
+    def discard(self):
+        """
+        Consume what remains of the body when it can no longer be sent to the worker.
+        """
+        while not self._ended:
+            yield self._get()
+
+
+class ForwardingMixin(object):
+    def forward(self, worker_url, method=None, body=None, headers=None, **kwargs):
+        request = HTTPRequest(worker_url + self.request.uri,
+                              method=method or self.request.method,
+                              body=body,
+                              headers=headers if headers is not None else _forwarded_headers(self.request.headers),
+                              decompress_response=False,
+                              request_timeout=WORKER_REQUEST_TIMEOUT,
+                              **kwargs)
+        return AsyncHTTPClient().fetch(request, raise_error=False)
+
+    def write_worker_unavailable(self, response):
+        self.set_status(ResponseCode.BAD_GATEWAY)
+        self.write(json.dumps({'error': 'Worker unavailable: {error}'.format(error=response.error)}))
+
+    def write_worker_headers(self, code, reason, headers):
+        self.set_status(code, reason)
+        for name, value in headers.get_all():
+            if name not in _SKIPPED_HEADERS:
+                self.set_header(name, value)
+
+
+@http_auth
+@stream_request_body
+class RoutingHandler(ForwardingMixin, RequestHandler):
+    """
+    Forwards dataset requests to the owning worker. The request body is streamed to the worker
+    as it's received from the client and the response to the client as it's received from the
+    worker.
+    """
+    def initialize(self, shard_map, max_body_size):
+        self.shard_map = shard_map
+        self.max_body_size = max_body_size
+        self.header_lines = []
+        self.headers_received = False
+        self.body_stream = None
+        self.routed = None
+
+    def prepare(self):
+        if self.request.method == 'POST':
+            # Other requests than dataset uploads are limited to the default body size of the server
+            if self.max_body_size:
+                self.request.connection.set_max_body_size(self.max_body_size)
+            self.body_stream = BodyStream()
+
+        dataset_key = self.path_args[0]
+        self.routed = self.route(dataset_key)
+
+    def data_received(self, chunk):
+        return self.body_stream.put(chunk)
+
+    def on_connection_close(self):
+        if self.body_stream is not None:
+            self.body_stream.abort()
+
+    def worker_header_received(self, line):
+        if line != '\r\n':
+            self.header_lines.append(line)
+            return
+
+        start_line = httputil.parse_response_start_line(self.header_lines[0])
+        headers = httputil.HTTPHeaders.parse(''.join(self.header_lines[1:]))
+        self.header_lines = []
+        if start_line.code == 100:
+            return
+
+        self.write_worker_headers(start_line.code, start_line.reason, headers)
+        self.headers_received = True
+
+    def worker_data_received(self, chunk):
+        self.write(chunk)
+        self.flush()
+
+    @gen.coroutine
+    def route(self, dataset_key):
+        response = yield self.forward(self.shard_map.worker_url(dataset_key),
+                                      body_producer=self.body_stream.produce if self.body_stream else None,
+                                      header_callback=self.worker_header_received,
+                                      streaming_callback=self.worker_data_received)
+
+        if self.body_stream is not None:
+            # The worker may have failed before the complete body was received
+            IOLoop.current().spawn_callback(self.body_stream.discard)
+
+        if response.code == 599 and not self.headers_received:
+            self.write_worker_unavailable(response)
+
+    def get(self, dataset_key, *_):
+        return self.routed
+
+    @gen.coroutine
+    def post(self, dataset_key, *_):
+        yield self.body_stream.end()
+        yield self.routed
+
+    def delete(self, dataset_key, *_):
+        return self.routed
+
+
+@http_auth
+class RouterBatchQueryHandler(ForwardingMixin, RequestHandler):
+    """
+    Splits a cross dataset batch of queries into one batch per worker and merges the
+    results of the workers back into the order of the original batch.
+    """
+    def initialize(self, shard_map):
+        self.shard_map = shard_map
+
+    @gen.coroutine
+    def post(self):
+        try:
+            batch = json.loads(decoded_body(self.request))
+        except ValueError:
+            raise HTTPError(ResponseCode.BAD_REQUEST, 'Could not load JSON')
+
+        if not isinstance(batch, list) or \
+                not all(isinstance(item, dict) and isinstance(item.get('dataset'), basestring) for item in batch):
+            raise HTTPError(ResponseCode.BAD_REQUEST, 'A list of objects with dataset and query is required')
+
+        for item in batch:
+            if not _DATASET_KEY_RE.match(item['dataset']):
+                raise HTTPError(ResponseCode.BAD_REQUEST, 'Invalid dataset key')
+
+        worker_positions = {}
+        for position, item in enumerate(batch):
+            worker_positions.setdefault(self.shard_map.worker_url(item['dataset']), []).append(position)
+
+        headers = _forwarded_headers(self.request.headers)
+        for name in ('Content-Encoding', 'Accept-Encoding'):
+            headers.pop(name, None)
+
+        responses = yield {worker_url: self.forward(worker_url, body=json.dumps([batch[p] for p in positions]),
+                                                    headers=headers)
+                           for worker_url, positions in worker_positions.items()}
+
+        results = [None] * len(batch)
+        for worker_url, response in responses.items():
+            positions = worker_positions[worker_url]
+            if response.code != ResponseCode.OK:
+                error = batch_error(ResponseCode.BAD_GATEWAY if response.code == 599 else response.code,
+                                    'Worker error: {error}'.format(error=response.error))
+                worker_results = [error] * len(positions)
+            else:
+                worker_results = [json.dumps(r) for r in json.loads(response.body)]
+
+            for position, result in zip(positions, worker_results):
+                results[position] = result
+
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write('[' + ','.join(results) + ']')
+
+
+@http_auth
+class RouterStatusHandler(RequestHandler):
+    def get(self):
+        self.write("OK")
+
+
+@http_auth
+class RouterStatisticsHandler(ForwardingMixin, RequestHandler):
+    def initialize(self, shard_map):
+        self.shard_map = shard_map
+
+    @gen.coroutine
+    def get(self):
+        responses = yield [self.forward(worker_url, headers={}) for worker_url in self.shard_map.worker_urls]
+        snapshots = [json.loads(r.body) for r in responses if r.code == ResponseCode.OK]
+
+        stats = merge_snapshots(snapshots)
+        stats['worker_count'] = len(self.shard_map.worker_urls)
+        stats['unavailable_worker_count'] = len(responses) - len(snapshots)
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write(json.dumps(stats))
+
+
+def make_router_app(worker_urls, url_prefix='/qcache', debug=False, basic_auth=None, max_body_size=None):
+    """
+    :param max_body_size: Max size of dataset uploads, None = the max body size of the server.
+    """
+    configure_auth(basic_auth)
+    shard_map = ShardMap(worker_urls)
+    return Application([
+                           url(r"{url_prefix}/dataset/({key})/?(q|qs)?".format(url_prefix=url_prefix,
+                                                                                key=DATASET_KEY_PATTERN),
+                               RoutingHandler,
+                               dict(shard_map=shard_map, max_body_size=max_body_size),
+                               name="dataset"),
+                           url(r"{url_prefix}/qs".format(url_prefix=url_prefix),
+                               RouterBatchQueryHandler,
+                               dict(shard_map=shard_map),
+                               name="batch_query"),
+                           url(r"{url_prefix}/status".format(url_prefix=url_prefix),
+                               RouterStatusHandler,
+                               dict(),
+                               name="status"),
+                           url(r"{url_prefix}/statistics".format(url_prefix=url_prefix),
+                               RouterStatisticsHandler,
+                               dict(shard_map=shard_map),
+                               name="statistics")
+                       ], debug=debug)
+
+
+def _serve_worker(sockets, app_args, max_buffer_size):
+    app = make_app(**app_args)
+    server = HTTPServer(app, max_buffer_size=max_buffer_size)
+    server.add_sockets(sockets)
+    serve(app)
+
+
+class WorkerPool(object):
+    """
+    Starts one process per worker, each serving a pre-bound loopback socket.
+    Workers that die are restarted with an empty cache on the same socket.
+    """
+    def __init__(self, worker_count, app_args, max_buffer_size):
+        self.app_args = app_args
+        self.max_buffer_size = max_buffer_size
+        self.sockets = [bind_sockets(0, address=WORKER_ADDRESS) for _ in range(worker_count)]
+        self.processes = [None] * worker_count
+
+    @property
+    def worker_urls(self):
+        return ['http://{address}:{port}'.format(address=WORKER_ADDRESS, port=s[0].getsockname()[1])
+                for s in self.sockets]
+
+    def _start_worker(self, ix):
+        app_args = dict(self.app_args)
+        for name in ('spill_dir', 'snapshot_dir'):
+            if app_args.get(name):
+                # Each worker manages its own files
+                app_args[name] = os.path.join(app_args[name], 'worker-{ix}'.format(ix=ix))
+
+        process = multiprocessing.Process(target=_serve_worker,
+                                          args=(self.sockets[ix], app_args, self.max_buffer_size))
+        process.daemon = True
+        process.start()
+        self.processes[ix] = process
+
+    def start(self):
+        for ix in range(len(self.sockets)):
+            self._start_worker(ix)
+
+    def restart_dead_workers(self):
+        for ix, process in enumerate(self.processes):
+            if not process.is_alive():
+                print "Worker {ix} exited with code {code}, restarting".format(ix=ix, code=process.exitcode)
+                self._start_worker(ix)
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+        # Let the workers save their snapshots
+        for process in self.processes:
+            process.join()
+
+
+def run(workers, port=8888, max_cache_size=1000000000, result_cache_size=0, rss_soft_limit=0, rss_hard_limit=0,
+        spill_size=0, auto_index_size=100000000, debug=False, certfile=None, cafile=None, basic_auth=None,
+        **worker_args):
+    """
+    Start a router on port and the given number of worker processes. worker_args are passed to the
+    application of each worker.
+    """
+    if basic_auth and not certfile:
+        print "TLS must be enabled to use basic auth!"
+        return
+
+    # The cache sizes and memory limits are shared evenly between the workers
+    worker_cache_size = max_cache_size // workers
+    print("Starting router on port {port} with {workers} workers, max cache size {worker_cache_size} bytes per worker,"
+          " {worker_args}, debug={debug},".format(
+        port=port, workers=workers, worker_cache_size=worker_cache_size, debug=debug,
+        worker_args=', '.join('{k} {v}'.format(k=k, v=v) for k, v in sorted(worker_args.items()))))
+
+    # The workers must be forked before any IOLoop is created in this process
+    worker_args.update(debug=debug, max_cache_size=worker_cache_size, result_cache_size=result_cache_size // workers,
+                       rss_soft_limit=rss_soft_limit // workers, rss_hard_limit=rss_hard_limit // workers,
+                       spill_size=spill_size // workers, auto_index_size=auto_index_size // workers)
+    pool = WorkerPool(workers, app_args=worker_args, max_buffer_size=worker_cache_size)
+    pool.start()
+
+    try:
+        AsyncHTTPClient.configure(None, max_clients=100 * workers, max_body_size=max_cache_size,
+                                  max_buffer_size=max_cache_size)
+        # Dataset uploads are streamed to the workers rather than buffered
+        app = make_router_app(pool.worker_urls, debug=debug, basic_auth=basic_auth, max_body_size=max_cache_size)
+        args = {}
+        args.update(ssl_options(certfile=certfile, cafile=cafile))
+        app.listen(port, **args)
+
+        io_loop = IOLoop.current()
+        signal.signal(signal.SIGTERM, lambda *_: io_loop.add_callback_from_signal(io_loop.stop))
+        PeriodicCallback(pool.restart_dead_workers, WORKER_CHECK_INTERVAL).start()
+        io_loop.start()
+    finally:
+        pool.stop()
@@ -0,0 +1,229 @@
+"""
+Snapshots of the cached datasets on disk to survive restarts.
+
+A snapshot is a directory with one file per dataset in the columnar format and a manifest listing
+the datasets and their metadata. Datasets that have not been modified since the previous snapshot
+are not written again. The manifest is replaced atomically after all dataset files have been
+written, a snapshot interrupted half way leaves the previous one intact.
+
+When starting with an existing snapshot the manifest is read but the datasets are only memory
+mapped back into the cache when they are first queried.
+"""
+import glob
+import json
+import os
+import time
+
+from tornado.ioloop import PeriodicCallback
+
+from qcache.qframe import QFrame
+from qcache.qframe.columnar import ColumnarFormatException, key_file_name, remove_file, write_columnar_file
+
+MANIFEST_NAME = 'manifest.json'
+SNAPSHOT_FILE_SUFFIX = '.qcol'
+_MANIFEST_FORMAT = 1
+
+
+class SnapshotFile(object):
+    __slots__ = ('name', 'size', 'expiry_time', 'original_types', 'version', 'string_columns', 'index_kinds')
+
+    def __init__(self, name, size, expiry_time, original_types=None, version=None, string_columns=None,
+                 index_kinds=None):
+        self.name = name
+        self.size = size
+        self.expiry_time = expiry_time
+        self.original_types = original_types or {}
+
+        # Names of the compact string columns
+        self.string_columns = string_columns or []
+
+        # Indexes are not written to disk, they are built again when the dataset is loaded
+        self.index_kinds = index_kinds or {}
+
+        # Version of the cached dataset that the file was written from, None if unknown
+        self.version = version
+
+
+class Snapshot(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+        # All datasets in the latest snapshot
+        self._files = {}
+
+        # Datasets in the snapshot that have not been loaded into memory
+        self._pending = set()
+        self._generation = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._read_manifest()
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_manifest(self):
+        try:
+            with open(self._path(MANIFEST_NAME), 'rb') as f:
+                manifest = json.load(f)
+
+            if manifest['format'] == _MANIFEST_FORMAT:
+                self._generation = manifest['generation']
+                now = time.time()
+                for dataset in manifest['datasets']:
+                    snapshot_file = SnapshotFile(dataset['file'], dataset['size'], dataset['expiry_time'],
+                                                 dataset.get('original_types'),
+                                                 string_columns=dataset.get('string_columns'),
+                                                 index_kinds=dataset.get('index_kinds'))
+                    if snapshot_file.expiry_time is not None and now > snapshot_file.expiry_time:
+                        continue
+
+                    if os.path.isfile(self._path(snapshot_file.name)):
+                        self._files[dataset['key']] = snapshot_file
+                        self._pending.add(dataset['key'])
+        except (IOError, OSError, KeyError, TypeError, ValueError):
+            # No snapshot or not readable, start with an empty cache
+            self._files = {}
+            self._pending = set()
+
+        self._remove_unreferenced_files()
+
+    def _remove_unreferenced_files(self):
+        referenced = set(self._path(f.name) for f in self._files.values())
+        for path in glob.glob(self._path('*' + SNAPSHOT_FILE_SUFFIX + '*')):
+            if path not in referenced:
+                remove_file(path)
+
+    def pop(self, key):
+        """
+        Map the dataset saved under key into memory. The file is kept until a later snapshot no
+        longer contains the dataset.
+
+        :return: A tuple (qframe, expiry time) or None if there is no valid dataset saved under key
+                 that has not already been loaded.
+        """
+        if key not in self._pending:
+            return None
+
+        self._pending.discard(key)
+        snapshot_file = self._files[key]
+        if snapshot_file.expiry_time is not None and time.time() > snapshot_file.expiry_time:
+            return None
+
+        try:
+            qframe = QFrame.map_columnar(self._path(snapshot_file.name), original_types=snapshot_file.original_types,
+                                         string_columns=snapshot_file.string_columns,
+                                         index_kinds=snapshot_file.index_kinds)
+            return qframe, snapshot_file.expiry_time
+        except (ColumnarFormatException, IOError, OSError):
+            return None
+
+    def discard(self, key):
+        """
+        Make sure that the dataset saved under key is never loaded, eg. because it has been replaced.
+        """
+        self._pending.discard(key)
+
+    def restored(self, key, version):
+        """
+        Record that the dataset loaded from the snapshot is cached as version, the file does not
+        have to be written again as long as the dataset is not modified.
+        """
+        if key in self._files:
+            self._files[key].version = version
+
+    def _write(self, key, qframe):
+        # Files from the previous snapshot are not overwritten since they are still referenced by its manifest
+        name = key_file_name(key, '-{generation}{suffix}'.format(generation=self._generation,
+                                                                 suffix=SNAPSHOT_FILE_SUFFIX))
+        size = write_columnar_file(qframe.df, self._path(name), string_columns=qframe.string_columns)
+        if size is None:
+            return None
+
+        return name, size
+
+    def save(self, dataset_cache):
+        """
+        Replace the snapshot with the datasets currently in dataset_cache and the datasets in the
+        snapshot that have not been loaded yet. Datasets with values that cannot be represented in
+        the columnar format are left out.
+
+        :return: Number of dataset files written.
+        """
+        self._generation += 1
+        files = {}
+        for key in self._pending:
+            files[key] = self._files[key]
+
+        written_count = 0
+        for key, item in dataset_cache.items():
+            if dataset_cache.has_expired(item):
+                continue
+
+            snapshot_file = self._files.get(key)
+            if snapshot_file is None or snapshot_file.version != item.version:
+                written = self._write(key, item.qframe)
+                if written is None:
+                    continue
+
+                name, size = written
+                snapshot_file = SnapshotFile(name, size, None, item.qframe.original_types, item.version,
+                                             list(item.qframe.string_columns),
+                                             item.qframe.declared_index_kinds)
+                written_count += 1
+
+            # The expiry time may have moved since the file was written if the age is sliding
+            snapshot_file.expiry_time = dataset_cache.expiry_time(item)
+            files[key] = snapshot_file
+
+        manifest = {'format': _MANIFEST_FORMAT,
+                    'generation': self._generation,
+                    'datasets': [{'key': key, 'file': f.name, 'size': f.size, 'expiry_time': f.expiry_time,
+                                  'original_types': f.original_types, 'string_columns': f.string_columns,
+                                  'index_kinds': f.index_kinds}
+                                 for key, f in files.items()]}
+        temp_path = self._path(MANIFEST_NAME + '.tmp')
+        with open(temp_path, 'wb') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self._path(MANIFEST_NAME))
+
+        self._files = files
+        self._remove_unreferenced_files()
+        return written_count
+
+
+class SnapshotWriter(object):
+    """
+    Saves snapshots of the dataset cache at an interval and when the server is shut down.
+    """
+    def __init__(self, dataset_cache, stats, interval=0):
+        """
+        :param interval: Seconds between snapshots, 0 = only when shut down.
+        """
+        self.dataset_cache = dataset_cache
+        self.stats = stats
+        self.interval = interval
+        self._callback = PeriodicCallback(self.save, interval * 1000) if interval else None
+
+    def start(self):
+        if self._callback:
+            self._callback.start()
+
+    def stop(self):
+        if self._callback:
+            self._callback.stop()
+
+    def save(self):
+        t0 = time.time()
+        written_count = self.dataset_cache.snapshot.save(self.dataset_cache)
+        self.stats.inc('snapshot_write_count', count=written_count)
+        self.stats.append('snapshot_durations', time.time() - t0)
@@ -0,0 +1,114 @@
+"""
+Second cache tier on disk for datasets evicted from memory.
+
+Evicted datasets are written to files in the columnar format. When a spilled dataset is queried
+it's memory mapped back and moved to the memory tier again, which is a lot cheaper than having
+the client upload the dataset again. The disk tier has its own max size, the least recently
+spilled datasets are removed first.
+"""
+import glob
+import os
+import time
+from collections import OrderedDict
+
+from qcache.qframe import QFrame
+from qcache.qframe.columnar import ColumnarFormatException, key_file_name, remove_file, write_columnar_file
+
+SPILL_FILE_SUFFIX = '.qcol'
+
+
+class SpilledDataset(object):
+    __slots__ = ('path', 'size', 'expiry_time', 'original_types', 'string_columns', 'index_kinds')
+
+    def __init__(self, path, size, expiry_time, original_types, string_columns, index_kinds):
+        self.path = path
+        self.size = size
+        self.expiry_time = expiry_time
+        self.original_types = original_types
+
+        # Names of the compact string columns
+        self.string_columns = string_columns
+
+        # Indexes are not written to disk, they are built again when the dataset is restored
+        self.index_kinds = index_kinds
+
+
+class SpillCache(object):
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self._datasets = OrderedDict()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Left behind by a previous process, the datasets they hold may have been replaced since
+        for path in glob.glob(os.path.join(directory, '*' + SPILL_FILE_SUFFIX + '*')):
+            remove_file(path)
+
+    def __contains__(self, key):
+        return key in self._datasets
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key_file_name(key, SPILL_FILE_SUFFIX))
+
+    def put(self, key, qframe, expiry_time=None):
+        """
+        Write qframe to disk, replacing any dataset previously spilled under key.
+
+        :param expiry_time: Time after which the dataset should no longer be returned, None = never.
+        :return: True if the dataset was spilled, False if it's too large or contains values that
+                 cannot be represented in the columnar format.
+        """
+        self.discard(key)
+        path = self._path(key)
+        temp_path = path + '.tmp'
+        size = write_columnar_file(qframe.df, temp_path, string_columns=qframe.string_columns)
+        if size is None:
+            return False
+
+        if size > self.max_size:
+            remove_file(temp_path)
+            return False
+
+        os.rename(temp_path, path)
+        while self.size + size > self.max_size:
+            self.discard(next(iter(self._datasets)))
+
+        self._datasets[key] = SpilledDataset(path, size, expiry_time, qframe.original_types,
+                                             list(qframe.string_columns), qframe.declared_index_kinds)
+        self.size += size
+        return True
+
+    def pop(self, key):
+        """
+        Remove the dataset spilled under key from the disk tier and map it into memory.
+
+        :return: A tuple (qframe, expiry time) or None if there is no valid dataset spilled under key.
+        """
+        dataset = self._datasets.pop(key, None)
+        if dataset is None:
+            return None
+
+        self.size -= dataset.size
+        try:
+            if dataset.expiry_time is not None and time.time() > dataset.expiry_time:
+                return None
+
+            qframe = QFrame.map_columnar(dataset.path, original_types=dataset.original_types,
+                                         string_columns=dataset.string_columns, index_kinds=dataset.index_kinds)
+            return qframe, dataset.expiry_time
+        except (ColumnarFormatException, IOError, OSError):
+            return None
+        finally:
+            remove_file(dataset.path)
+
+    def discard(self, key):
+        dataset = self._datasets.pop(key, None)
+        if dataset is not None:
+            self.size -= dataset.size
+            remove_file(dataset.path)
@@ -46,3 +46,39 @@ class Statistics(object):
         del snapshot['since']
         self.reset()
         return snapshot
+
+
+# Statistics that describe the collection rather than being counters or samples
+_NON_ADDITIVE_STATISTICS = {'statistics_buffer_size', 'statistics_duration', 'hit_ratio', 'eviction_policy'}
+
+
+def add_hit_ratio(snapshot, eviction_policy):
+    """
+    Add the ratio of dataset lookups that were hits, and the eviction policy it was achieved with,
+    to snapshot if there were any lookups.
+    """
+    lookup_count = snapshot.get('hit_count', 0) + snapshot.get('miss_count', 0)
+    if lookup_count:
+        snapshot['hit_ratio'] = snapshot.get('hit_count', 0) / float(lookup_count)
+        snapshot['eviction_policy'] = eviction_policy
+
+
+def merge_snapshots(snapshots):
+    """
+    Merge statistics snapshots from several caches into one. Counters are summed,
+    sample buffers are concatenated. The hit ratio is recalculated from the merged counters.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for k, v in snapshot.items():
+            if isinstance(v, list):
+                merged.setdefault(k, []).extend(v)
+            elif k in _NON_ADDITIVE_STATISTICS:
+                merged[k] = max(merged.get(k, v), v)
+            else:
+                merged[k] = merged.get(k, 0) + v
+
+    if 'eviction_policy' in merged:
+        add_hit_ratio(merged, merged['eviction_policy'])
+
+    return merged
@@ -8,7 +8,8 @@ REQUIRES = [
     'numpy==1.13.3',
     'pandas==0.20.3',
     'tornado==5.1.1',
-    'lz4==2.1.6'
+    'lz4==2.1.6',
+    'futures==3.2.0'
 ]
 
 
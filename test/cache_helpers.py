@@ -0,0 +1,24 @@
+"""
+Helpers shared by the tests of the dataset cache and the memory management around it.
+"""
+
+
+class FakeQFrame(object):
+    def __init__(self, size):
+        self.size = size
+
+    def byte_size(self):
+        return self.size
+
+
+def item_size(qframe_size):
+    # Includes the estimated overhead of each cache item
+    return 100 + qframe_size
+
+
+class FakeRss(object):
+    def __init__(self, rss=1000):
+        self.rss = rss
+
+    def __call__(self):
+        return self.rss
@@ -0,0 +1,101 @@
+import pytest
+
+from qcache.admission import FrequencySketch, TinyLFUAdmission, make_admission
+from qcache.dataset_cache import DatasetCache
+from qcache.eviction import EVICTION_POLICIES
+
+from cache_helpers import FakeQFrame
+
+
+def test_sketch_estimates_frequency():
+    sketch = FrequencySketch(width=1024)
+    for _ in range(5):
+        sketch.increment('foo')
+    sketch.increment('bar')
+
+    assert sketch.estimate('foo') == 5
+    assert sketch.estimate('bar') == 1
+    assert sketch.estimate('baz') == 0
+
+
+def test_sketch_counters_saturate():
+    sketch = FrequencySketch(width=1024)
+    for _ in range(100):
+        sketch.increment('foo')
+
+    assert sketch.estimate('foo') == FrequencySketch.MAX_COUNT
+
+
+def test_sketch_frequencies_are_halved_after_sample_size_additions():
+    sketch = FrequencySketch(width=1024, sample_size=10)
+    for _ in range(8):
+        sketch.increment('foo')
+    sketch.increment('bar')
+    sketch.increment('bar')
+
+    assert sketch.estimate('foo') == 4
+    assert sketch.estimate('bar') == 1
+    assert sketch.additions == 5
+
+
+def test_tinylfu_admits_keys_more_frequent_than_all_victims():
+    admission = TinyLFUAdmission(FrequencySketch(width=1024))
+    for key in ['a', 'a', 'a', 'b', 'c', 'c']:
+        admission.record(key)
+
+    assert admission.admit('a', ['b', 'c'])
+    assert not admission.admit('c', ['a', 'b'])
+    assert not admission.admit('b', ['b'])
+    assert admission.admit('b', [])
+
+
+def test_unknown_admission_policy():
+    assert make_admission('none') is None
+    with pytest.raises(ValueError):
+        make_admission('lfu')
+
+
+def test_dataset_cache_admits_everything_without_admission_policy():
+    cache = DatasetCache(max_size=1000, max_age=0)
+    cache['a'] = FakeQFrame(800)
+
+    assert cache.admit('b', 800)
+
+
+def test_dataset_cache_compares_with_the_datasets_that_would_be_evicted():
+    cache = DatasetCache(max_size=1000, max_age=0, admission='tinylfu')
+    for key in ['a', 'b', 'c']:
+        cache[key] = FakeQFrame(200)
+
+    for key in ['a', 'a', 'b', 'd', 'd']:
+        cache.record_access(key)
+
+    # Fits without evictions
+    assert cache.has_room(100)
+    assert cache.admit('e', 100)
+
+    # Evicts a
+    assert not cache.admit('d', 200)
+
+    # Evicts c which has never been accessed
+    cache['a']
+    assert cache.admit('d', 200)
+
+
+@pytest.mark.parametrize("policy", sorted(EVICTION_POLICIES))
+def test_eviction_order_matches_victims(policy):
+    cache = DatasetCache(max_size=5000, max_age=0, eviction_policy=policy)
+    for key in range(10):
+        cache.ensure_free(400)
+        cache[key] = FakeQFrame(key * 10)
+        for _ in range(key % 3):
+            cache[key]
+
+    expected = list(cache._policy.eviction_order())
+    assert sorted(expected) == sorted(k for k in range(10) if k in cache)
+    victims = []
+    while len(cache):
+        victims.append(cache._policy.victim())
+        del cache[victims[-1]]
+
+    assert victims == expected
@@ -1,16 +1,29 @@
 # coding=utf-8
 import json
 import os
+import shutil
+import socket
+import tempfile
 
 import lz4 as lz4
+import lz4.frame
+import pandas
 import ssl
 
-from tornado.httputil import url_concat
-from tornado.testing import AsyncHTTPTestCase
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPHeaders, url_concat
+from tornado.iostream import IOStream
+from tornado.testing import AsyncHTTPTestCase, bind_unused_port
 from freezegun import freeze_time
 
 import qcache
 import qcache.app as app
+import qcache.router as router
+from qcache.dataset_cache import DatasetCache
+from qcache.qframe import QFrame
+from qcache.qframe.columnar import from_columnar, to_columnar
+from qcache.snapshot import Snapshot
 import csv
 from StringIO import StringIO
 
@@ -74,6 +87,21 @@ class SharedTest(AsyncHTTPTestCase):
         body = to_csv(data)
         return self.fetch(url, method='POST', body=body, headers=headers, use_gzip=False)
 
+    def post_columnar(self, url, df, extra_headers=None):
+        headers = {'Content-Type': 'application/x-qcache-columnar'}
+        if extra_headers:
+            headers.update(extra_headers)
+
+        body = b''.join(to_columnar(df))
+        return self.fetch(url, method='POST', body=body, headers=headers, use_gzip=False)
+
+    def query_columnar(self, url, query, extra_headers=None):
+        url = url_concat(url, {'q': json.dumps(query)})
+        headers = {'Accept': 'application/x-qcache-columnar'}
+        if extra_headers:
+            headers.update(extra_headers)
+        return self.fetch(url, headers=headers, use_gzip=False)
+
     def query_csv(self, url, query):
         url = url_concat(url, {'q': json.dumps(query)})
         return self.fetch(url, headers={'Accept': 'text/csv, application/json'}, use_gzip=False)
@@ -157,6 +185,276 @@ class TestQueryWithPost(SharedTest):
         assert response.code == 200
 
 
+class TestUploadAndQuery(SharedTest):
+    def get_app(self):
+        return app.make_app(url_prefix='', debug=True, max_cache_size=2000)
+
+    def upload_and_query(self, key, upload, extra_headers=None):
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        if extra_headers:
+            headers.update(extra_headers)
+        return self.fetch('/dataset/{key}/q'.format(key=key), method='POST', body=to_json(upload), headers=headers)
+
+    def test_upload_columns_and_query(self):
+        response = self.upload_and_query('abc', {'dataset': {'foo': [1, 2], 'bar': ['aaa', u'bbå']},
+                                                 'query': {'where': ['==', 'foo', 2]}})
+
+        assert response.code == 200
+        assert json.loads(response.body) == [{'foo': 2, 'bar': u'bbå'}]
+
+    def test_upload_records_and_query(self):
+        response = self.upload_and_query('abc', {'dataset': [{'foo': 1, 'bar': 'aaa'}, {'foo': 2, 'bar': 'bbb'}],
+                                                 'query': {'where': ['==', 'bar', '"bbb"']}})
+
+        assert response.code == 200
+        assert response.headers['X-QCache-stored'] == 'true'
+        assert json.loads(response.body) == [{'foo': 2, 'bar': 'bbb'}]
+
+        # The dataset has been stored
+        assert json.loads(self.query_json('/dataset/abc', {'select': [['count']]}).body) == [{'count': 2}]
+        stats = self.get_statistics()
+        assert stats['store_count'] == 1
+
+        # The uploaded dataset is not looked up in the cache
+        assert stats['hit_count'] == 1
+        assert 'miss_count' not in stats
+
+    def test_upload_csv_and_query_with_types_and_stand_in_columns(self):
+        response = self.upload_and_query('abc', {'dataset': 'foo,bar\n1,2\n3,4\n',
+                                                 'query': {'where': ['==', 'foo', '"3"']}},
+                                         extra_headers={'X-QCache-types': 'foo=string',
+                                                        'X-QCache-stand-in-columns': 'baz=5'})
+
+        assert response.code == 200
+        assert json.loads(response.body) == [{'foo': '3', 'bar': 4, 'baz': 5}]
+
+    def test_update_of_stored_dataset_updates_its_size(self):
+        self.upload_and_query('abc', {'dataset': [{'foo': i, 'bar': 'a'} for i in range(10)]})
+        size = self.get_statistics()['cache_size']
+
+        response = self.upload_and_query('abc', {'dataset': [{'foo': i, 'bar': 'a'} for i in range(10)],
+                                                 'query': {'update': [['bar', '"{}"'.format('b' * 50)]],
+                                                           'where': ['<', 'foo', 5]}})
+        assert response.code == 200
+        assert self.get_statistics()['cache_size'] > size
+        assert json.loads(self.query_json('/dataset/abc', {'where': ['==', 'foo', 1], 'select': ['bar']}).body) == \
+            [{'bar': 'b' * 50}]
+
+    def test_upload_without_storing(self):
+        response = self.upload_and_query('abc', {'dataset': [{'foo': 1}], 'query': {}, 'store': False})
+
+        assert response.code == 200
+        assert response.headers['X-QCache-stored'] == 'false'
+        assert json.loads(response.body) == [{'foo': 1}]
+        assert self.query_json('/dataset/abc', {}).code == 404
+
+    def test_upload_replaces_existing_dataset(self):
+        assert self.post_json('/dataset/abc', [{'foo': 1}]).code == 201
+
+        response = self.upload_and_query('abc', {'dataset': [{'foo': 2}]})
+
+        assert json.loads(response.body) == [{'foo': 2}]
+        assert json.loads(self.query_json('/dataset/abc', {}).body) == [{'foo': 2}]
+        assert self.get_statistics()['replace_count'] == 1
+
+    def test_result_returned_for_dataset_too_large_to_be_cached(self):
+        dataset = [{'foo': i, 'bar': 'abcdefghijklmnopqrstuvwxyz'} for i in range(200)]
+        response = self.upload_and_query('abc', {'dataset': dataset, 'query': {'select': [['count']]}})
+
+        assert response.code == 200
+        assert response.headers['X-QCache-stored'] == 'false'
+        assert json.loads(response.body) == [{'count': 200}]
+        assert self.query_json('/dataset/abc', {}).code == 404
+
+    def test_other_datasets_are_evicted_to_make_room_for_upload(self):
+        assert self.post_json('/dataset/cba', [{'foo': i} for i in range(150)]).code == 201
+
+        response = self.upload_and_query('abc', {'dataset': [{'foo': i} for i in range(150)],
+                                                 'query': {'select': [['count']]}})
+
+        assert response.code == 200
+        assert json.loads(response.body) == [{'count': 150}]
+        assert self.query_json('/dataset/cba', {}).code == 404
+        assert self.get_statistics()['size_evict_count'] == 1
+
+    def test_invalid_dataset_is_400(self):
+        assert self.upload_and_query('abc', {'dataset': 1, 'query': {}}).code == 400
+        assert self.upload_and_query('abc', {'dataset': [1, 2], 'query': {}}).code == 400
+
+    def test_malformed_query_is_400(self):
+        assert self.upload_and_query('abc', {'dataset': [{'foo': 1}], 'query': {'blabb': []}}).code == 400
+
+
+class TestBatchQueries(SharedTest):
+    def post_batch(self, url, batch, extra_headers=None):
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        if extra_headers:
+            headers.update(extra_headers)
+        return self.fetch(url, method='POST', body=to_json(batch), headers=headers)
+
+    def setUp(self):
+        super(TestBatchQueries, self).setUp()
+        assert self.post_json('/dataset/abc', [{'foo': 1, 'bar': 10}, {'foo': 2, 'bar': 20}]).code == 201
+        assert self.post_json('/dataset/cba', [{'foo': 3, 'bar': 30}]).code == 201
+
+    def test_many_queries_against_one_dataset(self):
+        response = self.post_batch('/dataset/abc/qs', [{'where': ['==', 'foo', 1]},
+                                                       {'select': [['count']]},
+                                                       {'where': ['>', 'foo', 0], 'select': ['bar'], 'limit': 1}])
+
+        assert response.code == 200
+        assert json.loads(response.body) == [
+            {'status': 200, 'unsliced_length': 1, 'result': [{'foo': 1, 'bar': 10}]},
+            {'status': 200, 'unsliced_length': 1, 'result': [{'count': 2}]},
+            {'status': 200, 'unsliced_length': 2, 'result': [{'bar': 10}]}]
+
+    def test_malformed_query_only_fails_that_query(self):
+        response = self.post_batch('/dataset/abc/qs', [{'blabb': []}, {'where': ['==', 'foo', 2]}])
+
+        assert response.code == 200
+        results = json.loads(response.body)
+        assert results[0]['status'] == 400
+        assert 'blabb' in results[0]['error']
+        assert results[1]['result'] == [{'foo': 2, 'bar': 20}]
+
+    def test_missing_dataset_is_404(self):
+        assert self.post_batch('/dataset/xyz/qs', [{}]).code == 404
+
+    def test_queries_against_many_datasets(self):
+        response = self.post_batch('/qs', [{'dataset': 'abc', 'query': {'where': ['==', 'foo', 2]}},
+                                           {'dataset': 'xyz', 'query': {}},
+                                           {'dataset': 'cba', 'query': {'select': ['bar']}},
+                                           {'dataset': 'abc', 'query': {'select': [['count']]}}])
+
+        assert response.code == 200
+        assert json.loads(response.body) == [
+            {'status': 200, 'unsliced_length': 1, 'result': [{'foo': 2, 'bar': 20}]},
+            {'status': 404, 'error': 'Dataset not found'},
+            {'status': 200, 'unsliced_length': 1, 'result': [{'bar': 30}]},
+            {'status': 200, 'unsliced_length': 1, 'result': [{'count': 2}]}]
+
+        # One lookup per dataset
+        stats = self.get_statistics()
+        assert stats['hit_count'] == 2
+        assert stats['miss_count'] == 1
+        assert len(stats['batch_query_durations']) == 1
+
+    def test_stand_in_columns_apply_to_all_queries(self):
+        response = self.post_batch('/qs', [{'dataset': 'abc', 'query': {'select': ['baz'], 'limit': 1}},
+                                           {'dataset': 'cba', 'query': {'select': ['baz']}}],
+                                   extra_headers={'X-QCache-stand-in-columns': 'baz=5'})
+
+        assert [r['result'] for r in json.loads(response.body)] == [[{'baz': 5}], [{'baz': 5}]]
+
+    def test_compressed_batch(self):
+        response = self.fetch('/dataset/abc/qs', method='POST', body=lz4.frame.compress(to_json([{}])),
+                              headers={'Content-Type': 'application/json', 'Content-Encoding': 'lz4-frame'})
+
+        assert response.code == 200
+        assert json.loads(response.body)[0]['unsliced_length'] == 2
+
+    def test_invalid_batches_are_400(self):
+        assert self.post_batch('/dataset/abc/qs', {'where': ['==', 'foo', 1]}).code == 400
+        assert self.post_batch('/qs', [{'query': {}}]).code == 400
+        assert self.fetch('/qs', method='POST', body='[{').code == 400
+
+    def test_only_json_is_acceptable(self):
+        assert self.post_batch('/qs', [], extra_headers={'Accept': 'text/csv'}).code == 406
+
+    def test_get_against_batch_endpoint_is_not_allowed(self):
+        assert self.fetch('/dataset/abc/qs').code == 405
+
+
+class TestResultCache(SharedTest):
+    def get_app(self):
+        return app.make_app(url_prefix='', debug=True, result_cache_size=100000)
+
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        assert self.post_json('/dataset/abc', [{'foo': 1, 'bar': 10}, {'foo': 2, 'bar': 20}]).code == 201
+
+    def assert_result(self, query, expected, extra_headers=None):
+        response = self.query_json('/dataset/abc', query, extra_headers=extra_headers)
+        assert response.code == 200
+        assert json.loads(response.body) == expected
+        return response
+
+    def test_repeated_query_is_served_from_cache(self):
+        query = {'where': ['==', 'foo', 1], 'select': ['bar']}
+        self.assert_result(query, [{'bar': 10}])
+        response = self.assert_result({'select': ['bar'], 'where': ['==', 'foo', 1]}, [{'bar': 10}])
+
+        assert response.headers['X-QCache-unsliced-length'] == '1'
+        stats = self.get_statistics()
+        assert stats['result_cache_miss_count'] == 1
+        assert stats['result_cache_hit_count'] == 1
+        assert stats['hit_count'] == 2
+        assert stats['result_cache_size'] > 0
+
+    def test_compressed_results_are_cached(self):
+        for _ in range(2):
+            response = self.query_json('/dataset/abc', {}, extra_headers={'Accept-Encoding': 'lz4'})
+            assert response.headers['Content-Encoding'] == 'lz4'
+            assert json.loads(lz4.block.decompress(response.body)) == [{'foo': 1, 'bar': 10}, {'foo': 2, 'bar': 20}]
+
+        # Uncompressed from the same cache entry
+        self.assert_result({}, [{'foo': 1, 'bar': 10}, {'foo': 2, 'bar': 20}])
+        assert self.get_statistics()['result_cache_hit_count'] == 2
+
+    def test_csv_and_json_results_are_cached_separately(self):
+        self.assert_result({'select': ['foo']}, [{'foo': 1}, {'foo': 2}])
+        response = self.query_csv('/dataset/abc', {'select': ['foo']})
+
+        assert from_csv(response.body) == [{'foo': '1'}, {'foo': '2'}]
+
+    def test_replace_invalidates_results(self):
+        self.assert_result({}, [{'foo': 1, 'bar': 10}, {'foo': 2, 'bar': 20}])
+        self.post_json('/dataset/abc', [{'foo': 3, 'bar': 30}])
+
+        self.assert_result({}, [{'foo': 3, 'bar': 30}])
+        assert self.get_statistics()['result_cache_size'] > 0
+
+    def test_delete_invalidates_results(self):
+        self.assert_result({}, [{'foo': 1, 'bar': 10}, {'foo': 2, 'bar': 20}])
+        self.fetch('/dataset/abc', method='DELETE')
+
+        assert self.query_json('/dataset/abc', {}).code == 404
+        assert self.get_statistics()['result_cache_size'] == 0
+
+    def test_update_invalidates_results(self):
+        self.assert_result({'select': ['bar']}, [{'bar': 10}, {'bar': 20}])
+        response = self.fetch('/dataset/abc/q', method='POST', body=to_json({'update': [['bar', 11]],
+                                                                             'where': ['==', 'foo', 1]}))
+        assert response.code == 200
+
+        self.assert_result({'select': ['bar']}, [{'bar': 11}, {'bar': 20}])
+
+    def test_added_stand_in_columns_invalidate_results(self):
+        self.assert_result({'where': ['==', 'foo', 1]}, [{'foo': 1, 'bar': 10}])
+        self.assert_result({'where': ['==', 'foo', 1]}, [{'foo': 1, 'bar': 10, 'baz': 5}],
+                           extra_headers={'X-QCache-stand-in-columns': 'baz=5'})
+
+        # The stand in column is now part of the dataset
+        self.assert_result({'where': ['==', 'foo', 1]}, [{'foo': 1, 'bar': 10, 'baz': 5}])
+
+    def test_stand_in_columns_added_by_batch_query_invalidate_results(self):
+        self.assert_result({'where': ['==', 'foo', 1]}, [{'foo': 1, 'bar': 10}])
+        size = self.get_statistics()['cache_size']
+        response = self.fetch('/dataset/abc/qs', method='POST', body=to_json([{}]),
+                              headers={'Accept': 'application/json', 'Content-Type': 'application/json',
+                                       'X-QCache-stand-in-columns': 'baz=5'})
+        assert response.code == 200
+
+        self.assert_result({'where': ['==', 'foo', 1]}, [{'foo': 1, 'bar': 10, 'baz': 5}])
+        assert self.get_statistics()['cache_size'] > size
+
+    def test_malformed_query_is_not_cached(self):
+        for _ in range(2):
+            assert self.query_json('/dataset/abc', {'blabb': []}).code == 400
+
+        assert 'result_cache_hit_count' not in self.get_statistics()
+
+
 class TestSlicing(SharedTest):
     def test_unsliced_size_header_indicates_the_dataset_size_before_slicing_it(self):
         # This helps out in pagination of data
@@ -215,6 +513,102 @@ class TestCharacterEncoding(SharedTest):
         assert response.code == 415
 
 
+class TestJsonOrient(SharedTest):
+    def post_columns(self, url, data, orient='columns'):
+        return self.post_json(url, data, extra_headers={'Content-Type': 'application/json; orient=' + orient})
+
+    def test_upload_columns_query_records(self):
+        response = self.post_columns('/dataset/abc', {'foo': [1, 2, 3], 'bar': [u'åäö', None, 'x']})
+        assert response.code == 201
+
+        response = self.query_json('/dataset/abc', {'where': ['<', 'foo', 3]})
+        assert json.loads(response.body) == [{'foo': 1, 'bar': u'åäö'}, {'foo': 2, 'bar': None}]
+
+    def test_upload_columns_of_different_lengths(self):
+        assert self.post_columns('/dataset/abc', {'foo': [1, 2, 3], 'bar': [1]}).code == 400
+        assert self.post_columns('/dataset/abc', [{'foo': 1}]).code == 400
+
+    def test_upload_unsupported_orient(self):
+        assert self.post_columns('/dataset/abc', {'foo': [1]}, orient='index').code == 415
+
+    def test_query_orient(self):
+        self.post_json('/dataset/abc', [{'foo': 1, 'bar': 'x'}, {'foo': 2, 'bar': u'å'}])
+        query = {'select': ['foo', 'bar']}
+
+        response = self.query_json('/dataset/abc', query, extra_headers={'Accept': 'application/json; orient=columns'})
+        assert response.code == 200
+        assert response.headers['Content-Type'] == 'application/json; orient=columns; charset=utf-8'
+        assert json.loads(response.body) == {'foo': [1, 2], 'bar': ['x', u'å']}
+
+        response = self.query_json('/dataset/abc', query, extra_headers={'Accept': 'application/json;orient=split'})
+        assert json.loads(response.body) == {'columns': ['foo', 'bar'], 'data': [[1, 'x'], [2, u'å']]}
+
+        response = self.query_json('/dataset/abc', query, extra_headers={'Accept': 'application/json; orient=index'})
+        assert response.code == 406
+
+    def test_accept_quality(self):
+        self.post_json('/dataset/abc', [{'foo': 1}])
+
+        response = self.query_json('/dataset/abc', {}, extra_headers={'Accept': 'application/json;q=0.5, text/csv'})
+        assert response.headers['Content-Type'] == 'text/csv; charset=utf-8'
+
+        response = self.query_json('/dataset/abc', {}, extra_headers={'Accept': 'text/csv;q=0, application/json'})
+        assert response.headers['Content-Type'] == 'application/json; charset=utf-8'
+
+
+class TestColumnarFormat(SharedTest):
+    def test_upload_columnar_query_json(self):
+        df = pandas.DataFrame({'foo': [1, 2, 3],
+                               'bar': [u'åäö', None, 'abc'],
+                               'baz': pandas.Categorical(['x', 'y', 'x'])})
+        response = self.post_columnar('/dataset/abc', df)
+        assert response.code == 201
+
+        response = self.query_json('/dataset/abc', {'where': ['==', 'baz', '"x"'], 'select': ['foo', 'bar']})
+        assert response.code == 200
+        assert json.loads(response.body) == [{'foo': 1, 'bar': u'åäö'}, {'foo': 3, 'bar': 'abc'}]
+
+    def test_upload_columnar_with_stand_in_columns(self):
+        response = self.post_columnar('/dataset/abc', pandas.DataFrame({'foo': [1, 2]}),
+                                      extra_headers={'X-QCache-stand-in-columns': 'bar=13'})
+        assert response.code == 201
+
+        response = self.query_json('/dataset/abc', {'where': ['==', 'bar', 13]})
+        assert json.loads(response.body) == [{'foo': 1, 'bar': 13}, {'foo': 2, 'bar': 13}]
+
+    def test_update_columnar_upload(self):
+        self.post_columnar('/dataset/abc', pandas.DataFrame({'foo': [1, 2, 3], 'bar': [1.5, 2.5, 3.5]}))
+
+        response = self.query_json('/dataset/abc', {'update': [['bar', 0.5]], 'where': ['>', 'foo', 1]})
+        assert response.code == 200
+
+        response = self.query_json('/dataset/abc', {'select': ['bar']})
+        assert json.loads(response.body) == [{'bar': 1.5}, {'bar': 0.5}, {'bar': 0.5}]
+
+    def test_upload_invalid_columnar_data(self):
+        response = self.fetch('/dataset/abc', method='POST', body='foo,bar\n1,2',
+                              headers={'Content-Type': 'application/x-qcache-columnar'})
+        assert response.code == 400
+        assert self.query_json('/dataset/abc', {}).code == 404
+
+    def test_query_columnar(self):
+        self.post_json('/dataset/abc', [{'foo': 1, 'bar': u'åäö'}, {'foo': 2, 'bar': None}, {'foo': 3, 'bar': 'x'}])
+
+        response = self.query_columnar('/dataset/abc', {'where': ['>', 'foo', 1], 'order_by': ['-foo']})
+        assert response.code == 200
+        assert response.headers['Content-Type'] == 'application/x-qcache-columnar'
+        assert response.headers['X-QCache-unsliced-length'] == '2'
+
+        df = from_columnar(response.body)
+        assert list(df['foo']) == [3, 2]
+        assert df['bar'][0] == 'x'
+        assert pandas.isnull(df['bar'][1])
+
+    def test_query_columnar_result_not_representable(self):
+        self.post_json('/dataset/abc', [{'foo': 1}, {'foo': 'abc'}])
+        assert self.query_columnar('/dataset/abc', {}).code == 406
+
+
 class TestInvalidQueries(SharedTest):
     def setUp(self):
         super(TestInvalidQueries, self).setUp()
@@ -369,7 +763,9 @@ class TestCacheEvictionOnSize(SharedTest):
         stats = self.get_statistics()
         assert stats['dataset_count'] == 1
         assert stats['size_evict_count'] == repetitions - 1
-        assert stats['cache_size'] == 370
+
+        # Includes the stand in column added by the query
+        assert stats['cache_size'] == 482
 
 
 class TestCacheEvictionOnAge(SharedTest):
@@ -388,6 +784,41 @@ class TestCacheEvictionOnAge(SharedTest):
         with freeze_time('2015-10-22 00:00:06'):
             assert self.query_json('/dataset/abc', {}).code == 404
 
+    def test_ttl_per_dataset(self):
+        with freeze_time('2015-10-22 00:00:00'):
+            assert self.post_json('/dataset/short', [{'foo': 1}], extra_headers={'X-QCache-ttl': '2'}).code == 201
+            assert self.post_json('/dataset/forever', [{'foo': 1}], extra_headers={'X-QCache-ttl': '0'}).code == 201
+
+        with freeze_time('2015-10-22 00:00:03'):
+            assert self.query_json('/dataset/short', {}).code == 404
+
+        with freeze_time('2015-10-22 01:00:00'):
+            assert self.query_json('/dataset/forever', {}).code == 200
+
+    def test_invalid_ttl(self):
+        for ttl in ('abc', '-1'):
+            response = self.post_json('/dataset/abc', [{'foo': 1}], extra_headers={'X-QCache-ttl': ttl})
+            assert response.code == 400
+            assert self.query_json('/dataset/abc', {}).code == 404
+
+
+class TestCacheEvictionOnSlidingAge(SharedTest):
+    def get_app(self):
+        return app.make_app(url_prefix='', max_age=5, sliding_age=True, debug=True)
+
+    def test_age_is_refreshed_by_queries(self):
+        with freeze_time('2015-10-22 00:00:00'):
+            self.post_json('/dataset/abc', [{'foo': 1}])
+
+        with freeze_time('2015-10-22 00:00:04'):
+            assert self.query_json('/dataset/abc', {}).code == 200
+
+        with freeze_time('2015-10-22 00:00:08'):
+            assert self.query_json('/dataset/abc', {}).code == 200
+
+        with freeze_time('2015-10-22 00:00:14'):
+            assert self.query_json('/dataset/abc', {}).code == 404
+
 
 class TestStatusEndpoint(SharedTest):
     def test_status_endpoint_returns_200_ok(self):
@@ -427,8 +858,7 @@ class TestColumnTyping(SharedTest):
         assert not self.get({'where': ['==', 'another_key', 2222]})
 
     def test_type_hinting_with_invalid_type_results_in_bad_request(self):
-        # It's currently only possible to type hint strings and enums.
-        # Is there ever a need for other type hints?
+        # Integer types must be given with their size
 
         data = [{'some_key': '123456', 'another_key': 1111}]
         response = self.post_csv('/dataset/abc', data, types={'another_key': 'int'})
@@ -483,6 +913,36 @@ class TestColumnTyping(SharedTest):
         assert result == [{'some_key': 12.0}]
         assert type(result[0]['some_key']) == float
 
+    def test_type_hinting_with_sized_integers_and_bool(self):
+        data = [{'flags': 5, 'count': 65535, 'active': 'true'},
+                {'flags': 2, 'count': 0, 'active': 'False'}]
+        response = self.post_csv('/dataset/abc', data, types={'flags': 'int8', 'count': 'uint16', 'active': 'bool'})
+        assert response.code == 201
+
+        assert self.get({'where': ['any_bits', 'flags', 4]}) == [{'flags': 5, 'count': 65535, 'active': True}]
+        assert self.get({'where': ['==', 'active', False], 'select': ['count']}) == [{'count': 0}]
+
+    def test_type_hinting_with_datetime(self):
+        data = [{'day': '2017/01/02'}, {'day': '2017/03/04'}]
+        response = self.post_csv('/dataset/abc', data, types={'day': 'datetime:%Y/%m/%d'})
+        assert response.code == 201
+
+        response = self.query_csv('/dataset/abc', {'where': ['>', 'day', '"2017-02-01"']})
+        assert response.body == 'day\n2017-03-04\n'
+
+    def test_type_hinting_json_records(self):
+        response = self.post_json('/dataset/abc', [{'some_key': 1.0}, {'some_key': 2.0}],
+                                  extra_headers={'X-QCache-types': 'some_key=int32'})
+        assert response.code == 201
+        assert self.get({'where': ['==', 'some_key', 2]}) == [{'some_key': 2}]
+
+    def test_values_not_representable_in_hinted_type_results_in_bad_request(self):
+        assert self.post_csv('/dataset/abc', [{'some_key': 1000}], types={'some_key': 'int8'}).code == 400
+        assert self.post_csv('/dataset/abc', [{'some_key': 'x'}], types={'some_key': 'datetime'}).code == 400
+        response = self.post_json('/dataset/abc', [{'some_key': -1}],
+                                  extra_headers={'X-QCache-types': 'some_key=uint8'})
+        assert response.code == 400
+
 
 class TestStandInColumns(SharedTest):
     def test_stand_in_column_with_numeric_value(self):
@@ -500,6 +960,14 @@ class TestStandInColumns(SharedTest):
         assert response.code == 200
         assert json.loads(response.body) == []
 
+    def test_stand_in_columns_are_included_in_cache_size(self):
+        assert self.post_json('/dataset/cba', [{'baz': 1, 'bar': 10}]).code == 201
+        size = self.get_statistics()['cache_size']
+
+        response = self.query_json('/dataset/cba', {}, extra_headers={'X-QCache-stand-in-columns': 'foo=13'})
+        assert response.code == 200
+        assert self.get_statistics()['cache_size'] == size + 8
+
     def test_stand_in_column_with_string_value(self):
         response = self.post_csv('/dataset/cba', [{'baz': 1, 'bar': 10}],
                                  extra_headers={'X-QCache-stand-in-columns': 'foo="13"'})
@@ -625,6 +1093,132 @@ class TestCompression(SharedTest):
         assert response.headers.get('Content-Encoding') is None
 
 
+class TestStreamingUpload(SharedTest):
+    def post_compressed_csv(self, encoding_fn, content_encoding, row_count=20000):
+        body = "foo,bar\n" + "".join("{i},bar{i}\n".format(i=i) for i in range(row_count))
+        headers = {'Content-Type': 'text/csv'}
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+
+        return self.fetch('/dataset/abc', method='POST', body=encoding_fn(body), headers=headers, use_gzip=False)
+
+    def assert_stored(self, row_count=20000):
+        response = self.query_json('/dataset/abc', {'select': [['count']]})
+        assert json.loads(response.body) == [{'count': row_count}]
+
+        response = self.query_json('/dataset/abc', {'where': ['==', 'bar', '"bar17"']})
+        assert json.loads(response.body) == [{'foo': 17, 'bar': 'bar17'}]
+
+    def test_upload_large_csv_in_multiple_chunks(self):
+        assert self.post_compressed_csv(lambda x: x, None, row_count=200000).code == 201
+        self.assert_stored(row_count=200000)
+
+    def test_upload_gzip_csv(self):
+        assert self.post_compressed_csv(qcache.compression.gzip_dumps, 'gzip').code == 201
+        self.assert_stored()
+
+    def test_upload_lz4_csv(self):
+        assert self.post_compressed_csv(lz4.block.compress, 'lz4').code == 201
+        self.assert_stored()
+
+    def test_upload_lz4_frame_csv(self):
+        assert self.post_compressed_csv(lz4.frame.compress, 'lz4-frame').code == 201
+        self.assert_stored()
+
+    def test_upload_corrupt_gzip_csv(self):
+        response = self.post_compressed_csv(lambda x: 'not gzip' + qcache.compression.gzip_dumps(x), 'gzip')
+        assert response.code == 500
+        assert self.query_json('/dataset/abc', {}).code == 404
+
+
+class TestStreamingResponses(SharedTest):
+    def get_app(self):
+        return app.make_app(url_prefix='', debug=True, response_batch_rows=10)
+
+    def setUp(self):
+        super(TestStreamingResponses, self).setUp()
+        self.data = [{'foo': i, 'bar': 'bar{i}'.format(i=i)} for i in range(25)]
+        assert self.post_json('/dataset/abc', self.data).code == 201
+
+    def test_json_result_in_multiple_batches(self):
+        response = self.query_json('/dataset/abc', {})
+
+        assert response.code == 200
+        assert json.loads(response.body) == self.data
+        assert response.headers['X-QCache-unsliced-length'] == '25'
+        assert 'Content-Length' not in response.headers
+
+    def test_csv_result_in_multiple_batches(self):
+        response = self.query_csv('/dataset/abc', {'order_by': ['-foo']})
+
+        assert response.code == 200
+        assert from_csv(response.body) == [{'foo': str(d['foo']), 'bar': d['bar']} for d in reversed(self.data)]
+
+    def test_small_result_in_one_batch(self):
+        response = self.query_json('/dataset/abc', {'limit': 10})
+
+        assert json.loads(response.body) == self.data[:10]
+        assert response.headers['Content-Length'] == str(len(response.body))
+
+    def assert_compressed_result(self, accept_encoding, expected_encoding, decoding_fn):
+        response = self.query_json('/dataset/abc', {}, extra_headers={'Accept-Encoding': accept_encoding})
+
+        assert response.code == 200
+        assert response.headers.get('Content-Encoding') == expected_encoding
+        assert json.loads(decoding_fn(response.body)) == self.data
+
+    def test_gzip_result_in_multiple_batches(self):
+        self.assert_compressed_result('gzip', 'gzip', qcache.compression.gzip_loads)
+
+    def test_lz4_frame_result_in_multiple_batches(self):
+        self.assert_compressed_result('lz4-frame', 'lz4-frame', lz4.frame.decompress)
+
+    def test_lz4_frame_preferred_over_gzip_in_multiple_batches(self):
+        self.assert_compressed_result('lz4,lz4-frame,gzip', 'lz4-frame', lz4.frame.decompress)
+
+    def test_gzip_used_when_lz4_frame_not_accepted(self):
+        self.assert_compressed_result('lz4,gzip', 'gzip', qcache.compression.gzip_loads)
+
+    def test_lz4_blocks_not_used_for_multiple_batches(self):
+        self.assert_compressed_result('lz4', None, lambda x: x)
+
+    def test_json_columns_result_in_multiple_batches(self):
+        response = self.query_json('/dataset/abc', {}, extra_headers={'Accept': 'application/json; orient=columns'})
+
+        assert response.code == 200
+        assert 'Content-Length' not in response.headers
+        assert json.loads(response.body) == {'foo': [d['foo'] for d in self.data], 'bar': [d['bar'] for d in self.data]}
+
+    def test_json_split_result_in_multiple_batches(self):
+        response = self.query_json('/dataset/abc', {'select': ['foo', 'bar']},
+                                   extra_headers={'Accept': 'application/json; orient=split'})
+
+        assert response.code == 200
+        assert 'Content-Length' not in response.headers
+        assert json.loads(response.body) == {'columns': ['foo', 'bar'],
+                                             'data': [[d['foo'], d['bar']] for d in self.data]}
+
+    def test_columnar_result_in_multiple_batches(self):
+        response = self.query_columnar('/dataset/abc', {}, extra_headers={'Accept-Encoding': 'gzip'})
+
+        assert response.code == 200
+        assert response.headers.get('Content-Encoding') == 'gzip'
+        assert 'Content-Length' not in response.headers
+        df = from_columnar(qcache.compression.gzip_loads(response.body))
+        assert df.to_dict(orient='records') == self.data
+
+    def test_result_streamed_through_router(self):
+        sock, port = bind_unused_port()
+        HTTPServer(self._app).add_sockets([sock])
+        self._app = router.make_router_app(['http://127.0.0.1:{port}'.format(port=port)], url_prefix='', debug=True)
+        self.http_server.request_callback = self._app
+
+        response = self.query_json('/dataset/abc', {}, extra_headers={'Accept-Encoding': 'gzip'})
+        assert response.code == 200
+        assert response.headers.get('Content-Encoding') == 'gzip'
+        assert json.loads(qcache.compression.gzip_loads(response.body)) == self.data
+
+
 class TestStatistics(SharedTest):
     def test_store_and_query_durations(self):
         assert self.post_json('/dataset/abc', [{'foo': 123}]).code == 201
@@ -641,6 +1235,402 @@ class TestStatistics(SharedTest):
         assert stats['store_durations'][0] < stats['store_request_durations'][0]
 
 
+class TestEvictionPolicy(SharedTest):
+    def get_app(self):
+        return app.make_app(url_prefix='', debug=True, eviction_policy='gdsf')
+
+    def test_hit_ratio_in_statistics(self):
+        assert self.post_json('/dataset/abc', [{'foo': 123}]).code == 201
+        assert self.query_json('/dataset/abc', query={}).code == 200
+        assert self.query_json('/dataset/abc', query={}).code == 200
+        assert self.query_json('/dataset/cba', query={}).code == 404
+
+        stats = self.get_statistics()
+        assert stats['hit_ratio'] == 2 / 3.0
+        assert stats['eviction_policy'] == 'gdsf'
+
+    def test_no_hit_ratio_without_lookups(self):
+        assert 'hit_ratio' not in self.get_statistics()
+
+
+class TestMemoryHardLimit(SharedTest):
+    def get_app(self):
+        return app.make_app(url_prefix='', debug=True, rss_hard_limit=1)
+
+    def test_stores_and_queries_are_rejected_above_hard_limit(self):
+        response = self.post_json('/dataset/abc', [{'foo': 1}])
+        assert response.code == 503
+        assert response.headers['Retry-After'] == '1'
+
+        response = self.fetch('/dataset/abc/q', method='POST', body=to_json({'dataset': [{'foo': 1}], 'query': {}}))
+        assert response.code == 503
+
+        response = self.fetch('/qs', method='POST', body=to_json([{'dataset': 'abc', 'query': {}}]))
+        assert response.code == 503
+
+        # Cheap requests are still served
+        assert self.query_json('/dataset/abc', {}).code == 404
+        assert self.fetch('/dataset/abc', method='DELETE').code == 200
+
+        stats = self.get_statistics()
+        assert stats['rss_reject_count'] == 3
+        assert stats['rss'] > 1
+
+
+class TestSpillToDisk(SharedTest):
+    def get_app(self):
+        self.spill_dir = tempfile.mkdtemp()
+        # Fits one of the datasets below
+        return app.make_app(url_prefix='', debug=True, max_cache_size=6000, spill_dir=self.spill_dir,
+                            spill_size=100000)
+
+    def tearDown(self):
+        super(TestSpillToDisk, self).tearDown()
+        shutil.rmtree(self.spill_dir)
+
+    def post_dataset(self, key):
+        return self.post_json('/dataset/' + key, [{'foo': i, 'bar': 'abc'} for i in range(100)])
+
+    def test_evicted_dataset_is_restored_from_disk(self):
+        assert self.post_dataset('abc').code == 201
+        assert self.post_dataset('def').code == 201
+
+        response = self.query_json('/dataset/abc', {'where': ['==', 'foo', 5]})
+        assert response.code == 200
+        assert json.loads(response.body) == [{'foo': 5, 'bar': 'abc'}]
+
+        stats = self.get_statistics()
+        assert stats['spill_restore_count'] == 1
+        assert stats['size_evict_count'] == 2
+        assert stats['spill_dataset_count'] == 1
+        assert stats['spill_size'] > 0
+
+    def test_deleted_dataset_is_removed_from_disk(self):
+        self.post_dataset('abc')
+        self.post_dataset('def')
+        assert self.fetch('/dataset/abc', method='DELETE').code == 200
+        assert self.query_json('/dataset/abc', {}).code == 404
+        assert self.get_statistics()['spill_dataset_count'] == 0
+
+
+class TestSnapshot(SharedTest):
+    def get_app(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        cache = DatasetCache(max_size=100000, max_age=0, snapshot_dir=self.snapshot_dir)
+        cache['abc'] = QFrame(pandas.DataFrame({'foo': [1, 2, 3]}))
+        cache.snapshot.save(cache)
+        return app.make_app(url_prefix='', debug=True, snapshot_dir=self.snapshot_dir)
+
+    def tearDown(self):
+        super(TestSnapshot, self).tearDown()
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_dataset_in_snapshot_is_loaded_when_queried(self):
+        assert self.get_statistics()['snapshot_pending_count'] == 1
+
+        response = self.query_json('/dataset/abc', {'where': ['>', 'foo', 1]})
+        assert response.code == 200
+        assert json.loads(response.body) == [{'foo': 2}, {'foo': 3}]
+
+        stats = self.get_statistics()
+        assert stats['snapshot_restore_count'] == 1
+        assert stats['snapshot_pending_count'] == 0
+
+    def test_snapshot_contains_uploaded_datasets(self):
+        self.post_json('/dataset/def', [{'foo': 1}])
+        self._app.settings['snapshot_writer'].save()
+
+        snapshot = Snapshot(self.snapshot_dir)
+        assert 'abc' in snapshot
+        assert 'def' in snapshot
+
+
+class TestOptimizeTypes(SharedTest):
+    def get_app(self):
+        return app.make_app(url_prefix='', debug=True, optimize_types=True)
+
+    def post_dataset(self, types=None):
+        data = [{'foo': i % 3, 'bar': ['aaa', 'bbb'][i % 2], 'baz': 'id{i}'.format(i=i)} for i in range(10)]
+        return self.post_csv('/dataset/abc', data, types=types)
+
+    def test_optimized_types_reported_on_upload(self):
+        response = self.post_dataset()
+        assert response.code == 201
+        assert response.headers['X-QCache-optimized-types'] == 'foo=int8; bar=enum'
+
+    def test_columns_with_given_types_are_not_optimized(self):
+        response = self.post_dataset(types={'bar': 'string'})
+        assert response.headers['X-QCache-optimized-types'] == 'foo=int8'
+
+    def test_query_results_unaffected_by_optimization(self):
+        self.post_dataset()
+
+        response = self.query_json('/dataset/abc', {'where': ['<', 'bar', '"bbb"'],
+                                                     'select': [['=', 'qux', ['*', 'foo', 1000]]],
+                                                     'order_by': ['-qux'], 'limit': 2})
+        assert json.loads(response.body) == [{'qux': 2000}, {'qux': 2000}]
+
+        response = self.query_json('/dataset/abc', {'group_by': ['bar'], 'select': ['bar', ['sum', 'foo']]})
+        assert json.loads(response.body) == [{'bar': 'aaa', 'foo': 5}, {'bar': 'bbb', 'foo': 4}]
+
+    def test_update_of_optimized_column(self):
+        self.post_dataset()
+        response = self.query_json('/dataset/abc', {'update': [['foo', 1000], ['bar', '"ccc"']],
+                                                    'where': ['==', 'baz', '"id0"']})
+        assert response.code == 200
+
+        response = self.query_json('/dataset/abc', {'where': ['==', 'foo', 1000]})
+        assert json.loads(response.body) == [{'foo': 1000, 'bar': 'ccc', 'baz': 'id0'}]
+
+
+class TestCompactStrings(SharedTest):
+    def get_app(self):
+        return app.make_app(url_prefix='', debug=True, optimize_types=True, compact_strings=True)
+
+    def post_dataset(self):
+        data = [{'foo': i % 3, 'bar': ['aaa', 'bbb'][i % 2], 'baz': 'id{i}'.format(i=i)} for i in range(10)]
+        return self.post_csv('/dataset/abc', data)
+
+    def test_query_results_unaffected_by_compact_strings(self):
+        self.post_dataset()
+
+        response = self.query_json('/dataset/abc', {'where': ['like', 'baz', '"id1%"'], 'select': ['baz', 'bar']})
+        assert json.loads(response.body) == [{'baz': 'id1', 'bar': 'bbb'}]
+
+        response = self.query_json('/dataset/abc', {'where': ['in', 'baz', ['id3', 'id4']], 'order_by': ['-baz'],
+                                                     'select': ['baz']}, extra_headers={'Accept': 'text/csv'})
+        assert response.body == 'baz\nid4\nid3\n'
+
+    def test_update_of_compact_string_column(self):
+        self.post_dataset()
+        response = self.query_json('/dataset/abc', {'update': [['baz', '"xxx"']], 'where': ['==', 'foo', 0]})
+        assert response.code == 200
+
+        response = self.query_json('/dataset/abc', {'where': ['==', 'baz', '"xxx"'], 'select': [['count']]})
+        assert json.loads(response.body) == [{'count': 4}]
+
+
+class TestIndexes(SharedTest):
+    def post_dataset(self, indexes):
+        data = [{'foo': i % 3, 'bar': 'id{i}'.format(i=i)} for i in range(10)]
+        return self.post_csv('/dataset/abc', data, extra_headers={'X-QCache-indexes': indexes})
+
+    def test_query_indexed_columns(self):
+        response = self.post_dataset('foo=sorted; bar=hash')
+        assert response.code == 201
+
+        response = self.query_json('/dataset/abc', {'where': ['in', 'bar', ['id3', 'id4']], 'select': ['bar']})
+        assert json.loads(response.body) == [{'bar': 'id3'}, {'bar': 'id4'}]
+
+        response = self.query_json('/dataset/abc', {'where': ['>', 'foo', 1], 'select': [['count']]})
+        assert json.loads(response.body) == [{'count': 3}]
+
+    def test_indexes_are_included_in_cache_size(self):
+        self.post_dataset('')
+        size = json.loads(self.fetch('/statistics').body)['cache_size']
+        self.post_dataset('bar=hash')
+        assert json.loads(self.fetch('/statistics').body)['cache_size'] > size
+
+    def test_invalid_index(self):
+        for indexes in ['foo', 'foo=btree', 'qux=hash']:
+            response = self.post_dataset(indexes)
+            assert response.code == 400
+            assert 'index' in response.body
+
+
+class TestTinyLFUAdmission(SharedTest):
+    def get_app(self):
+        # Fits two of the datasets below
+        return app.make_app(url_prefix='', debug=True, max_cache_size=2000, admission='tinylfu')
+
+    def post_dataset(self, key):
+        return self.post_json('/dataset/' + key, [{'foo': i} for i in range(100)])
+
+    def test_rarely_used_dataset_does_not_evict_frequently_used_dataset(self):
+        assert self.post_dataset('hot').headers['X-QCache-stored'] == 'true'
+        for _ in range(3):
+            assert self.query_json('/dataset/hot', {}).code == 200
+        assert self.post_dataset('cold1').headers['X-QCache-stored'] == 'true'
+
+        response = self.post_dataset('cold2')
+        assert response.code == 201
+        assert response.headers['X-QCache-stored'] == 'false'
+        assert self.query_json('/dataset/hot', {}).code == 200
+        assert self.query_json('/dataset/cold1', {}).code == 200
+        assert self.query_json('/dataset/cold2', {}).code == 404
+
+        # Once cold2 is requested more often than hot it's admitted
+        for _ in range(5):
+            assert self.query_json('/dataset/cold2', {}).code == 404
+
+        assert self.post_dataset('cold2').headers['X-QCache-stored'] == 'true'
+        assert self.query_json('/dataset/cold2', {}).code == 200
+
+        stats = self.get_statistics()
+        assert stats['admission_reject_count'] == 1
+        assert stats['store_count'] == 3
+
+
+class TestQueryThreads(SharedTest):
+    def get_app(self):
+        return app.make_app(url_prefix='', debug=True, query_threads=2)
+
+    def test_upload_json_query_json(self):
+        assert self.post_json('/dataset/abc', [{'foo': 1, 'bar': 10}, {'foo': 2, 'bar': 20}]).code == 201
+
+        response = self.query_json('/dataset/abc', {'where': ['==', 'foo', 1]})
+        assert response.code == 200
+        assert json.loads(response.body) == [{'foo': 1, 'bar': 10}]
+        assert response.headers['X-QCache-unsliced-length'] == '1'
+
+    def test_malformed_query_results_in_bad_request(self):
+        assert self.post_json('/dataset/abc', [{'foo': 1, 'bar': 10}]).code == 201
+
+        response = self.query_json('/dataset/abc', {'where': ['<>', 'foo', 1]})
+        assert response.code == 400
+        assert 'Unknown operator' in json.loads(response.body)['error']
+
+    def test_concurrent_queries(self):
+        assert self.post_csv('/dataset/abc', [{'foo': i, 'bar': i % 3} for i in range(1000)]).code == 201
+
+        queries = [{'where': ['==', 'bar', i % 3], 'select': [['count']]} for i in range(10)]
+        urls = [self.get_url(url_concat('/dataset/abc', {'q': json.dumps(q)})) for q in queries]
+        responses = self.io_loop.run_sync(lambda: gen.multi([self.http_client.fetch(url) for url in urls]))
+
+        assert [json.loads(r.body) for r in responses] == [[{'count': 334 if i % 3 == 0 else 333}] for i in range(10)]
+
+    def test_stand_in_columns_and_update(self):
+        assert self.post_csv('/dataset/abc', [{'foo': 1}, {'foo': 2}]).code == 201
+
+        response = self.query_json('/dataset/abc', {'update': [['foo', 3]], 'where': ['==', 'foo', 2]})
+        assert response.code == 200
+
+        response = self.query_json('/dataset/abc', {}, extra_headers={'X-QCache-stand-in-columns': 'bar=13'})
+        assert json.loads(response.body) == [{'foo': 1, 'bar': 13}, {'foo': 3, 'bar': 13}]
+
+
+class TestShardedRouting(SharedTest):
+    def get_app(self):
+        self.worker_urls = []
+        for _ in range(2):
+            sock, port = bind_unused_port()
+            server = HTTPServer(app.make_app(url_prefix='', debug=True))
+            server.add_sockets([sock])
+            self.worker_urls.append('http://127.0.0.1:{port}'.format(port=port))
+
+        return router.make_router_app(self.worker_urls, url_prefix='', debug=True, max_body_size=10000000)
+
+    def get_httpserver_options(self):
+        # Only streamed request bodies may be larger than this
+        return {'max_body_size': 100000}
+
+    def worker_dataset_counts(self):
+        return [json.loads(self.fetch(url + '/statistics').body)['dataset_count'] for url in self.worker_urls]
+
+    def test_datasets_are_distributed_between_workers_by_key(self):
+        keys = ['key{i}'.format(i=i) for i in range(20)]
+        for key in keys:
+            assert self.post_json('/dataset/' + key, [{'foo': 1, 'key': key}]).code == 201
+
+        for key in keys:
+            response = self.query_json('/dataset/' + key, {'select': ['key']})
+            assert response.code == 200
+            assert json.loads(response.body) == [{'key': key}]
+
+        assert sum(self.worker_dataset_counts()) == len(keys)
+        assert all(count > 0 for count in self.worker_dataset_counts())
+
+    def test_query_post_and_delete_are_routed(self):
+        assert self.post_csv('/dataset/abc', [{'foo': 1}, {'foo': 2}]).code == 201
+
+        response = self.fetch('/dataset/abc/q', method='POST', body=to_json({'where': ['==', 'foo', 2]}),
+                              headers={'Content-Type': 'application/json'})
+        assert response.code == 200
+        assert json.loads(response.body) == [{'foo': 2}]
+
+        assert self.fetch('/dataset/abc', method='DELETE').code == 200
+        assert self.query_json('/dataset/abc', {}).code == 404
+
+    def test_compressed_response_is_passed_through_unchanged(self):
+        assert self.post_json('/dataset/abc', [{'foo': 1}]).code == 201
+        response = self.query_json('/dataset/abc', {}, extra_headers={'Accept-Encoding': 'lz4'})
+
+        assert response.code == 200
+        assert response.headers['Content-Encoding'] == 'lz4'
+        assert json.loads(lz4.block.decompress(response.body)) == [{'foo': 1}]
+
+    def test_statistics_are_merged_from_all_workers(self):
+        for i in range(10):
+            self.post_json('/dataset/key{i}'.format(i=i), [{'foo': i}])
+
+        stats = self.get_statistics()
+        assert stats['worker_count'] == 2
+        assert stats['unavailable_worker_count'] == 0
+        assert stats['store_count'] == 10
+        assert stats['dataset_count'] == 10
+        assert len(stats['store_durations']) == 10
+
+    def test_batch_queries_are_split_between_workers(self):
+        keys = ['key{i}'.format(i=i) for i in range(10)]
+        for i, key in enumerate(keys):
+            assert self.post_json('/dataset/' + key, [{'foo': i}]).code == 201
+
+        batch = [{'dataset': key, 'query': {}} for key in reversed(keys)] + [{'dataset': 'missing', 'query': {}}]
+        response = self.fetch('/qs', method='POST', body=to_json(batch), headers={'Accept-Encoding': 'gzip'})
+
+        assert response.code == 200
+        results = json.loads(response.body)
+        assert [r['result'] for r in results[:-1]] == [[{'foo': i}] for i in reversed(range(10))]
+        assert results[-1]['status'] == 404
+
+        response = self.fetch('/dataset/key1/qs', method='POST', body=to_json([{}, {'select': [['count']]}]))
+        assert [r['result'] for r in json.loads(response.body)] == [[{'foo': 1}], [{'count': 1}]]
+
+    def test_upload_larger_than_server_max_body_size_is_streamed_to_worker(self):
+        data = [{'foo': i, 'bar': 'abcdefghij'} for i in range(50000)]
+        response = self.post_csv('/dataset/abc', data)
+        assert response.code == 201
+
+        response = self.query_json('/dataset/abc', {'select': [['count']]})
+        assert json.loads(response.body) == [{'count': 50000}]
+
+    def test_upload_aborted_by_client_is_not_stored(self):
+        body = to_csv([{'foo': i, 'bar': 'abcdefghij'} for i in range(50000)])
+
+        @gen.coroutine
+        def send_half_body():
+            stream = IOStream(socket.socket())
+            yield stream.connect(('127.0.0.1', self.get_http_port()))
+            yield stream.write('POST /dataset/abc HTTP/1.1\r\nContent-Type: text/csv\r\n'
+                               'Content-Length: {length}\r\n\r\n'.format(length=len(body)))
+            yield stream.write(body[:len(body) // 2])
+            yield gen.sleep(0.1)
+            stream.close()
+            yield gen.sleep(0.2)
+
+        self.io_loop.run_sync(send_half_body)
+        assert self.worker_dataset_counts() == [0, 0]
+
+    def test_repeated_headers_are_forwarded(self):
+        assert self.post_json('/dataset/abc', [{'foo': 1}]).code == 201
+
+        headers = HTTPHeaders()
+        headers.add('Accept', 'text/csv')
+        headers.add('Accept', 'application/json;q=0.5')
+        response = self.fetch(url_concat('/dataset/abc', {'q': json.dumps({})}), headers=headers)
+        assert response.code == 200
+        assert response.headers['Content-Type'] == 'text/csv; charset=utf-8'
+
+    def test_batch_with_invalid_dataset_key_is_400(self):
+        for key in ['a/b', u'åäö', '']:
+            response = self.fetch('/qs', method='POST', body=to_json([{'dataset': key, 'query': {}}]))
+            assert response.code == 400
+
+    def test_key_slot_is_stable(self):
+        assert router.key_slot('abc') == router.key_slot('abc')
+        assert 0 <= router.key_slot('abc') < router.SLOT_COUNT
+
+
 class SSLTestBase(AsyncHTTPTestCase):
     TLS_DIR = os.path.join(os.path.dirname(__file__), '../tls/')
 
@@ -0,0 +1,191 @@
+import time
+
+import pandas
+from tornado.concurrent import dummy_executor
+
+from qcache.app import AppState
+from qcache.auto_index import AutoIndexer
+from qcache.dataset_cache import DatasetCache
+from qcache.qframe import QFrame
+from qcache.statistics import Statistics
+
+
+class FakeGCScheduler(object):
+    def __init__(self):
+        self.last_activity = 0
+
+
+def new_cache():
+    cache = DatasetCache(max_size=10000000, max_age=0)
+    cache['a'] = QFrame(pandas.DataFrame({'foo': range(100), 'bar': ['x{}'.format(i % 10) for i in range(100)]}))
+    return cache
+
+
+def new_indexer(cache, gc_scheduler=None, min_scans=3, max_size=100000, max_age=600.0):
+    return AutoIndexer(cache, Statistics(buffer_size=10), dummy_executor, AppState(), gc_scheduler or FakeGCScheduler(),
+                       min_scans=min_scans, max_size=max_size, max_age=max_age, min_rows=10)
+
+
+def scan(cache, q, count):
+    for _ in range(count):
+        cache['a'].query(q)
+
+
+def test_builds_index_for_repeatedly_scanned_column():
+    cache = new_cache()
+    indexer = new_indexer(cache)
+    size = cache.size
+
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 2)
+    indexer.check()
+    assert cache['a'].indexes == {}
+
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 1)
+    indexer.check()
+    assert cache['a'].index_kinds == {'bar': 'hash'}
+    assert cache.size > size
+    assert indexer.size() > 0
+    assert len(cache['a'].query({'where': ['==', 'bar', '"x1"']})) == 10
+    assert indexer.stats.snapshot()['auto_index_build_count'] == 1
+
+
+def test_range_filters_and_ordering_build_sorted_index():
+    cache = new_cache()
+    indexer = new_indexer(cache)
+
+    scan(cache, {'where': ['==', 'foo', 5]}, 3)
+    indexer.check()
+    assert cache['a'].index_kinds == {'foo': 'hash'}
+
+    # Replaces the hash index, which cannot serve ordering
+    scan(cache, {'order_by': ['-foo']}, 3)
+    indexer.check()
+    assert cache['a'].index_kinds == {'foo': 'sorted'}
+    assert cache['a'].query({'order_by': ['-foo'], 'limit': 2}).to_dicts()[0]['foo'] == 99
+
+
+def test_most_scanned_column_is_indexed_first():
+    cache = new_cache()
+    indexer = new_indexer(cache)
+    scan(cache, {'where': ['<', 'foo', 5]}, 3)
+    scan(cache, {'where': ['in', 'bar', ['x1']]}, 4)
+
+    indexer.check()
+    assert cache['a'].index_kinds == {'bar': 'hash'}
+    indexer.check()
+    assert cache['a'].index_kinds == {'bar': 'hash', 'foo': 'sorted'}
+
+
+def test_does_not_index_while_busy():
+    cache = new_cache()
+    gc_scheduler = FakeGCScheduler()
+    gc_scheduler.last_activity = time.time()
+    indexer = new_indexer(cache, gc_scheduler=gc_scheduler)
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 3)
+
+    indexer.check()
+    assert cache['a'].indexes == {}
+
+
+def test_indexes_stay_within_max_size():
+    cache = new_cache()
+    indexer = new_indexer(cache, max_size=100)
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 3)
+
+    indexer.check()
+    assert cache['a'].indexes == {}
+
+
+def test_unused_index_is_dropped():
+    cache = new_cache()
+    indexer = new_indexer(cache, max_age=0.01)
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 3)
+    indexer.check()
+    size = cache.size
+
+    time.sleep(0.02)
+    indexer.check()
+    assert cache['a'].indexes == {}
+    assert cache.size < size
+
+    # The scans could not be served by the index, it's not built again
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 3)
+    indexer.check()
+    assert cache['a'].indexes == {}
+
+
+def test_declared_indexes_are_neither_replaced_nor_dropped():
+    cache = new_cache()
+    cache['a'].build_indexes({'foo': 'hash'})
+    indexer = new_indexer(cache, max_age=0)
+    scan(cache, {'where': ['>', 'foo', 95]}, 3)
+
+    indexer.check()
+    assert cache['a'].index_kinds == {'foo': 'hash'}
+
+
+def test_columns_that_cannot_be_indexed_are_skipped():
+    cache = new_cache()
+    cache['a'] = QFrame(pandas.DataFrame({'foo': [True, False] * 50}))
+    indexer = new_indexer(cache)
+    scan(cache, {'where': ['==', 'foo', True]}, 3)
+
+    indexer.check()
+    assert cache['a'].indexes == {}
+    assert cache['a'].index_usage.candidates(1) == []
+
+
+def test_index_is_discarded_if_dataset_modified_while_building():
+    cache = new_cache()
+    indexer = new_indexer(cache)
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 3)
+
+    class ModifyingExecutor(object):
+        def submit(self, fn, *args):
+            cache.modified('a')
+            return dummy_executor.submit(fn, *args)
+
+    indexer.executor = ModifyingExecutor()
+    indexer.check()
+    assert cache['a'].indexes == {}
+
+
+def test_build_is_registered_as_running_query():
+    cache = new_cache()
+    indexer = new_indexer(cache)
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 3)
+    running_queries = []
+
+    class RecordingExecutor(object):
+        def submit(self, fn, *args):
+            running_queries.append(indexer.state.running_queries['a'])
+            return dummy_executor.submit(fn, *args)
+
+    indexer.executor = RecordingExecutor()
+    indexer.check()
+    assert running_queries == [1]
+    assert 'a' not in indexer.state.running_queries
+    assert set(cache['a'].indexes) == {'bar'}
+
+
+def test_failed_build_is_logged(caplog):
+    cache = new_cache()
+    indexer = new_indexer(cache)
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 3)
+
+    class FailingExecutor(object):
+        def submit(self, fn, *args):
+            return dummy_executor.submit(lambda: 1 / 0)
+
+    indexer.executor = FailingExecutor()
+    indexer.check()
+    assert cache['a'].indexes == {}
+    assert not indexer.building
+    assert 'ZeroDivisionError' in caplog.text
+    assert 'a' not in indexer.state.running_queries
+
+    # Built once the column has been scanned again
+    indexer.executor = dummy_executor
+    scan(cache, {'where': ['==', 'bar', '"x1"']}, 3)
+    indexer.check()
+    assert set(cache['a'].indexes) == {'bar'}
@@ -0,0 +1,152 @@
+# coding=utf-8
+import mmap
+
+import numpy
+import pandas
+import pytest
+from pandas.util.testing import assert_frame_equal
+
+from qcache.qframe.columnar import ColumnarFormatException, from_columnar, map_columnar, read_columnar, \
+    to_columnar, write_columnar
+from qcache.qframe.strings import compact_strings
+
+
+def round_trip(df):
+    return from_columnar(b''.join(to_columnar(df)))
+
+
+def buffer_of(values):
+    """
+    The object holding the memory of the array values.
+    """
+    while isinstance(values, numpy.ndarray):
+        values = values.base
+    return values
+
+
+def test_numeric_columns_round_trip():
+    df = pandas.DataFrame({'a': [1, 2, 3],
+                           'b': [1.5, numpy.nan, -2.0],
+                           'c': [True, False, True],
+                           'd': numpy.array([1, 2, 3], dtype=numpy.uint8),
+                           'e': pandas.to_datetime(['2016-01-01', '2016-01-02', None])},
+                          columns=['a', 'b', 'c', 'd', 'e'])
+    assert_frame_equal(round_trip(df), df)
+
+
+def test_string_columns_round_trip():
+    df = pandas.DataFrame({'plain': ['abc', u'åäö', None, ''],
+                           'dictionary': ['x', 'y', 'x', numpy.nan]},
+                          columns=['plain', 'dictionary'])
+    result = round_trip(df)
+
+    assert list(result['plain'][:2]) == ['abc', u'åäö'.encode('utf-8')]
+    assert result['plain'][3] == ''
+    assert pandas.isnull(result['plain'][2])
+    assert list(result['dictionary'][:3]) == ['x', 'y', 'x']
+    assert pandas.isnull(result['dictionary'][3])
+
+
+def test_repeated_strings_are_dictionary_encoded():
+    repeated = pandas.DataFrame({'a': ['abcdefgh', 'ijklmnop'] * 1000})
+    distinct = pandas.DataFrame({'a': ['{:08}'.format(i) for i in range(2000)]})
+
+    assert len(b''.join(to_columnar(repeated))) < len(b''.join(to_columnar(distinct))) / 2
+    assert_frame_equal(round_trip(repeated), repeated)
+
+
+def test_category_columns_round_trip():
+    df = pandas.DataFrame({'a': pandas.Categorical(['x', 'y', None, 'x'], categories=['y', 'x'], ordered=True),
+                           'b': pandas.Categorical([1, 2, 1, 1])})
+    assert_frame_equal(round_trip(df), df)
+
+
+def test_empty_frame_round_trip():
+    df = pandas.DataFrame({'a': numpy.array([], dtype=numpy.int64), 'b': numpy.array([], dtype=object)})
+    result = round_trip(df)
+    assert len(result) == 0
+    assert list(result.columns) == ['a', 'b']
+
+
+def test_index_is_not_preserved():
+    df = pandas.DataFrame({'a': [1, 2]}, index=[5, 7])
+    assert list(round_trip(df).index) == [0, 1]
+
+
+def test_unsupported_values_raise_exception():
+    with pytest.raises(ColumnarFormatException):
+        to_columnar(pandas.DataFrame({'a': [1, 'b']}))
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'NOTCOLUMNAR' + b'\0' * 20,
+    b''.join(to_columnar(pandas.DataFrame({'a': [1, 2]})))[:-8],
+])
+def test_invalid_data_raises_exception(data):
+    with pytest.raises(ColumnarFormatException):
+        from_columnar(data)
+
+
+def test_map_file(tmpdir):
+    df = pandas.DataFrame({'a': [1, 2, 3], 'b': ['x', 'y', 'z']})
+    path = str(tmpdir.join('df.qcol'))
+    with open(path, 'wb') as f:
+        write_columnar(df, f)
+
+    result = map_columnar(path)
+    assert_frame_equal(result, df)
+
+    # The mapping is private
+    result['a'] += 1
+    assert_frame_equal(map_columnar(path), df)
+
+
+def test_numeric_columns_refer_to_writable_data():
+    df = pandas.DataFrame({'a': [1, 2, 3], 'b': [1.5, 2.5, 3.5], 'c': ['x', 'y', 'z']}, columns=['a', 'b', 'c'])
+    data = bytearray(b''.join(to_columnar(df)))
+
+    result = from_columnar(data)
+    assert_frame_equal(result, df)
+    assert buffer_of(result['a'].values) is data
+    assert buffer_of(result['b'].values) is data
+
+    # Read only data is copied so that the columns can be updated
+    result = from_columnar(bytes(data))
+    result.loc[result['a'] > 1, 'b'] = 0.0
+    assert list(result['b']) == [1.5, 0.0, 0.0]
+
+
+def test_mapped_numeric_columns_refer_to_file(tmpdir):
+    df = pandas.DataFrame({'a': [1, 2, 3], 'b': [1.5, 2.5, 3.5], 'c': [4, 5, 6],
+                           'd': pandas.to_datetime(['2016-01-01', '2016-01-02', None]), 'e': ['x', 'y', 'z']},
+                          columns=['a', 'b', 'c', 'd', 'e'])
+    path = str(tmpdir.join('df.qcol'))
+    with open(path, 'wb') as f:
+        write_columnar(df, f)
+
+    result = map_columnar(path)
+    assert_frame_equal(result, df)
+    assert all(isinstance(buffer_of(result[name].values), mmap.mmap) for name in ['a', 'b', 'c', 'd'])
+
+    # Updates are done in place
+    result.loc[result['a'] > 1, 'b'] = 0.0
+    assert list(result['b']) == [1.5, 0.0, 0.0]
+
+
+def test_compact_string_columns_round_trip():
+    df = pandas.DataFrame({'a': ['abc', u'åäö'.encode('utf-8'), None], 'b': [1, 2, 3]}, columns=['a', 'b'])
+    compact_df = df.copy()
+    string_columns = compact_strings(compact_df)
+
+    data = b''.join(to_columnar(compact_df, string_columns=string_columns))
+    assert_frame_equal(from_columnar(data), df)
+
+    result, result_string_columns = read_columnar(data, string_columns=['a'])
+    assert list(result_string_columns) == ['a']
+    assert result['a'].tolist() == [0, 1, 2]
+    assert result_string_columns['a'].take(numpy.array([1]))[0] == u'åäö'.encode('utf-8')
+
+    # Only the given positions are written
+    data = b''.join(to_columnar(compact_df.iloc[[2, 0]], string_columns=string_columns))
+    assert_frame_equal(from_columnar(data), df.iloc[[2, 0]].reset_index(drop=True))
@@ -0,0 +1,204 @@
+import time
+
+import pandas
+import pytest
+from freezegun import freeze_time
+
+from qcache.dataset_cache import DatasetCache
+from qcache.eviction import EVICTION_POLICIES
+from qcache.expiry import ExpirySweeper
+from qcache.qframe import QFrame
+from qcache.statistics import Statistics
+
+from cache_helpers import FakeQFrame, item_size
+
+
+def fill(cache, keys, size=100):
+    for key in keys:
+        cache[key] = FakeQFrame(size)
+
+
+def test_least_recently_stored_dataset_is_evicted_first():
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0)
+    fill(cache, ['a', 'b', 'c'])
+
+    durations = cache.ensure_free(item_size(100))
+
+    assert len(durations) == 1
+    assert 'a' not in cache
+    assert 'b' in cache and 'c' in cache
+
+
+def test_accessed_dataset_is_evicted_last():
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0)
+    fill(cache, ['a', 'b', 'c'])
+    cache['a']
+
+    cache.ensure_free(2 * item_size(100))
+
+    assert list(k for k in 'abc' if k in cache) == ['a']
+
+
+def test_replaced_dataset_becomes_most_recently_used():
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0)
+    fill(cache, ['a', 'b', 'c'])
+    fill(cache, ['a'])
+
+    cache.ensure_free(item_size(100))
+
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert cache.size == 2 * item_size(100)
+
+
+def test_no_eviction_when_space_is_available():
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0)
+    fill(cache, ['a', 'b'])
+
+    assert cache.ensure_free(item_size(100)) == []
+    assert len(cache) == 2
+
+
+def test_everything_evicted_when_required():
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0)
+    fill(cache, ['a', 'b', 'c'])
+
+    assert len(cache.ensure_free(3 * item_size(100))) == 3
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_impossible_to_allocate_more_than_max_size():
+    cache = DatasetCache(max_size=100, max_age=0)
+    with pytest.raises(Exception):
+        cache.ensure_free(101)
+
+
+def test_invalidation_callback_on_replace_delete_and_eviction():
+    invalidated = []
+    cache = DatasetCache(max_size=2 * item_size(100), max_age=0, on_invalidate=invalidated.append)
+    fill(cache, ['a', 'b', 'a'])
+    del cache['b']
+    fill(cache, ['c'])
+    cache.ensure_free(2 * item_size(100))
+
+    assert invalidated == ['a', 'b', 'a', 'c']
+
+
+@pytest.mark.parametrize("policy", sorted(EVICTION_POLICIES))
+def test_size_is_updated_when_dataset_is_modified(policy):
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0, eviction_policy=policy)
+    fill(cache, ['a', 'b'])
+    qframe = cache['a']
+    version = cache.version('a')
+
+    qframe.size = 200
+    cache.modified('a')
+
+    assert cache.size == item_size(100) + item_size(200)
+    assert cache.version('a') != version
+
+    # The policy also knows about the new size
+    cache.ensure_free(item_size(100))
+    assert len(cache) == 1
+    assert cache.size <= 2 * item_size(100)
+
+
+def test_overhead_is_included_when_making_room():
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0)
+    fill(cache, ['a', 'b'])
+    assert cache.has_room(item_size(100))
+
+    cache.overhead = 50
+    assert not cache.has_room(item_size(100))
+    assert len(cache.ensure_free(item_size(100))) == 1
+
+
+def test_expired_datasets_are_evicted_without_being_accessed():
+    cache = DatasetCache(max_size=10 * item_size(100), max_age=5)
+    with freeze_time('2015-10-22 00:00:00'):
+        fill(cache, ['a', 'b'])
+        cache.store('c', FakeQFrame(100), ttl=0)
+        cache.store('d', FakeQFrame(100), ttl=10)
+
+    with freeze_time('2015-10-22 00:00:04'):
+        fill(cache, ['b'])
+        assert cache.evict_expired() == 0
+
+    with freeze_time('2015-10-22 00:00:06'):
+        assert cache.evict_expired() == 1
+        assert sorted(k for k in 'abcd' if k in cache) == ['b', 'c', 'd']
+
+    with freeze_time('2015-10-22 00:00:11'):
+        assert cache.evict_expired() == 2
+        assert len(cache) == 1
+        assert cache.size == item_size(100)
+
+
+def test_sliding_age_is_counted_from_last_access():
+    cache = DatasetCache(max_size=10 * item_size(100), max_age=5, sliding_age=True)
+    with freeze_time('2015-10-22 00:00:00'):
+        fill(cache, ['a', 'b'])
+
+    with freeze_time('2015-10-22 00:00:04'):
+        cache['a']
+
+    with freeze_time('2015-10-22 00:00:06'):
+        assert cache.evict_expired() == 1
+        assert 'a' in cache
+
+    with freeze_time('2015-10-22 00:00:10'):
+        assert cache.evict_expired() == 1
+        assert len(cache) == 0
+
+
+def test_expiry_sweeper_counts_evicted_datasets():
+    stats = Statistics(buffer_size=10)
+    cache = DatasetCache(max_size=10 * item_size(100), max_age=5)
+    sweeper = ExpirySweeper(cache, stats)
+    with freeze_time('2015-10-22 00:00:00'):
+        fill(cache, ['a', 'b'])
+
+    with freeze_time('2015-10-22 00:00:06'):
+        sweeper.sweep()
+
+    assert len(cache) == 0
+    assert stats.stats['age_evict_count'] == 2
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("key_count", [100, 10000, 100000, 1000000])
+def test_eviction_cost_is_independent_of_cache_size(key_count):
+    cache = DatasetCache(max_size=key_count * item_size(1), max_age=0)
+    fill(cache, xrange(key_count), size=1)
+
+    eviction_count = 1000
+    t0 = time.time()
+    for key in xrange(key_count, key_count + eviction_count):
+        cache.ensure_free(item_size(1))
+        cache[key] = FakeQFrame(1)
+        cache[key - 1]
+
+    duration = time.time() - t0
+    print('\n{key_count} keys, eviction and access duration: {duration} us'.format(
+        key_count=key_count, duration=1000000 * duration / eviction_count))
+
+
+def test_datasets_evicted_to_make_room_are_spilled_and_restored(tmpdir):
+    cache = DatasetCache(max_size=2000, max_age=0, spill_dir=str(tmpdir), spill_size=10000)
+    cache['a'] = QFrame(pandas.DataFrame({'a': range(100)}))
+    cache.ensure_free(cache.max_size)
+    assert 'a' not in cache
+    assert 'a' in cache.spill
+
+    assert cache.restore('a') == ('spill', [])
+    assert list(cache['a'].df['a']) == list(range(100))
+    assert 'a' not in cache.spill
+
+
+def test_discard_removes_spilled_dataset(tmpdir):
+    cache = DatasetCache(max_size=2000, max_age=0, spill_dir=str(tmpdir), spill_size=10000)
+    cache['a'] = QFrame(pandas.DataFrame({'a': range(100)}))
+    cache.ensure_free(cache.max_size)
+    cache.discard('a')
+    assert cache.restore('a') is None
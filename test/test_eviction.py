@@ -0,0 +1,131 @@
+import random
+
+import pytest
+
+from qcache.dataset_cache import DatasetCache
+from qcache.eviction import EVICTION_POLICIES
+
+from cache_helpers import FakeQFrame, item_size
+
+
+def store(cache, key, size=100):
+    cache.ensure_free(item_size(size))
+    cache[key] = FakeQFrame(size)
+
+
+def cached_keys(cache, keys):
+    return [k for k in keys if k in cache]
+
+
+@pytest.mark.parametrize("policy", sorted(EVICTION_POLICIES))
+def test_random_workload_stays_within_max_size(policy):
+    rand = random.Random(policy)
+    cache = DatasetCache(max_size=20000, max_age=0, eviction_policy=policy)
+    for _ in range(5000):
+        key = rand.randint(0, 200)
+        if key in cache and rand.random() < 0.7:
+            cache[key]
+        elif key in cache and rand.random() < 0.1:
+            del cache[key]
+        else:
+            store(cache, key, size=rand.randint(1, 2000))
+
+        assert cache.size <= cache.max_size
+
+    assert cache.size == sum(item_size(cache[k].size) for k in range(201) if k in cache)
+
+
+@pytest.mark.parametrize("policy", sorted(EVICTION_POLICIES))
+def test_everything_can_be_evicted(policy):
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0, eviction_policy=policy)
+    for key in 'abc':
+        store(cache, key)
+    cache['b']
+
+    assert len(cache.ensure_free(3 * item_size(100))) == 3
+    assert len(cache) == 0
+
+
+def test_lru_evicts_least_recently_used():
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0, eviction_policy='lru')
+    for key in 'abc':
+        store(cache, key)
+    cache['a']
+
+    store(cache, 'd')
+    assert cached_keys(cache, 'abcd') == ['a', 'c', 'd']
+
+
+def test_lfu_evicts_least_frequently_used():
+    cache = DatasetCache(max_size=3 * item_size(100), max_age=0, eviction_policy='lfu')
+    for key in 'abc':
+        store(cache, key)
+    for key in 'aab':
+        cache[key]
+
+    store(cache, 'd')
+    assert cached_keys(cache, 'abcd') == ['a', 'b', 'd']
+
+    # Ties are broken by least recently used
+    store(cache, 'e')
+    assert cached_keys(cache, 'abcde') == ['a', 'b', 'e']
+
+
+def test_gdsf_evicts_large_rarely_used_dataset_before_small_hot_datasets():
+    cache = DatasetCache(max_size=6 * item_size(100) + item_size(1000), max_age=0, eviction_policy='gdsf')
+    for key in 'abcde':
+        store(cache, key)
+        cache[key]
+
+    store(cache, 'large', size=1000)
+    store(cache, 'f')
+    store(cache, 'g')
+
+    assert cached_keys(cache, ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'large']) == ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+
+
+def test_gdsf_ages_datasets_that_are_no_longer_used():
+    cache = DatasetCache(max_size=2 * item_size(100), max_age=0, eviction_policy='gdsf')
+    store(cache, 'old')
+    for _ in range(3):
+        cache['old']
+
+    # Each new dataset is accessed once, the inflation eventually makes the old dataset the victim
+    for key in range(10):
+        store(cache, key)
+        cache[key]
+
+    assert 'old' not in cache
+
+
+def test_arc_frequently_used_datasets_survive_scan():
+    cache = DatasetCache(max_size=4 * item_size(100), max_age=0, eviction_policy='arc')
+    for key in 'ab':
+        store(cache, key)
+        cache[key]
+
+    for key in range(20):
+        store(cache, key)
+
+    assert cached_keys(cache, 'ab') == ['a', 'b']
+
+
+def test_arc_adapts_to_recency_when_evicted_datasets_return():
+    cache = DatasetCache(max_size=4 * item_size(100), max_age=0, eviction_policy='arc')
+    for key in 'ab':
+        store(cache, key)
+        cache[key]
+
+    for key in 'cdef':
+        store(cache, key)
+
+    # c was evicted to the recency ghost list, storing it again grows the target size of the recency list
+    assert 'c' not in cache
+    store(cache, 'c')
+    assert cache._policy.target > 0
+    assert 'c' in cache
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        DatasetCache(max_size=100, max_age=0, eviction_policy='random')
@@ -0,0 +1,106 @@
+import gc
+
+import pytest
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from qcache.gc_scheduler import GCScheduler, current_rss
+from qcache.statistics import Statistics
+
+from cache_helpers import FakeRss
+
+
+class TestGCScheduler(AsyncTestCase):
+    def setUp(self):
+        super(TestGCScheduler, self).setUp()
+        self.collected_generations = []
+        self.original_collect = gc.collect
+        gc.collect = self.collected_generations.append
+        self.stats = Statistics(buffer_size=10)
+        self.rss = FakeRss()
+
+    def tearDown(self):
+        gc.collect = self.original_collect
+        super(TestGCScheduler, self).tearDown()
+
+    def scheduler(self, idle_delay=0.01, **kwargs):
+        return GCScheduler(self.stats, idle_delay=idle_delay, max_pending=5, max_rss_growth=100, rss_fn=self.rss,
+                           **kwargs)
+
+    @gen_test
+    def test_collects_when_idle(self):
+        scheduler = self.scheduler()
+        scheduler.request_started()
+        scheduler.request_finished(1)
+        assert self.collected_generations == []
+
+        yield gen.sleep(0.05)
+        assert self.collected_generations == [2]
+        assert len(self.stats.snapshot()['gc_durations']) == 1
+
+    @gen_test
+    def test_does_not_collect_while_requests_keep_arriving(self):
+        scheduler = self.scheduler(idle_delay=0.05)
+        for _ in range(4):
+            scheduler.request_started()
+            scheduler.request_finished(1)
+            yield gen.sleep(0.005)
+
+        assert self.collected_generations == []
+        yield gen.sleep(0.2)
+        assert self.collected_generations == [2]
+
+    @gen_test
+    def test_does_not_collect_without_pending_queries(self):
+        scheduler = self.scheduler()
+        scheduler.request_finished(0)
+
+        yield gen.sleep(0.05)
+        assert self.collected_generations == []
+
+    def test_collects_after_max_pending_queries(self):
+        scheduler = self.scheduler()
+        for _ in range(4):
+            scheduler.request_finished(1)
+        assert self.collected_generations == []
+
+        scheduler.request_finished(1)
+        assert self.collected_generations == [2]
+        assert scheduler.pending == 0
+
+    def test_collects_when_rss_has_grown(self):
+        scheduler = self.scheduler()
+        self.rss.rss += 100
+        scheduler.request_finished(1)
+        assert self.collected_generations == []
+
+        self.rss.rss += 1
+        scheduler.request_finished(1)
+        assert self.collected_generations == [2]
+
+        # Growth is measured from the RSS after the last collection
+        scheduler.request_finished(1)
+        assert self.collected_generations == [2]
+
+    def test_young_mode_collects_young_generations(self):
+        scheduler = self.scheduler(mode='young')
+        for _ in range(5):
+            scheduler.request_finished(1)
+
+        assert self.collected_generations == [1]
+
+    def test_off_mode_never_collects(self):
+        scheduler = self.scheduler(mode='off')
+        for _ in range(10):
+            scheduler.request_finished(1)
+
+        assert self.collected_generations == []
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            self.scheduler(mode='sometimes')
+
+
+def test_current_rss():
+    rss = current_rss()
+    assert rss is None or rss > 0
@@ -0,0 +1,106 @@
+import operator
+
+import numpy
+import pandas
+import pytest
+
+from qcache.qframe.indexes import HashIndex, IndexException, SortedIndex, build_index, column_values, rows_mask
+from qcache.qframe.strings import StringColumn
+
+
+def rows(index, series, values):
+    return sorted(index.equal_rows(column_values(series), values).tolist())
+
+
+@pytest.mark.parametrize('kind', ['hash', 'sorted'])
+def test_equal_rows_of_string_column(kind):
+    series = pandas.Series(['b', 'a', None, 'b', u'c'])
+    index = build_index(series, kind)
+
+    assert rows(index, series, ['b']) == [0, 3]
+    assert rows(index, series, ['a', u'c', 'x']) == [1, 4]
+    assert rows(index, series, ['x']) == []
+
+
+@pytest.mark.parametrize('kind', ['hash', 'sorted'])
+def test_values_that_cannot_be_looked_up(kind):
+    index = build_index(pandas.Series(['a', 'b']), kind)
+    assert index.equal_rows(numpy.array(['a', 'b'], dtype=object), [1]) is None
+    assert index.equal_rows(numpy.array(['a', 'b'], dtype=object), [None]) is None
+
+    index = build_index(pandas.Series([1.0, numpy.nan] * 20), kind)
+    assert index.equal_rows(numpy.array([1.0, numpy.nan] * 20), ['a']) is None
+    assert index.equal_rows(numpy.array([1.0, numpy.nan] * 20), [True]) is None
+
+
+def test_numeric_lookups_matching_many_rows_fall_back_to_scanning():
+    series = pandas.Series(range(100))
+    index = build_index(series, 'sorted')
+
+    assert index.range_rows(series.values, operator.lt, 5).tolist() == [0, 1, 2, 3, 4]
+    assert index.range_rows(series.values, operator.lt, 50) is None
+    assert index.equal_rows(series.values, [7]).tolist() == [7]
+
+
+def test_range_rows_of_sorted_index():
+    series = pandas.Series(['d', 'a', None, 'c', 'b', 'c'])
+    index = build_index(series, 'sorted')
+    values = column_values(series)
+
+    def range_rows(op_fn, value):
+        return sorted(index.range_rows(values, op_fn, value).tolist())
+
+    assert range_rows(operator.lt, 'c') == [1, 4]
+    assert range_rows(operator.le, 'c') == [1, 3, 4, 5]
+    assert range_rows(operator.gt, 'c') == [0]
+    assert range_rows(operator.ge, 'c') == [0, 3, 5]
+    assert index.range_rows(values, operator.ne, 'c') is None
+
+
+def test_hash_index_does_not_serve_ranges():
+    series = pandas.Series(['a', 'b'])
+    assert build_index(series, 'hash').range_rows(series.values, operator.lt, 'b') is None
+
+
+def test_sorted_index_of_compact_string_column():
+    string_column = StringColumn.from_values(['b', None, 'a', 'c'])
+    series = pandas.Series(string_column.take(string_column.positions()))
+    index = build_index(series, 'sorted')
+    values = column_values(series, string_column)
+
+    assert index.equal_rows(values, ['a', 'c']).tolist() == [2, 3]
+    assert sorted(index.range_rows(values, operator.ge, 'b').tolist()) == [0, 3]
+
+
+def test_ordered_rows_puts_nulls_last():
+    index = build_index(pandas.Series([2.0, numpy.nan, 1.0, 3.0]), 'sorted')
+    assert index.ordered_rows(True).tolist() == [2, 0, 3, 1]
+    assert index.ordered_rows(False).tolist() == [3, 0, 2, 1]
+
+
+def test_categorical_column():
+    series = pandas.Series(pandas.Categorical(['x', 'y', 'x', None]))
+    assert rows(build_index(series, 'hash'), series, ['x']) == [0, 2]
+    assert rows(build_index(series, 'sorted'), series, ['y']) == [1]
+
+
+def test_index_classes():
+    series = pandas.Series([1, 2])
+    assert isinstance(build_index(series, 'hash'), HashIndex)
+    assert isinstance(build_index(series, 'sorted'), SortedIndex)
+    assert build_index(series, 'hash').nbytes > 0
+
+
+@pytest.mark.parametrize('series, kind', [
+    (pandas.Series([1, 2]), 'btree'),
+    (pandas.Series([True, False]), 'hash'),
+    (pandas.Series(['a', 1]), 'sorted'),
+    (pandas.Series([[1], [2]]), 'hash'),
+])
+def test_invalid_index_raises_exception(series, kind):
+    with pytest.raises(IndexException):
+        build_index(series, kind)
+
+
+def test_rows_mask():
+    assert rows_mask(numpy.array([3, 0]), 4).tolist() == [True, False, False, True]
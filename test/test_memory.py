@@ -0,0 +1,109 @@
+from qcache.dataset_cache import DatasetCache
+from qcache.memory import MemoryGovernor, MemoryReconciler
+from qcache.statistics import Statistics
+
+from cache_helpers import FakeQFrame, FakeRss
+
+
+def setup_reconciler():
+    stats = Statistics(buffer_size=10)
+    cache = DatasetCache(max_size=10000, max_age=0)
+    rss = FakeRss(1000000)
+    return MemoryReconciler(cache, stats, rss_fn=rss), cache, stats, rss
+
+
+def test_memory_used_beyond_the_dataset_sizes_is_reserved():
+    reconciler, cache, _, rss = setup_reconciler()
+    cache['a'] = FakeQFrame(900)
+
+    rss.rss += 3000
+    reconciler.reconcile()
+    assert cache.overhead == 2000
+    assert cache.free_bytes() == 7000
+
+    rss.rss -= 2500
+    reconciler.reconcile()
+    assert cache.overhead == 0
+
+
+def test_datasets_are_evicted_when_overhead_exceeds_free_space():
+    reconciler, cache, stats, rss = setup_reconciler()
+    for key in 'abcd':
+        cache[key] = FakeQFrame(1900)
+
+    rss.rss += cache.size + 3000
+    reconciler.reconcile()
+
+    assert cache.overhead == 3000
+    assert len(cache) == 3
+    assert stats.stats['memory_evict_count'] == 1
+
+
+def test_overhead_is_limited_to_fraction_of_max_size():
+    reconciler, cache, _, rss = setup_reconciler()
+    rss.rss += 8000
+    reconciler.reconcile()
+
+    assert cache.overhead == 5000
+
+
+def test_no_reconciliation_without_rss():
+    reconciler, cache, _, rss = setup_reconciler()
+    reconciler.rss_fn = lambda: None
+    reconciler.reconcile()
+
+    assert cache.overhead == 0
+
+
+def setup_governor(**kwargs):
+    stats = Statistics(buffer_size=10)
+    cache = DatasetCache(max_size=10000, max_age=0)
+    rss = FakeRss(1000000)
+    return MemoryGovernor(cache, stats, rss_fn=rss, **kwargs), cache, stats, rss
+
+
+def test_governor_evicts_datasets_above_soft_limit():
+    governor, cache, stats, rss = setup_governor(soft_limit=1001000)
+    for key in 'abcd':
+        cache[key] = FakeQFrame(900)
+
+    governor.check()
+    assert len(cache) == 4
+
+    rss.rss += 2500
+    governor.check()
+    assert sorted(k for k in 'abcd' if k in cache) == ['c', 'd']
+    assert stats.stats['rss_evict_count'] == 2
+
+
+def test_governor_does_not_evict_more_if_memory_is_not_released():
+    governor, cache, stats, rss = setup_governor(soft_limit=1001000)
+    for key in 'abcd':
+        cache[key] = FakeQFrame(900)
+
+    rss.rss += 2500
+    governor.check()
+    governor.check()
+    assert len(cache) == 2
+
+    # The RSS grows further, probably because of new datasets
+    rss.rss += 100
+    governor.check()
+    assert len(cache) < 2
+
+
+def test_governor_overloaded_above_hard_limit():
+    governor, cache, _, rss = setup_governor(hard_limit=1001000)
+    assert governor.enabled
+    assert not governor.overloaded()
+
+    rss.rss += 1001
+    assert governor.overloaded()
+
+
+def test_governor_disabled_without_limits():
+    governor, _, _, rss = setup_governor()
+    rss.rss = 10 ** 12
+
+    assert not governor.enabled
+    assert not governor.overloaded()
@@ -1,10 +1,16 @@
 # coding=utf-8
 import json
 from contextlib import contextmanager
+import pandas
 import pytest
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import time
 
-from qcache.qframe import MalformedQueryException, QFrame
+from qcache.qframe import MalformedQueryException, QFrame, CSVStreamParser, IndexException
+from qcache.qframe.column_types import ColumnTypeException, DatetimeType, parse_type_name
+from qcache.qframe.columnar import to_columnar
+from qcache.qframe.query import compile_query
 
 
 def query(df, q):
@@ -242,6 +248,11 @@ def test_like_invalid_column_type(string_frame):
         string_frame.query({'where': ['like', "foo", "'%a%'"]})
 
 
+def test_like_invalid_pattern(string_frame):
+    with pytest.raises(MalformedQueryException):
+        string_frame.query({'where': ['like', "bar", "'%a(%'"]})
+
+
 ############### Sub select ##################
 
 
@@ -276,6 +287,18 @@ def test_sub_select_in_column_missing_in_sub_select():
                                              'where': ['==', 'foo', 2]}]})
 
 
+def test_sub_select_in_concurrent_threads():
+    frames = [QFrame.from_csv("foo,bar\n{i},{i}\n{j},{i}".format(i=i, j=i + 100)) for i in range(20)]
+
+    def run(frame):
+        return frame.query({'where': ['in', 'foo', {'where': ['>', 'foo', 50]}]}).to_dicts()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(run, frames))
+
+    assert results == [[{'foo': i + 100, 'bar': i}] for i in range(20)]
+
+
 ############### Projections #######################
 
 
@@ -624,6 +647,11 @@ def test_enum_filter_by_equality(enum_frame):
     ]
 
 
+def test_enum_filter_by_like_and_isnull(enum_frame):
+    assert enum_frame.query({'where': ['like', 'foo', '"b%"']}).to_dicts() == [{'foo': 'bbb', 'bar': 20}]
+    assert len(enum_frame.query({'where': ['isnull', 'foo']})) == 0
+
+
 def test_enum_filter_by_order_comparison_not_possible(enum_frame):
     with pytest.raises(MalformedQueryException):
         enum_frame.query({'where': ['<', 'foo', '"bbb"']})
@@ -643,6 +671,18 @@ def test_enum_from_dicts(enum_frame):
     assert cat_frame.byte_size() < frame.byte_size()
 
 
+def test_byte_size_equals_deep_memory_usage_for_small_frames(enum_frame):
+    frame = QFrame.from_dicts([{'foo': 1, 'bar': 'aaa', 'baz': 1.5}, {'foo': 2, 'bar': None, 'baz': 2.5}])
+    assert frame.byte_size() == frame.df.memory_usage(index=True, deep=True).sum()
+    assert enum_frame.byte_size() == enum_frame.df.memory_usage(index=True, deep=True).sum()
+
+
+def test_byte_size_of_large_object_columns_is_estimated_from_sample():
+    frame = QFrame.from_dicts([{'foo': i, 'bar': 'a' * (i % 100)} for i in range(100000)])
+    deep_size = frame.df.memory_usage(index=True, deep=True).sum()
+    assert 0.95 * deep_size < frame.byte_size() < 1.05 * deep_size
+
+
 ############# NaN ###############
 
 
@@ -683,6 +723,163 @@ def test_only_empty_string_is_nan():
     ]
 
 
+################# Streaming CSV ######################
+
+
+def stream_csv(csv_string, block_size, column_types=None, chunk_size=7):
+    parser = CSVStreamParser(column_types=column_types, block_size=block_size)
+    for i in range(0, len(csv_string), chunk_size):
+        parser.feed(csv_string[i:i + chunk_size])
+
+    return QFrame.from_csv_stream(parser)
+
+
+@pytest.mark.parametrize("block_size", [1, 10, 100, 100000])
+def test_csv_stream_same_result_as_complete_csv(block_size):
+    csv_string = "foo,bar\n" + "".join("{i},abc{i}\n".format(i=i) for i in range(100))
+
+    assert stream_csv(csv_string, block_size).to_dicts() == QFrame.from_csv(csv_string).to_dicts()
+
+
+def test_csv_stream_newline_in_quoted_field():
+    csv_string = 'foo,bar\n1,"a\nb"\n2,"c\n\nd"\n3,"e""f"\n4,g'
+    frame = stream_csv(csv_string, block_size=5, chunk_size=3)
+
+    assert frame.to_dicts() == [{'foo': 1, 'bar': 'a\nb'},
+                                {'foo': 2, 'bar': 'c\n\nd'},
+                                {'foo': 3, 'bar': 'e"f'},
+                                {'foo': 4, 'bar': 'g'}]
+
+
+def test_csv_stream_categories_are_merged_between_blocks():
+    csv_string = "foo\n" + "".join("{c}\n".format(c=c) for c in 'aaabbbccc')
+    frame = stream_csv(csv_string, block_size=4, column_types={'foo': 'category'})
+
+    assert frame.df['foo'].dtype == 'category'
+    assert set(frame.df['foo'].cat.categories) == {'a', 'b', 'c'}
+    assert frame.query({'where': ['==', 'foo', '"b"']}).to_dicts() == 3 * [{'foo': 'b'}]
+
+
+def test_csv_stream_typed_columns_in_every_block():
+    csv_string = "foo,bar\n" + "".join("{i},2017-01-{d:02d}\n".format(i=i, d=i + 1) for i in range(20))
+    frame = stream_csv(csv_string, block_size=10, column_types={'foo': 'int8', 'bar': DatetimeType('%Y-%m-%d')})
+
+    assert frame.df['foo'].dtype == 'int8'
+    assert frame.df['bar'].dtype == 'datetime64[ns]'
+    assert len(frame.query({'where': ['>=', 'bar', '"2017-01-11"']})) == 10
+
+    with pytest.raises(ColumnTypeException):
+        stream_csv(csv_string + "1000,2017-02-01\n", block_size=10, column_types={'foo': 'int8'})
+
+
+@pytest.mark.parametrize("block_size", [10, 100000])
+def test_csv_stream_types_reconciled_between_blocks(block_size):
+    csv_string = "id,num,flag,empty,code\n" + "".join("{i},{i},True,,a{i}\n".format(i=i) for i in range(10)) + \
+                 "x,1.5,1,,b\n" + "".join("{i},{i},False,,00{i}\n".format(i=i) for i in range(10, 20))
+    frame = stream_csv(csv_string, block_size=block_size)
+    expected = QFrame.from_csv(csv_string)
+
+    assert frame.to_json() == expected.to_json()
+    assert list(frame.df.dtypes) == list(expected.df.dtypes)
+    assert frame.query({'where': ['==', 'id', "'3'"], 'select': ['id', 'num', 'flag']}).to_dicts() == \
+        [{'id': '3', 'num': 3.0, 'flag': 'True'}]
+    assert frame.query({'where': ['==', 'code', "'0012'"], 'select': ['id']}).to_dicts() == [{'id': '12'}]
+
+
+def test_csv_stream_retains_no_parsed_text():
+    block_size = 1000
+    line = "".join("{i},abc{i},{i}.5\n".format(i=i) for i in range(10))
+    parser = CSVStreamParser(block_size=block_size)
+    parser.feed("foo,bar,baz\n")
+    for _ in range(2000):
+        parser.feed(line)
+        values = vars(parser).values()
+        texts = [v for v in values if isinstance(v, str)] + \
+                [text for v in values if isinstance(v, list) for text in v if isinstance(text, str)]
+        assert sum(len(text) for text in texts) < block_size + len(line)
+
+    assert len(QFrame.from_csv_stream(parser)) == 20000
+
+
+def test_csv_stream_only_header():
+    frame = stream_csv("foo,bar\n", block_size=1)
+
+    assert len(frame) == 0
+    assert list(frame.columns) == ['foo', 'bar']
+
+
+################# Query plans ######################
+
+
+def test_compiled_plan_is_reused_for_equal_queries():
+    plan = compile_query({'where': ['==', 'foo', '"aaa"'], 'limit': 1})
+
+    assert compile_query({'limit': 1, 'where': ['==', 'foo', '"aaa"']}) is plan
+    assert compile_query({'limit': 2, 'where': ['==', 'foo', '"aaa"']}) is not plan
+
+
+def test_compiled_plan_is_not_affected_by_later_changes_to_query(basic_frame):
+    q = {'where': ['==', 'foo', '"aaa"']}
+    assert_rows(basic_frame.query(q), ['aaa'])
+
+    q['where'][2] = '"bbb"'
+    assert_rows(basic_frame.query(q), ['bbb'])
+    assert_rows(basic_frame.query({'where': ['==', 'foo', '"aaa"']}), ['aaa'])
+
+
+def test_malformed_query_is_reported_every_time(basic_frame):
+    for _ in range(2):
+        with pytest.raises(MalformedQueryException):
+            basic_frame.query({'where': ['<>', 'foo', 1]})
+
+
+################# Query many ######################
+
+
+def test_query_many_results_in_query_order(basic_frame):
+    results = basic_frame.query_many([{'where': ['==', 'qux', '"qqq"'], 'order_by': ['foo']},
+                                      {'where': ['==', 'qux', '"qqq"'], 'select': [['count']]},
+                                      {'where': ['==', 'foo', '"ccc"'], 'select': ['baz']}])
+
+    assert_rows(results[0], ['aaa', 'bbb'])
+    assert results[0].unsliced_df_len == 2
+    assert results[1].to_dicts() == [{'count': 2}]
+    assert results[2].to_dicts() == [{'baz': 9}]
+
+
+def test_query_many_shares_filter_between_queries_with_equal_where(basic_frame, monkeypatch):
+    # The query module is shadowed by the query function in the qframe package
+    query_plan = sys.modules['qcache.qframe.query'].QueryPlan
+    filter_calls = []
+
+    def counting_filter(plan, df):
+        filter_calls.append(plan.filter_key)
+        return original_filter(plan, df)
+
+    original_filter = query_plan.filter.im_func
+    monkeypatch.setattr(query_plan, 'filter', counting_filter)
+
+    results = basic_frame.query_many([{'where': ['>', 'baz', 6], 'select': ['foo']},
+                                      {'where': ['>', 'baz', 6], 'select': ['baz'], 'limit': 1},
+                                      {'where': ['<', 'baz', 6]}])
+
+    assert len(filter_calls) == 2
+    assert_rows(results[0], ['aaa', 'ccc'])
+    assert results[1].to_dicts() == [{'baz': 7}]
+    assert results[1].unsliced_df_len == 2
+    assert_rows(results[2], ['bbb'])
+
+
+def test_query_many_malformed_query_does_not_affect_other_queries(basic_frame):
+    results = basic_frame.query_many([{'where': ['==', 'foo', '"aaa"']},
+                                      {'foo': []},
+                                      {'where': ['==', 'unknown', 1]}])
+
+    assert_rows(results[0], ['aaa'])
+    assert isinstance(results[1], MalformedQueryException)
+    assert isinstance(results[2], MalformedQueryException)
+
+
 ################# Update ######################
 
 
@@ -799,6 +996,30 @@ def test_large_frame_json(large_frame):
     # from_json duration: 3.07192707062 s, This implementation no longer exists
 
 
+@pytest.mark.benchmark
+def test_large_frame_columnar(large_frame):
+    with timeit('to_columnar'):
+        data = b''.join(large_frame.to_columnar())
+
+    with timeit('from_columnar'):
+        QFrame.from_columnar(data)
+
+    # Results:
+    # to_columnar duration: 0.0677750110626 s
+    # from_columnar duration: 0.0352098941803 s
+
+
+@pytest.mark.benchmark
+def test_many_small_queries(basic_frame):
+    queries = [{'where': ['&', ['like', 'foo', '"%a%"'], ['>', 'baz', i]], 'select': ['foo', 'baz'],
+                'order_by': ['-baz'], 'limit': 10} for i in range(10)]
+
+    with timeit('1000 small queries'):
+        for _ in range(100):
+            for q in queries:
+                basic_frame.query(q)
+
+
 @pytest.mark.benchmark
 @pytest.mark.skipif(True, reason="No implementation")
 def test_large_frame_msgpack(large_frame):
@@ -831,3 +1052,338 @@ def xtest_update_with_conjunction(basic_frame):
                        'where': ['==', 'foo', '"bbb"']})
 
     assert basic_frame.to_dicts()[0]['bar'] == 3.25
+
+
+def test_from_columnar_with_stand_in_columns():
+    data = b''.join(to_columnar(pandas.DataFrame({'foo': [1, 2]})))
+    qf = QFrame.from_columnar(data, stand_in_columns=[('bar', 'foo')])
+    assert list(qf.df['bar']) == [1, 2]
+
+
+@pytest.mark.parametrize('orient', ['records', 'columns', 'split'])
+@pytest.mark.parametrize('row_count', [0, 1, 5])
+def test_json_batches_equal_to_json(orient, row_count):
+    qf = QFrame(pandas.DataFrame({'foo': range(row_count), 'bar': ['x'] * row_count}, columns=['foo', 'bar']))
+    assert ''.join(qf.to_json_batches(2, orient=orient)) == qf.to_json(orient=orient)
+
+
+def test_to_json_orient():
+    qf = QFrame(pandas.DataFrame({'foo': [1, 2], 'bar': ['x', None]}, columns=['foo', 'bar']))
+    assert json.loads(qf.to_json(orient='columns')) == {'foo': [1, 2], 'bar': ['x', None]}
+    assert json.loads(qf.to_json(orient='split')) == {'columns': ['foo', 'bar'], 'data': [[1, 'x'], [2, None]]}
+
+
+def test_from_columns():
+    qf = QFrame.from_columns([('foo', [1, 2]), ('bar', ['x', 'y'])], column_types={'bar': 'category'})
+    assert list(qf.columns) == ['foo', 'bar']
+    assert qf.df['bar'].dtype.name == 'category'
+
+    with pytest.raises(ValueError):
+        QFrame.from_columns([('foo', [1, 2]), ('bar', ['x'])])
+
+
+@pytest.fixture
+def optimizable_data():
+    return [{'foo': i % 7 - 3 if i % 9 else 100, 'bar': ['aaa', 'bbb', 'ccc'][i % 3] if i % 5 else None,
+             'baz': 'id{i}'.format(i=i)} for i in range(40)]
+
+
+def test_optimize_types(optimizable_data):
+    qf = QFrame.from_dicts(optimizable_data)
+    assert qf.optimize_types() == {'foo': 'int8', 'bar': 'enum'}
+    assert qf.original_types == {'foo': 'int64', 'bar': 'object'}
+    assert qf.df['baz'].dtype.name == 'object'
+    assert qf.byte_size() < QFrame.from_dicts(optimizable_data).byte_size()
+
+
+def test_optimize_types_category_threshold_and_skipped_columns(optimizable_data):
+    assert QFrame.from_dicts(optimizable_data).optimize_types(category_threshold=0.05) == {'foo': 'int8'}
+    assert QFrame.from_dicts(optimizable_data).optimize_types(skip_columns=('foo',)) == {'bar': 'enum'}
+
+
+@pytest.mark.parametrize('q', [
+    {'where': ['<', 'bar', '"bbb"']},
+    {'where': ['!=', 'bar', '"bbb"']},
+    {'where': ['!=', 'bar', '"xxx"']},
+    {'where': ['ilike', 'bar', '"B%"']},
+    {'where': ['isnull', 'bar']},
+    {'where': ['in', 'bar', ['aaa', 'ccc']]},
+    {'where': ['==', 'bar', 'baz']},
+    {'where': ['in', 'bar', {'where': ['==', 'foo', 100], 'select': ['bar']}]},
+    {'where': ['any_bits', 'foo', 4]},
+    {'select': [['=', 'qux', ['*', 'foo', 1000]]]},
+    {'group_by': ['bar'], 'select': ['bar', ['sum', 'foo']], 'where': ['==', 'bar', '"aaa"']},
+    {'select': [['sum', 'foo']]},
+    {'order_by': ['bar', '-foo']},
+    {'distinct': ['bar']},
+    {'from': {'where': ['==', 'bar', '"aaa"']}, 'select': [['=', 'qux', ['+', 'foo', 1000]]]},
+])
+def test_query_results_unaffected_by_optimized_types(optimizable_data, q):
+    qf = QFrame.from_dicts(optimizable_data)
+    qf.optimize_types()
+    assert qf.query(q).to_json() == QFrame.from_dicts(optimizable_data).query(q).to_json()
+
+
+def test_update_restores_original_types_of_updated_columns(optimizable_data):
+    qf = QFrame.from_dicts(optimizable_data)
+    qf.optimize_types()
+    qf.query({'update': [['+', 'foo', 1000]], 'where': ['==', 'baz', '"id1"']})
+
+    assert qf.df['foo'].dtype.name == 'int64'
+    assert qf.df['bar'].dtype.name == 'category'
+    assert qf.original_types == {'bar': 'object'}
+    assert qf.query({'where': ['>', 'foo', 100]}).to_dicts() == [{'foo': 998, 'bar': 'bbb', 'baz': 'id1'}]
+
+
+def test_stand_in_column_copied_from_optimized_column(optimizable_data):
+    qf = QFrame.from_dicts(optimizable_data)
+    qf.optimize_types()
+    qf.add_stand_in_columns([('qux', 'bar')])
+    assert qf.original_types['qux'] == 'object'
+    assert len(qf.query({'where': ['<', 'qux', '"bbb"']})) == len(qf.query({'where': ['<', 'bar', '"bbb"']}))
+
+
+@pytest.mark.parametrize('q', [
+    {'from': {'select': [['=', 'foo', ['/', 'foo', 2]], 'bar']}, 'where': ['>', 'foo', 1]},
+    {'from': {'group_by': ['bar'], 'select': ['bar', ['mean', 'foo']]}, 'where': ['<', 'foo', 100]},
+    {'from': {'select': [['=', 'bar', 'foo']]}, 'where': ['==', 'bar', 2]},
+])
+def test_from_clause_results_keep_their_types(optimizable_data, q):
+    qf = QFrame.from_dicts(optimizable_data)
+    qf.optimize_types()
+    assert qf.query(q).to_json() == QFrame.from_dicts(optimizable_data).query(q).to_json()
+
+
+def test_compact_strings(optimizable_data):
+    qf = QFrame.from_dicts(optimizable_data)
+    assert qf.compact_strings(skip_columns=('baz',)) == ['bar']
+    assert qf.df['bar'].dtype.kind == 'i'
+    assert qf.df['baz'].dtype.name == 'object'
+    assert qf.to_json() == QFrame.from_dicts(optimizable_data).to_json()
+
+
+def test_compact_strings_skips_optimized_columns(optimizable_data):
+    qf = QFrame.from_dicts(optimizable_data)
+    qf.optimize_types()
+    assert qf.compact_strings() == ['baz']
+    assert qf.byte_size() < QFrame.from_dicts(optimizable_data).byte_size()
+
+
+@pytest.mark.parametrize('q', [
+    {'where': ['==', 'bar', '"bbb"']},
+    {'where': ['!=', 'bar', '"bbb"']},
+    {'where': ['==', 'bar', 1]},
+    {'where': ['<', 'bar', '"bbb"']},
+    {'where': ['like', 'baz', '"id1%"']},
+    {'where': ['like', 'baz', '"%1"']},
+    {'where': ['like', 'baz', '"id1"']},
+    {'where': ['like', 'baz', '"%d2%"']},
+    {'where': ['ilike', 'baz', '"ID1%"']},
+    {'where': ['isnull', 'bar']},
+    {'where': ['in', 'bar', ['aaa', 'ccc', None]]},
+    {'where': ['==', 'bar', 'baz']},
+    {'where': ['in', 'baz', {'where': ['==', 'foo', 100], 'select': ['baz']}]},
+    {'group_by': ['bar'], 'select': ['bar', ['sum', 'foo']]},
+    {'order_by': ['bar', '-baz']},
+    {'distinct': ['bar']},
+    {'from': {'where': ['like', 'baz', '"id2%"']}, 'where': ['!=', 'bar', '"aaa"']},
+])
+def test_query_results_unaffected_by_compact_strings(optimizable_data, q):
+    qf = QFrame.from_dicts(optimizable_data)
+    qf.compact_strings()
+    assert qf.query(q).to_json() == QFrame.from_dicts(optimizable_data).query(q).to_json()
+
+
+@pytest.mark.parametrize('q', [
+    {'from': {'group_by': ['bar'], 'select': ['bar', ['count', 'baz']]}, 'where': ['>', 'baz', 1]},
+    {'from': {'select': [['=', 'baz', 'foo']]}, 'where': ['==', 'baz', 2]},
+    {'from': {'select': [['=', 'baz', 'foo']]}, 'where': ['in', 'baz', [2, 3]]},
+    {'from': {'select': [['=', 'baz', 'foo']]}, 'where': ['isnull', 'baz']},
+])
+def test_from_clause_results_are_not_compact(optimizable_data, q):
+    qf = QFrame.from_dicts(optimizable_data)
+    qf.compact_strings()
+    assert qf.query(q).to_json() == QFrame.from_dicts(optimizable_data).query(q).to_json()
+
+
+def test_update_of_compact_string_column(optimizable_data):
+    qf = QFrame.from_dicts(optimizable_data)
+    qf.compact_strings()
+    qf.query({'update': [['bar', '"xxx"']], 'where': ['==', 'foo', 100]})
+
+    assert qf.df['bar'].dtype.name == 'object'
+    assert list(qf.string_columns) == ['baz']
+    assert qf.query({'where': ['==', 'bar', '"xxx"'], 'select': ['baz']}).to_dicts() == \
+        [{'baz': 'id0'}, {'baz': 'id9'}, {'baz': 'id18'}, {'baz': 'id27'}, {'baz': 'id36'}]
+
+
+def test_stand_in_column_copied_from_compact_string_column(optimizable_data):
+    qf = QFrame.from_dicts(optimizable_data)
+    qf.compact_strings()
+    size = qf.byte_size()
+    qf.add_stand_in_columns([('qux', 'baz')])
+    assert qf.string_columns['qux'] is qf.string_columns['baz']
+    assert qf.query({'where': ['like', 'qux', '"id1%"'], 'select': ['qux']}).to_json() == \
+        '[{"qux":"id1"},{"qux":"id10"},{"qux":"id11"},{"qux":"id12"},{"qux":"id13"},{"qux":"id14"},' \
+        '{"qux":"id15"},{"qux":"id16"},{"qux":"id17"},{"qux":"id18"},{"qux":"id19"}]'
+
+    # The stand in shares the strings of the column it was copied from
+    assert qf.byte_size() < 2 * size
+
+
+@pytest.mark.parametrize('type_name, values, expected', [
+    ('int8', [1, -128], [1, -128]),
+    ('uint32', [1.0, 4294967295], [1, 4294967295]),
+    ('bool', [1, 0], [True, False]),
+    ('bool', ['TRUE', 'false'], [True, False]),
+    ('float32', [1, 1.5], [1.0, 1.5]),
+    ('string', [1, 2], ['1', '2']),
+    ('string', ['a', None], ['a', None]),
+    ('datetime', ['2017-01-02 10:00', None], [pandas.Timestamp('2017-01-02 10:00'), pandas.NaT]),
+    ('datetime:%d/%m/%Y', ['02/01/2017'], [pandas.Timestamp('2017-01-02')]),
+])
+def test_from_dicts_with_column_types(type_name, values, expected):
+    qf = QFrame.from_dicts([{'foo': v} for v in values], column_types={'foo': parse_type_name(type_name)})
+    assert qf.df['foo'].tolist() == expected
+
+
+@pytest.mark.parametrize('type_name, values', [
+    ('int8', [1, 128]),
+    ('int8', [1, None]),
+    ('int8', [1.5]),
+    ('uint8', [-1]),
+    ('int16', ['x']),
+    ('bool', [2]),
+    ('datetime:%Y-%m-%d', ['x']),
+])
+def test_from_dicts_with_values_not_representable_in_column_type(type_name, values):
+    with pytest.raises(ColumnTypeException):
+        QFrame.from_dicts([{'foo': v} for v in values], column_types={'foo': parse_type_name(type_name)})
+
+
+def test_unrecognized_type_name():
+    with pytest.raises(ColumnTypeException):
+        parse_type_name('int')
+
+
+def indexed_qframe(data, compact=False, **index_kinds):
+    qf = QFrame.from_dicts(data)
+    if compact:
+        qf.optimize_types()
+        qf.compact_strings()
+    qf.build_indexes(index_kinds)
+    return qf
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('q', [
+    {'where': ['==', 'baz', '"id3"']},
+    {'where': ['!=', 'baz', '"id3"']},
+    {'where': ['==', 'foo', 100]},
+    {'where': ['>=', 'foo', 100]},
+    {'where': ['<', 'baz', '"id13"']},
+    {'where': ['>', 'bar', '"aaa"']},
+    {'where': ['in', 'baz', ['id1', 'id2', 'xxx']]},
+    {'where': ['in', 'bar', ['aaa']]},
+    {'where': ['==', 'baz', 1]},
+    {'where': ['&', ['==', 'baz', '"id3"'], ['==', 'foo', 0]]},
+    {'where': ['in', 'baz', {'where': ['==', 'foo', 100], 'select': ['baz']}]},
+    {'where': ['==', 'baz', '"id3"'], 'from': {'where': ['!=', 'foo', 1]}},
+    {'order_by': ['baz'], 'limit': 5},
+    {'order_by': ['-baz'], 'where': ['>', 'foo', 0]},
+])
+def test_query_results_unaffected_by_indexes(optimizable_data, compact, q):
+    qf = indexed_qframe(optimizable_data, compact=compact, foo='sorted', bar='hash', baz='sorted')
+    assert qf.query(q).to_json() == QFrame.from_dicts(optimizable_data).query(q).to_json()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('q', [
+    {'order_by': ['foo']},
+    {'order_by': ['-foo']},
+    {'order_by': ['bar']},
+    {'order_by': ['-bar']},
+    {'order_by': ['-foo'], 'where': ['!=', 'bar', '"bbb"']},
+    {'order_by': ['bar'], 'offset': 5, 'limit': 20},
+])
+def test_order_by_indexed_column_with_equal_values_keeps_rows_in_position_order(optimizable_data, compact, q):
+    qf = indexed_qframe(optimizable_data, compact=compact, foo='sorted', bar='sorted')
+    result = [r['baz'] for r in qf.query(q).to_dicts()]
+    assert result == [r['baz'] for r in QFrame.from_dicts(optimizable_data).query(q).to_dicts()]
+
+    # Rows with equal values are ordered by position whichever the direction
+    column = q['order_by'][0].lstrip('-')
+    positions = dict((r['baz'], i) for i, r in enumerate(optimizable_data))
+    values = dict((r['baz'], r[column]) for r in optimizable_data)
+    for first, second in zip(result, result[1:]):
+        if values[first] == values[second]:
+            assert positions[first] < positions[second]
+
+
+def test_order_by_indexed_column_with_nulls_puts_nulls_last(optimizable_data):
+    qf = indexed_qframe(optimizable_data, bar='sorted')
+    result = qf.query({'order_by': ['-bar'], 'select': ['bar']}).to_dicts()
+    assert [r['bar'] for r in result[:2]] == ['ccc', 'ccc']
+    assert result[-1]['bar'] is None
+
+
+def test_index_of_updated_column_is_dropped(optimizable_data):
+    qf = indexed_qframe(optimizable_data, compact=True, foo='sorted', baz='hash')
+    qf.query({'update': [['baz', '"xxx"']], 'where': ['==', 'foo', 100]})
+    assert qf.index_kinds == {'foo': 'sorted'}
+    assert len(qf.query({'where': ['==', 'baz', '"xxx"']})) == 5
+
+
+def test_stand_in_column_copies_index(optimizable_data):
+    qf = indexed_qframe(optimizable_data, baz='hash')
+    qf.add_stand_in_columns([('qux', 'baz')])
+    assert qf.index_kinds == {'baz': 'hash', 'qux': 'hash'}
+    assert qf.query({'where': ['==', 'qux', '"id4"']}).to_dicts()[0]['baz'] == 'id4'
+
+
+def test_indexes_are_included_in_byte_size(optimizable_data):
+    assert indexed_qframe(optimizable_data, foo='hash').byte_size() > QFrame.from_dicts(optimizable_data).byte_size()
+
+
+@pytest.mark.parametrize('index_kinds', [
+    {'qux': 'hash'},
+    {'foo': 'btree'},
+    {'bar': 'sorted'},
+])
+def test_invalid_index_raises_exception(optimizable_data, index_kinds):
+    qf = QFrame.from_dicts(optimizable_data, column_types={'bar': parse_type_name('enum')})
+    with pytest.raises(IndexException):
+        qf.build_indexes(index_kinds)
+
+
+def test_index_usage(optimizable_data):
+    qf = indexed_qframe(optimizable_data, foo='sorted')
+    qf.query({'where': ['&', ['==', 'baz', '"id3"'], ['>', 'foo', 100]]})
+    qf.query({'where': ['in', 'baz', ['id1']], 'order_by': ['bar']})
+
+    # Only lookups on the stored frame, not on the result of the from clause, are counted
+    qf.query({'from': {'where': ['==', 'bar', '"aaa"']}, 'where': ['==', 'baz', '"id3"']})
+
+    assert qf.index_usage.candidates(1) == [(2, 'baz', 'hash'), (1, 'bar', 'hash')]
+    assert 'foo' in qf.index_usage.last_used
+
+    qf.query({'order_by': ['bar']})
+    assert qf.index_usage.candidates(2) == [(2, 'baz', 'hash')]
+    assert (1, 'bar', 'sorted') in qf.index_usage.candidates(1)
+
+    qf.query({'update': [['baz', '"xxx"']], 'where': ['==', 'foo', 0]})
+    assert [name for _, name, _ in qf.index_usage.candidates(1)] == ['bar', 'bar']
+
+
+def test_automatic_indexes(optimizable_data):
+    qf = indexed_qframe(optimizable_data, foo='sorted')
+    qf.add_automatic_index('baz', qf.index_column('baz', 'hash'))
+    assert qf.index_kinds == {'foo': 'sorted', 'baz': 'hash'}
+    assert qf.declared_index_kinds == {'foo': 'sorted'}
+
+    # Not copied to stand in columns
+    qf.add_stand_in_columns([('qux', 'baz'), ('quux', 'foo')])
+    assert qf.index_kinds == {'foo': 'sorted', 'baz': 'hash', 'quux': 'sorted'}
+
+    qf.drop_automatic_index('baz')
+    assert qf.index_kinds == {'foo': 'sorted', 'quux': 'sorted'}
@@ -0,0 +1,57 @@
+from qcache.compression import gzip_loads
+from qcache.result_cache import ResultCache, result_key, ENTRY_OVERHEAD
+
+
+def test_key_is_independent_of_query_key_order():
+    assert result_key('abc', 1, {'where': ['==', 'foo', 1], 'limit': 2}) == \
+        result_key('abc', 1, {'limit': 2, 'where': ['==', 'foo', 1]})
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_size=2 * (ENTRY_OVERHEAD + 10))
+    cache.put(('abc', 1, 'q1'), 1, 10 * 'a')
+    cache.put(('abc', 1, 'q2'), 1, 10 * 'b')
+    assert cache.get(('abc', 1, 'q1')) is not None
+
+    cache.put(('cba', 1, 'q3'), 1, 10 * 'c')
+
+    assert cache.get(('abc', 1, 'q2')) is None
+    assert cache.get(('abc', 1, 'q1')) is not None
+    assert cache.get(('cba', 1, 'q3')) is not None
+    assert cache.size == 2 * (ENTRY_OVERHEAD + 10)
+
+
+def test_too_large_entry_is_not_cached():
+    cache = ResultCache(max_size=ENTRY_OVERHEAD)
+    entry = cache.put(('abc', 1, 'q1'), 1, 'a')
+
+    assert entry.bodies[None] == 'a'
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_invalidate_removes_all_entries_of_dataset():
+    cache = ResultCache(max_size=10000)
+    cache.put(('abc', 1, 'q1'), 1, 'a')
+    cache.put(('abc', 2, 'q1'), 1, 'b')
+    cache.put(('cba', 1, 'q1'), 1, 'c')
+
+    cache.invalidate('abc')
+    cache.invalidate('xyz')
+
+    assert len(cache) == 1
+    assert cache.get(('cba', 1, 'q1')) is not None
+    assert cache.size == ENTRY_OVERHEAD + 1
+
+
+def test_encoded_bodies_are_kept_and_accounted_for():
+    cache = ResultCache(max_size=10000)
+    key = ('abc', 1, 'q1')
+    entry = cache.put(key, 1, 100 * 'a')
+    size_before = cache.size
+
+    body = cache.body(key, entry, 'gzip')
+
+    assert gzip_loads(body) == 100 * 'a'
+    assert cache.body(key, entry, 'gzip') is body
+    assert cache.size == size_before + len(body)
@@ -0,0 +1,173 @@
+import mmap
+import os
+import time
+
+import numpy
+import pandas
+from freezegun import freeze_time
+
+from qcache.dataset_cache import DatasetCache
+from qcache.qframe import QFrame
+from qcache.snapshot import MANIFEST_NAME, Snapshot, SnapshotWriter
+from qcache.statistics import Statistics
+
+
+def qframe(row_count=10):
+    return QFrame(pandas.DataFrame({'a': range(row_count)}))
+
+
+def snapshot_files(tmpdir):
+    return sorted(name for name in os.listdir(str(tmpdir)) if name.endswith('.qcol'))
+
+
+def new_cache(tmpdir, **kwargs):
+    return DatasetCache(max_size=100000, max_age=0, snapshot_dir=str(tmpdir), **kwargs)
+
+
+def test_datasets_are_loaded_lazily_from_snapshot(tmpdir):
+    cache = new_cache(tmpdir)
+    cache['a'] = qframe()
+    cache['b'] = qframe(20)
+    assert cache.snapshot.save(cache) == 2
+    assert os.path.isfile(str(tmpdir.join(MANIFEST_NAME)))
+
+    cache = new_cache(tmpdir)
+    assert len(cache) == 0
+    assert len(cache.snapshot) == 2
+    assert 'a' in cache.snapshot
+
+    assert cache.restore('a') == ('snapshot', [])
+    assert list(cache['a'].df['a']) == list(range(10))
+    assert 'a' not in cache.snapshot
+    assert 'b' in cache.snapshot
+    assert cache.restore('a') is None
+
+
+def test_loaded_datasets_refer_to_mapped_file(tmpdir):
+    cache = new_cache(tmpdir)
+    cache['a'] = qframe()
+    cache.snapshot.save(cache)
+
+    cache = new_cache(tmpdir)
+    cache.restore('a')
+    values = cache['a'].df['a'].values
+    while isinstance(values, numpy.ndarray):
+        values = values.base
+    assert isinstance(values, mmap.mmap)
+
+
+def test_unmodified_datasets_are_not_written_again(tmpdir):
+    cache = new_cache(tmpdir)
+    cache['a'] = qframe()
+    cache['b'] = qframe()
+    cache.snapshot.save(cache)
+
+    cache['b'] = qframe(20)
+    assert cache.snapshot.save(cache) == 1
+    assert len(snapshot_files(tmpdir)) == 2
+
+    # Neither datasets loaded from the snapshot nor datasets not loaded yet are written again
+    cache = new_cache(tmpdir)
+    cache.restore('a')
+    assert cache.snapshot.save(cache) == 0
+
+    cache = new_cache(tmpdir)
+    assert len(cache.snapshot) == 2
+
+
+def test_removed_and_replaced_datasets_are_not_restored(tmpdir):
+    cache = new_cache(tmpdir)
+    cache['a'] = qframe()
+    cache['b'] = qframe()
+    cache.snapshot.save(cache)
+
+    cache = new_cache(tmpdir)
+    cache.discard('a')
+    cache['b'] = qframe(20)
+    assert cache.restore('a') is None
+    cache.ensure_free(cache.max_size)
+    assert cache.restore('b') is None
+
+    cache.snapshot.save(cache)
+    assert len(snapshot_files(tmpdir)) == 0
+    assert len(new_cache(tmpdir).snapshot) == 0
+
+
+def test_expired_datasets_are_not_restored(tmpdir):
+    with freeze_time('2016-01-01 12:00:00'):
+        cache = new_cache(tmpdir)
+        cache.store('a', qframe(), ttl=10)
+        cache.store('b', qframe(), ttl=100)
+        cache.snapshot.save(cache)
+
+    with freeze_time('2016-01-01 12:00:20'):
+        cache = new_cache(tmpdir)
+        assert 'a' not in cache.snapshot
+        cache.restore('b')
+        assert cache.expiry_time(cache._cache_dict['b']) == time.time() + 80
+
+
+def test_unsupported_datasets_are_left_out(tmpdir):
+    cache = new_cache(tmpdir)
+    cache['a'] = QFrame(pandas.DataFrame({'a': [1, 'b']}))
+    assert cache.snapshot.save(cache) == 0
+    assert len(new_cache(tmpdir).snapshot) == 0
+
+
+def test_unreferenced_files_are_removed(tmpdir):
+    tmpdir.join('abc-1.qcol').write('')
+    tmpdir.join(MANIFEST_NAME).write('not json')
+    snapshot = Snapshot(str(tmpdir))
+    assert len(snapshot) == 0
+    assert snapshot_files(tmpdir) == []
+
+
+def test_snapshot_writer_records_statistics(tmpdir):
+    cache = new_cache(tmpdir)
+    cache['a'] = qframe()
+    stats = Statistics(buffer_size=10)
+    SnapshotWriter(cache, stats).save()
+
+    snapshot = stats.snapshot()
+    assert snapshot['snapshot_write_count'] == 1
+    assert len(snapshot['snapshot_durations']) == 1
+
+
+def test_original_types_of_optimized_columns_are_restored(tmpdir):
+    cache = new_cache(tmpdir)
+    qf = qframe()
+    qf.optimize_types()
+    cache['a'] = qf
+    cache.snapshot.save(cache)
+
+    cache = new_cache(tmpdir)
+    cache.restore('a')
+    assert cache['a'].df['a'].dtype.name == 'int8'
+    assert cache['a'].original_types == {'a': 'int64'}
+
+
+def test_compact_string_columns_are_restored(tmpdir):
+    cache = new_cache(tmpdir)
+    qf = QFrame(pandas.DataFrame({'a': range(3), 'b': ['x', None, 'zz']}))
+    qf.compact_strings()
+    cache['a'] = qf
+    cache.snapshot.save(cache)
+
+    cache = new_cache(tmpdir)
+    cache.restore('a')
+    assert list(cache['a'].string_columns) == ['b']
+    assert cache['a'].query({'where': ['like', 'b', '"z%"']}).to_dicts() == [{'a': 2, 'b': 'zz'}]
+
+
+def test_indexes_are_rebuilt(tmpdir):
+    cache = new_cache(tmpdir)
+    qf = QFrame(pandas.DataFrame({'a': range(3), 'b': ['x', None, 'zz']}))
+    qf.compact_strings()
+    qf.build_indexes({'b': 'sorted'})
+    cache['a'] = qf
+    cache.snapshot.save(cache)
+
+    cache = new_cache(tmpdir)
+    cache.restore('a')
+    assert cache['a'].index_kinds == {'b': 'sorted'}
+    assert cache['a'].query({'where': ['>', 'b', '"x"']}).to_dicts() == [{'a': 2, 'b': 'zz'}]
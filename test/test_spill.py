@@ -0,0 +1,127 @@
+import mmap
+import os
+import time
+
+import numpy
+import pandas
+
+from qcache.qframe import QFrame
+from qcache.spill import SpillCache
+
+
+def qframe(row_count=10):
+    return QFrame(pandas.DataFrame({'a': range(row_count)}))
+
+
+def spill_files(tmpdir):
+    return [name for name in os.listdir(str(tmpdir)) if name.endswith('.qcol')]
+
+
+def test_spilled_dataset_can_be_restored(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    assert spill.put('abc', qframe())
+    assert 'abc' in spill
+    assert len(spill_files(tmpdir)) == 1
+
+    restored, expiry_time = spill.pop('abc')
+    assert list(restored.df['a']) == list(range(10))
+    assert expiry_time is None
+
+    # Restoring a dataset removes it from the disk tier
+    assert 'abc' not in spill
+    assert spill.size == 0
+    assert spill_files(tmpdir) == []
+    assert spill.pop('abc') is None
+
+
+def test_restored_dataset_refers_to_mapped_file(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    spill.put('abc', qframe())
+
+    restored, _ = spill.pop('abc')
+    values = restored.df['a'].values
+    while isinstance(values, numpy.ndarray):
+        values = values.base
+    assert isinstance(values, mmap.mmap)
+
+
+def test_least_recently_spilled_datasets_are_removed_when_full(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    spill.put('a', qframe(500))
+    spill.put('b', qframe(500))
+    assert spill.size <= 10000
+
+    assert spill.put('c', qframe(500))
+    assert 'a' not in spill
+    assert 'b' in spill
+    assert 'c' in spill
+    assert len(spill_files(tmpdir)) == 2
+
+
+def test_dataset_larger_than_max_size_is_not_spilled(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=1000)
+    assert not spill.put('a', qframe(500))
+    assert 'a' not in spill
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_dataset_with_unsupported_values_is_not_spilled(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    assert not spill.put('a', QFrame(pandas.DataFrame({'a': [1, 'b']})))
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_expired_dataset_is_not_restored(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    spill.put('a', qframe(), expiry_time=time.time() - 1)
+    assert spill.pop('a') is None
+    assert spill_files(tmpdir) == []
+
+
+def test_discard_removes_file(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    spill.put('a', qframe())
+    spill.discard('a')
+    assert 'a' not in spill
+    assert spill.size == 0
+    assert spill_files(tmpdir) == []
+
+
+def test_files_left_by_previous_process_are_removed(tmpdir):
+    SpillCache(str(tmpdir), max_size=10000).put('a', qframe())
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    assert 'a' not in spill
+    assert spill_files(tmpdir) == []
+
+
+def test_original_types_of_optimized_columns_are_restored(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    qf = qframe()
+    qf.optimize_types()
+    spill.put('a', qf)
+
+    restored, _ = spill.pop('a')
+    assert restored.df['a'].dtype.name == 'int8'
+    assert restored.original_types == {'a': 'int64'}
+
+
+def test_compact_string_columns_are_restored(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    qf = QFrame(pandas.DataFrame({'a': range(3), 'b': ['x', None, 'zz']}))
+    qf.compact_strings()
+    spill.put('a', qf)
+
+    restored, _ = spill.pop('a')
+    assert list(restored.string_columns) == ['b']
+    assert restored.query({'where': ['==', 'b', '"zz"']}).to_dicts() == [{'a': 2, 'b': 'zz'}]
+
+
+def test_indexes_are_rebuilt(tmpdir):
+    spill = SpillCache(str(tmpdir), max_size=10000)
+    qf = QFrame(pandas.DataFrame({'a': range(3), 'b': ['x', None, 'zz']}))
+    qf.build_indexes({'a': 'sorted', 'b': 'hash'})
+    spill.put('a', qf)
+
+    restored, _ = spill.pop('a')
+    assert restored.index_kinds == {'a': 'sorted', 'b': 'hash'}
+    assert restored.query({'where': ['==', 'b', '"zz"']}).to_dicts() == [{'a': 2, 'b': 'zz'}]
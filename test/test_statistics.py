@@ -1,4 +1,4 @@
-from qcache.statistics import Statistics
+from qcache.statistics import Statistics, merge_snapshots
 
 
 def test_ring_buffer_size():
@@ -11,3 +11,13 @@ def test_ring_buffer_size():
 
     s.append('foo', 4)
     assert list(s.stats['foo']) == [2, 3, 4]
+
+
+def test_merge_snapshots_recalculates_hit_ratio():
+    merged = merge_snapshots([{'hit_count': 3, 'miss_count': 1, 'hit_ratio': 0.75, 'eviction_policy': 'arc'},
+                              {'hit_count': 1, 'miss_count': 3, 'hit_ratio': 0.25, 'eviction_policy': 'arc'},
+                              {'statistics_duration': 1.0}])
+
+    assert merged['hit_count'] == 4
+    assert merged['hit_ratio'] == 0.5
+    assert merged['eviction_policy'] == 'arc'
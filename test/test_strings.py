@@ -0,0 +1,80 @@
+# coding=utf-8
+import re
+
+import numpy
+import pandas
+import pytest
+
+from qcache.qframe.strings import StringColumn, compact_strings, materialize
+
+
+@pytest.fixture
+def column():
+    return StringColumn.from_values(['abc', u'åäö', None, '', 'abcd', numpy.nan, 'xabc'])
+
+
+def test_take(column):
+    values = column.take(numpy.array([1, 0, 2, 3]))
+    assert values[:2].tolist() == [u'åäö'.encode('utf-8'), 'abc']
+    assert numpy.isnan(values[2])
+    assert values[3] == ''
+
+
+def test_non_string_values_are_rejected():
+    with pytest.raises(TypeError):
+        StringColumn.from_values(['abc', 1])
+
+
+def test_isnull(column):
+    assert column.isnull(column.positions()).tolist() == [False, False, True, False, False, True, False]
+    assert StringColumn.from_values(['a']).isnull(numpy.array([0, 0])).tolist() == [False, False]
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('abc', [True, False, False, False, False, False, False]),
+    ('', [False, False, False, True, False, False, False]),
+    (u'åäö'.encode('utf-8'), [False, True, False, False, False, False, False]),
+    # Only ASCII unicode strings equal the stored UTF-8 strings, like for object columns
+    (u'abc', [True, False, False, False, False, False, False]),
+    (u'åäö', [False] * 7),
+    (1, [False] * 7),
+    (None, [False] * 7),
+])
+def test_equals(column, value, expected):
+    assert column.equals(column.positions(), value).tolist() == expected
+
+
+def test_isin(column):
+    assert column.isin(column.positions(), ['abc', 'xabc', 5]).tolist() == \
+        [True, False, False, False, False, False, True]
+
+
+def test_startswith_and_endswith(column):
+    assert column.startswith(column.positions(), 'abc').tolist() == [True, False, False, False, True, False, False]
+    assert column.endswith(column.positions(), 'abc').tolist() == [True, False, False, False, False, False, True]
+
+
+def test_search(column):
+    assert column.search(column.positions(), re.compile('b.$')).tolist() == \
+        [True, False, False, False, False, False, True]
+
+
+def test_kernels_only_evaluate_given_positions(column):
+    assert column.equals(numpy.array([6, 0, 0]), 'abc').tolist() == [False, True, True]
+
+
+def test_compact_strings_and_materialize():
+    df = pandas.DataFrame({'a': ['x', 'y', None], 'b': ['x', 1, 'z'], 'c': [1, 2, 3]}, columns=['a', 'b', 'c'])
+    original = df.copy()
+    string_columns = compact_strings(df)
+    assert list(string_columns) == ['a']
+    assert df['a'].tolist() == [0, 1, 2]
+
+    materialized, names = materialize(df.iloc[[2, 0]], string_columns)
+    assert names == ['a']
+    assert materialized['a'].tolist()[1] == 'x'
+    assert numpy.isnan(materialized['a'].tolist()[0])
+    assert df['a'].tolist() == [0, 1, 2]
+
+    df, _ = materialize(df, string_columns, inplace=True)
+    assert df['a'].fillna('null').tolist() == original['a'].fillna('null').tolist()